@@ -0,0 +1,75 @@
+"""
+Gunicorn server hooks, loaded by docker_startup.sh with --config.
+
+Command line options in docker_startup.sh still set the bind address,
+worker count and so on; this file only holds the hooks.
+"""
+import os
+
+# Recycle a worker once its resident memory passes this many MB. Python
+# rarely returns freed memory to the OS, so a worker that served one huge
+# response stays big; two of them can exhaust a 512 MB machine. 0 disables.
+MAX_WORKER_RSS_MB = int(os.environ.get('MAX_WORKER_RSS_MB', '200'))
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def worker_rss_bytes():
+    """
+    Resident set size of the current process, from /proc (Linux only).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def post_request(worker, req, environ, resp):
+    """
+    Ask a worker that grew past MAX_WORKER_RSS_MB to exit gracefully: it
+    finishes its in-flight requests and the arbiter starts a fresh one.
+
+    Gunicorn calls this for sync and gthread workers, not uvicorn workers.
+    """
+    if not MAX_WORKER_RSS_MB or not worker.alive:
+        return
+    rss = worker_rss_bytes()
+    if rss is not None and rss > MAX_WORKER_RSS_MB * 1024 * 1024:
+        worker.log.warning(
+            'Worker %s uses %.0f MB (limit %s MB), recycling it after %s',
+            worker.pid, rss / 1024 / 1024, MAX_WORKER_RSS_MB, req.path
+        )
+        worker.alive = False
+
+
+def child_exit(server, worker):
+    """
+    Drop the metric files of a worker that exited, so its gauges and live
+    samples no longer show up in /api/metrics.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """
+    With --preload, warm the application up in the arbiter before it
+    starts the workers, so they all fork from a warmed-up process.
+    """
+    if server.cfg.preload_app:
+        from rides.warmup import warm_up
+        warm_up()
+
+
+def post_worker_init(worker):
+    """
+    Finish warming up before the worker accepts requests: all of it
+    without --preload, and in any case connecting to the databases
+    (which can't be shared with the arbiter).
+    """
+    from rides.warmup import warm_up, warm_up_connections
+    if not worker.cfg.preload_app:
+        warm_up()
+    warm_up_connections()
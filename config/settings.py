@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+from importlib.util import find_spec
 from pathlib import Path
 import os
 
@@ -38,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     # Third party apps
     'rest_framework',
     'django_filters',
@@ -48,6 +50,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rides.middleware.MetricsMiddleware',
+    'rides.middleware.ServerTimingMiddleware',
+    'rides.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -56,6 +61,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'rides.middleware.ProfilingMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
@@ -94,6 +100,75 @@ DATABASES = {
     }
 }
 
+# Read replica (see rides/replicas.py). Setting DATABASE_REPLICA_HOST or
+# DATABASE_REPLICA_NAME sends the reads of list, detail and report GETs
+# to it; other connection settings default to the primary's.
+if os.environ.get('DATABASE_REPLICA_HOST') or os.environ.get('DATABASE_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DATABASE_REPLICA_NAME', DATABASES['default']['NAME']),
+        'USER': os.environ.get('DATABASE_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.environ.get('DATABASE_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        'HOST': os.environ.get('DATABASE_REPLICA_HOST', DATABASES['default']['HOST']),
+        'PORT': os.environ.get('DATABASE_REPLICA_PORT', DATABASES['default']['PORT']),
+    }
+
+# Ride event shards (see rides/sharding.py). DATABASE_SHARD_NAMES lists the
+# databases (on the primary's server, unless DATABASE_SHARD_HOSTS lists a
+# host for each) that ride events are spread over. Run
+# `manage.py migrate --database=<alias>` for each, then
+# `manage.py setup_ride_event_shards`.
+RIDE_EVENT_SHARDS = []
+shard_names = [name for name in os.environ.get('DATABASE_SHARD_NAMES', '').split(',') if name]
+shard_hosts = [host for host in os.environ.get('DATABASE_SHARD_HOSTS', '').split(',') if host]
+for index, shard_name in enumerate(shard_names):
+    alias = f'events_{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': shard_name,
+        'HOST': shard_hosts[index] if shard_hosts else DATABASES['default']['HOST'],
+    }
+    RIDE_EVENT_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['rides.sharding.ShardRouter', 'rides.replicas.ReplicaRouter']
+
+# Connection pool per worker process (see rides/backends/postgresql_pool).
+# With DATABASE_POOL_SIZE set, the threads of a worker share at most that
+# many connections per database, instead of keeping one each. Requests
+# wait up to DATABASE_POOL_TIMEOUT seconds for a free connection.
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', '0'))
+DATABASE_POOL = {
+    'MAX_SIZE': DATABASE_POOL_SIZE,
+    'TIMEOUT': float(os.environ.get('DATABASE_POOL_TIMEOUT', '10')),
+    # Close connections idle or open for longer than this (seconds)
+    'MAX_IDLE': int(os.environ.get('DATABASE_POOL_MAX_IDLE', '300')),
+    'MAX_LIFETIME': int(os.environ.get('DATABASE_POOL_MAX_LIFETIME', '3600')),
+    # Check connections idle for longer than this with SELECT 1 before reuse
+    'HEALTH_CHECK_INTERVAL': int(os.environ.get('DATABASE_POOL_HEALTH_CHECK_INTERVAL', '30')),
+}
+
+
+def use_connection_pool(databases):
+    """
+    Switch the PostgreSQL databases to the pooled backend, returning
+    connections to the pool at the end of each request.
+    """
+    for settings_dict in databases.values():
+        if settings_dict['ENGINE'] == 'django.db.backends.postgresql':
+            settings_dict['ENGINE'] = 'rides.backends.postgresql_pool'
+            settings_dict['CONN_MAX_AGE'] = 0
+            settings_dict['POOL'] = DATABASE_POOL
+
+
+if DATABASE_POOL_SIZE:
+    use_connection_pool(DATABASES)
+
+# After a client writes, its reads stay on the primary for this many
+# seconds (through a cookie), so it doesn't read stale data from a replica
+# that hasn't caught up yet. Set it above the replica's worst normal lag.
+REPLICA_LAG_SECONDS = int(os.environ.get('REPLICA_LAG_SECONDS', '5'))
+REPLICA_PIN_COOKIE = 'primary_pin'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -144,13 +219,153 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_RENDERER_CLASSES': [
+        'rides.renderers.StreamingJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'rides.pagination.StandardPageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.OrderingFilter',
     ],
+    # Token buckets per client and scope, kept in each worker process (see
+    # rides/throttling.py). A client can send a burst of as many requests
+    # as the rate allows per period.
+    'DEFAULT_THROTTLE_CLASSES': [
+        'rides.throttling.TokenBucketThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'api': os.environ.get('API_THROTTLE_RATE', '600/min'),
+        # Ride lists sorted by distance to a GPS position
+        'gps': os.environ.get('API_THROTTLE_RATE_GPS', '30/min'),
+        # Large, streamed list pages
+        'export': os.environ.get('API_THROTTLE_RATE_EXPORT', '10/min'),
+        # The change feed: clients catching up keep reading while has_more
+        # is set, a page of up to API_MAX_PAGE_SIZE rows per table at a time
+        'changes': os.environ.get('API_THROTTLE_RATE_CHANGES', '120/min'),
+        # Metrics and memory reports
+        'report': os.environ.get('API_THROTTLE_RATE_REPORT', '20/min'),
+    },
+}
+
+# Faster renderers and parsers are used when their packages are installed.
+# orjson replaces the stdlib JSON renderer (same output, so it is listed
+# first and wins content negotiation for application/json); MessagePack is
+# only used when a client asks for it with `Accept: application/msgpack`.
+if find_spec('orjson'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].insert(0, 'rides.renderers.ORJSONRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].insert(0, 'rides.parsers.ORJSONParser')
+if find_spec('msgpack'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('rides.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].append('rides.parsers.MessagePackParser')
+
+# Largest page a client can request with ?page_size=
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', '500'))
+
+# Pages with at least this many rows (and unpaginated lists) are streamed
+# row by row instead of being rendered in memory
+API_STREAMING_MIN_PAGE_SIZE = int(os.environ.get('API_STREAMING_MIN_PAGE_SIZE', '100'))
+
+# Queries of API GET requests are canceled after this many milliseconds,
+# unless the view sets its own `statement_timeout` (see rides/timeouts.py).
+# 0 turns the timeouts off.
+API_STATEMENT_TIMEOUT_MS = int(os.environ.get('API_STATEMENT_TIMEOUT_MS', '10000'))
+
+# Ride and ride event lists PostgreSQL estimates at this many rows or more
+# report the estimate as their count, with `count_approximate`, instead of
+# running COUNT(*). 0 always counts exactly.
+API_ESTIMATED_COUNT_THRESHOLD = int(os.environ.get('API_ESTIMATED_COUNT_THRESHOLD', '10000'))
+
+# Most users returned by a typeahead lookup (/api/users/lookup/), and how
+# many seconds browsers may reuse a lookup before revalidating its ETag
+API_USER_LOOKUP_LIMIT = int(os.environ.get('API_USER_LOOKUP_LIMIT', '20'))
+API_USER_LOOKUP_MAX_AGE = int(os.environ.get('API_USER_LOOKUP_MAX_AGE', '60'))
+
+# The change feed holds back rows changed in the last few seconds, so that
+# transactions still in flight don't commit behind a consumer's cursor (a
+# heuristic: see rides/changes.py)
+CHANGE_FEED_SETTLE_SECONDS = int(os.environ.get('CHANGE_FEED_SETTLE_SECONDS', '2'))
+
+# Ride event streams (/api/ride-events/stream/) are closed after this many
+# seconds so they don't hold a worker thread for long; clients reconnect.
+# Each process holds at most MAX_CONNECTIONS streams open (each takes one
+# of its threads), and turns further ones away with a 503.
+# A comment line is sent every KEEPALIVE seconds while nothing happens.
+RIDE_EVENT_STREAM_MAX_SECONDS = int(os.environ.get('RIDE_EVENT_STREAM_MAX_SECONDS', '60'))
+RIDE_EVENT_STREAM_MAX_CONNECTIONS = int(os.environ.get('RIDE_EVENT_STREAM_MAX_CONNECTIONS', '2'))
+RIDE_EVENT_STREAM_KEEPALIVE_SECONDS = 15
+
+# Caches
+# 'local' lives in each worker's memory. Entries are evicted in every worker
+# when the rows they were built from change (see rides/local_cache.py), and
+# expire after LOCAL_CACHE_TIMEOUT seconds regardless.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'rides-local',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
 }
+LOCAL_CACHE_ALIAS = 'local'
+LOCAL_CACHE_TIMEOUT = int(os.environ.get('LOCAL_CACHE_TIMEOUT', '300'))
+
+# Identical concurrent ride list requests share one computation (see
+# rides/coalescing.py). Within a worker this needs nothing else; to share
+# across workers and machines, point SINGLE_FLIGHT_CACHE_ALIAS at a cache
+# they all use, e.g. a DatabaseCache (run `manage.py createcachetable`).
+RIDE_LIST_SINGLE_FLIGHT = True
+SINGLE_FLIGHT_CACHE_ALIAS = os.environ.get('SINGLE_FLIGHT_CACHE_ALIAS') or None
+# How long a computed result stays in the shared cache for late arrivals
+SINGLE_FLIGHT_CACHE_SECONDS = 2
+# Longest a request waits for another one's result before computing its own
+SINGLE_FLIGHT_WAIT_SECONDS = 10
+
+# Prometheus metrics, served at /api/metrics (see rides/metrics.py).
+# PROMETHEUS_MULTIPROC_DIR makes gunicorn workers share their metrics
+# through files in that directory; docker_startup.sh sets it up. Scrapers
+# authenticate with `Authorization: Bearer <METRICS_TOKEN>`.
+METRICS_ENABLED = True
+METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Add a Server-Timing header (db / permissions / serialize / render) to
+# every response. When off, admins can still ask for it per request with
+# ?server_timing=1 or an `X-Server-Timing: 1` header.
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'False') == 'True'
+
+# Slow query log, browsable in the admin (see rides/slow_queries.py).
+# Statements taking at least SLOW_QUERY_THRESHOLD_MS during a request are
+# saved with the request's route and parameters; SLOW_QUERY_EXPLAIN_RATE
+# of them (0 to 1) also get their EXPLAIN plan. Only the latest
+# SLOW_QUERY_LOG_SIZE entries are kept.
+SLOW_QUERY_LOG_ENABLED = os.environ.get('SLOW_QUERY_LOG_ENABLED', 'True') == 'True'
+SLOW_QUERY_THRESHOLD_MS = int(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '200'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+SLOW_QUERY_LOG_SIZE = 1000
+
+# Admins can profile any request with ?profile=1 (see rides/profiling.py).
+# The report lists the PROFILING_TOP_FUNCTIONS most expensive functions.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'True') == 'True'
+PROFILING_TOP_FUNCTIONS = 50
+
+# Trace Python allocations with tracemalloc from startup, for the per-request
+# peak memory metric and /api/memory/ snapshots (see rides/memory.py). Admins
+# can also start tracing in a running worker through /api/memory/.
+MEMORY_TRACING_ENABLED = os.environ.get('MEMORY_TRACING_ENABLED', 'False') == 'True'
+# Stack frames kept per allocation; more frames give better grouping by
+# traceback, at a higher cost
+MEMORY_TRACING_FRAMES = int(os.environ.get('MEMORY_TRACING_FRAMES', '1'))
 
 # CORS Settings
 CORS_ALLOWED_ORIGINS = [
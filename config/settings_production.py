@@ -32,15 +32,12 @@ if CUSTOM_DOMAIN:
     ALLOWED_HOSTS.append(CUSTOM_DOMAIN)
 
 # Allow Fly.io private IPv6 network (health checks come from here)
-# Fly.io uses fdaa::/16 for private networks
-import socket
-try:
-    # Get machine's own IP which will be in the allowed range
-    hostname = socket.gethostname()
-    local_ips = socket.gethostbyname_ex(hostname)[2]
-    ALLOWED_HOSTS.extend(local_ips)
-except Exception:
-    pass
+# Fly.io uses fdaa::/16 for private networks. Fly sets the machine's own
+# address in FLY_PRIVATE_IP, which saves a blocking DNS lookup at startup.
+FLY_PRIVATE_IP = os.environ.get('FLY_PRIVATE_IP')
+if FLY_PRIVATE_IP:
+    # IPv6 addresses come bracketed in the Host header
+    ALLOWED_HOSTS.extend([FLY_PRIVATE_IP, f'[{FLY_PRIVATE_IP}]'])
 
 # CSRF Settings
 CSRF_TRUSTED_ORIGINS = [
@@ -61,6 +58,36 @@ DATABASES = {
     )
 }
 
+# Persistent connections aren't reused across requests under ASGI (each
+# request may run its queries in a different thread), so they would only
+# pile up. Close them at the end of each request instead.
+if os.environ.get('SERVER_MODE') == 'asgi':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
+# Read replica, e.g. a Fly Postgres read replica (see rides/replicas.py)
+if os.environ.get('REPLICA_DATABASE_URL'):
+    DATABASES['replica'] = dj_database_url.parse(
+        os.environ['REPLICA_DATABASE_URL'],
+        conn_max_age=DATABASES['default']['CONN_MAX_AGE'],
+        conn_health_checks=True,
+    )
+
+# Ride event shards, one URL each in RIDE_EVENT_SHARD_DATABASE_URLS
+# (comma separated, see rides/sharding.py)
+RIDE_EVENT_SHARDS = []
+for index, url in enumerate(filter(None, os.environ.get('RIDE_EVENT_SHARD_DATABASE_URLS', '').split(','))):
+    DATABASES[f'events_{index}'] = dj_database_url.parse(
+        url,
+        conn_max_age=DATABASES['default']['CONN_MAX_AGE'],
+        conn_health_checks=True,
+    )
+    RIDE_EVENT_SHARDS.append(f'events_{index}')
+
+# Share a bounded pool of connections between each worker's threads
+# instead of keeping one per thread (DATABASE_POOL_SIZE, see settings.py)
+if DATABASE_POOL_SIZE:
+    use_connection_pool(DATABASES)
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 STATIC_URL = '/static/'
@@ -90,8 +117,9 @@ TEMPLATES = [
     },
 ]
 
-# Use WhiteNoise for serving static files
-MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+# Use WhiteNoise for serving static files (its middleware, made async
+# capable for ASGI workers)
+MIDDLEWARE.insert(1, 'rides.middleware.StaticFilesMiddleware')
 
 # WhiteNoise configuration
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
@@ -19,3 +19,26 @@ INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'debug_toolbar']
 PASSWORD_HASHERS = [
     'django.contrib.auth.hashers.MD5PasswordHasher',
 ]
+
+# Test cases wrap their data in transactions the replica connection can't
+# see; ReplicaRoutingTest sets up its own replica
+DATABASES.pop('replica', None)
+# Likewise, the sharding tests set up their own ride event shards
+for alias in RIDE_EVENT_SHARDS:
+    DATABASES.pop(alias)
+RIDE_EVENT_SHARDS = []
+
+# Tests send requests far faster than any client should; ThrottlingTest
+# sets its own rates
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    'DEFAULT_THROTTLE_RATES': {scope: None for scope in REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']},
+}
+
+# The statement timeout adds a SET LOCAL and savepoints to each GET, which
+# the query counts of the other tests don't expect; StatementTimeoutTest
+# turns it on
+API_STATEMENT_TIMEOUT_MS = 0
+# Likewise for the query estimating the count; EstimatedCountTest sets a
+# threshold
+API_ESTIMATED_COUNT_THRESHOLD = 0
@@ -5,12 +5,37 @@ set -o pipefail
 set -o nounset
 
 PORT=${PORT:-8000}
+# wsgi (default): sync workers with threads
+# asgi: uvicorn workers serving config.asgi, for the async endpoints
+SERVER_MODE=${SERVER_MODE:-wsgi}
+
+# Workers write their Prometheus metrics here so /api/metrics can add them
+# up. Files left from a previous run would be counted again, so start empty.
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
 echo "Starting Django application..."
-echo "Running on port: $PORT"
+echo "Running on port: $PORT ($SERVER_MODE)"
+
+# Start gunicorn. --preload loads and warms up the application once,
+# before forking the workers (see rides/warmup.py), so the first request
+# after the machine starts doesn't pay for it.
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec gunicorn --config config/gunicorn_conf.py \
+        --preload \
+        --bind 0.0.0.0:$PORT \
+        --workers 2 \
+        --worker-class uvicorn.workers.UvicornWorker \
+        --timeout 60 \
+        --access-logfile - \
+        --error-logfile - \
+        config.asgi:application
+fi
 
-# Start gunicorn
-exec gunicorn --bind 0.0.0.0:$PORT \
+exec gunicorn --config config/gunicorn_conf.py \
+    --preload \
+    --bind 0.0.0.0:$PORT \
     --workers 2 \
     --threads 4 \
     --timeout 60 \
@@ -10,6 +10,16 @@ const userService = {
     return api.get('/users/', { params })
   },
 
+  /**
+   * Look up users of a role by the start of their name or email
+   * @param {string} role - 'rider', 'driver' or 'admin'
+   * @param {string} q - Text typed so far
+   * @returns {Promise} Response with at most a few matching users
+   */
+  lookupUsers(role, q) {
+    return api.get('/users/lookup/', { params: { role, q } })
+  },
+
   /**
    * Get a single user by ID
    * @param {number} id - User ID
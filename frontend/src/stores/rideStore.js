@@ -13,6 +13,7 @@ export const useRideStore = defineStore('ride', () => {
   const currentPage = ref(1)
   const totalPages = ref(1)
   const totalItems = ref(0)
+  const countApproximate = ref(false)
 
   // Filters
   const filters = ref({
@@ -50,11 +51,24 @@ export const useRideStore = defineStore('ride', () => {
       const response = await rideService.getRides(queryParams)
 
       rides.value = response.data.results || []
-      totalItems.value = response.data.count || 0
 
-      // Calculate total pages (assuming PAGE_SIZE = 10 from backend)
-      const pageSize = 10
-      totalPages.value = Math.ceil(totalItems.value / pageSize)
+      countApproximate.value = Boolean(response.data.count_approximate)
+      if (response.data.count === null) {
+        // The count timed out on the server: page on while there is a next page
+        totalItems.value = null
+        totalPages.value = (queryParams.page || 1) + (response.data.next ? 1 : 0)
+      } else {
+        totalItems.value = response.data.count || 0
+
+        // Calculate total pages (assuming PAGE_SIZE = 10 from backend)
+        const pageSize = 10
+        totalPages.value = Math.ceil(totalItems.value / pageSize)
+        if (countApproximate.value) {
+          // An estimated count: the next link tells where the rides end
+          const page = queryParams.page || 1
+          totalPages.value = response.data.next ? Math.max(totalPages.value, page + 1) : page
+        }
+      }
 
       return response.data
     } catch (err) {
@@ -170,6 +184,7 @@ export const useRideStore = defineStore('ride', () => {
     currentPage,
     totalPages,
     totalItems,
+    countApproximate,
     filters,
 
     // Getters
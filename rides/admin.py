@@ -1,5 +1,95 @@
 from django.contrib import admin
-from .models import User, Ride, RideEvent
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.db.models import Q
+from django.utils import timezone
+from datetime import date, datetime, time, timedelta
+
+from .models import User, Ride, RideEvent, SlowQueryLog
+from .pagination import EstimatedCountPaginator
+
+
+class DateRangeFilter(admin.DateFieldListFilter):
+    """
+    The usual date filter links, plus a from/to date form.
+
+    Replaces date_hierarchy, which reads the distinct dates of the whole
+    filtered table to build its links. The range is inclusive and filters
+    on the field's index.
+    """
+    template = 'admin/rides/date_range_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.lookup_kwarg_from = f'{field_path}__from'
+        self.lookup_kwarg_to = f'{field_path}__to'
+        super().__init__(field, request, params, model, model_admin, field_path)
+        try:
+            self.date_from = self.parse_date(self.lookup_kwarg_from)
+            self.date_to = self.parse_date(self.lookup_kwarg_to)
+        except ValueError as e:
+            raise IncorrectLookupParameters(e)
+
+    def parse_date(self, name):
+        values = self.used_parameters.pop(name, None)
+        value = values[-1] if isinstance(values, list) else values
+        return date.fromisoformat(value) if value else None
+
+    def expected_parameters(self):
+        return super().expected_parameters() + [self.lookup_kwarg_from, self.lookup_kwarg_to]
+
+    def queryset(self, request, queryset):
+        queryset = super().queryset(request, queryset)
+        if self.date_from is not None:
+            queryset = queryset.filter(**{f'{self.field_path}__gte': self.start_of(self.date_from)})
+        if self.date_to is not None:
+            queryset = queryset.filter(**{f'{self.field_path}__lt': self.start_of(self.date_to + timedelta(days=1))})
+        return queryset
+
+    def start_of(self, day):
+        return timezone.make_aware(datetime.combine(day, time.min))
+
+    def choices(self, changelist):
+        # The query string minus this filter, for the form's hidden inputs
+        self.preserved_params = [
+            (name, value) for name, value in changelist.params.items()
+            if not name.startswith(self.field_generic)
+        ]
+        yield from super().choices(changelist)
+
+
+class IndexedSearchMixin:
+    """
+    Admin search using only lookups an index serves, for large tables.
+
+    A number matches the `search_id_fields` exactly; anything else matches
+    the start of the `search_fields` (case-sensitive, see the
+    varchar_pattern_ops indexes), instead of Django's icontains, which
+    reads the whole table.
+    """
+    search_id_fields = ('pk',)
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            fields, lookup, value = self.search_id_fields, 'exact', int(term)
+        else:
+            fields, lookup, value = self.search_fields, 'startswith', term
+        condition = Q()
+        for field in fields:
+            condition |= Q(**{f'{field}__{lookup}': value})
+        return queryset.filter(condition), False
+
+
+class LargeTableAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    """
+    Changelist settings for tables too large to count or scan per page
+    view: estimated counts (see EstimatedCountPaginator), no count of the
+    unfiltered table and no facet counts.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
 
 
 @admin.register(User)
@@ -11,20 +101,45 @@ class UserAdmin(admin.ModelAdmin):
 
 
 @admin.register(Ride)
-class RideAdmin(admin.ModelAdmin):
+class RideAdmin(LargeTableAdmin):
     list_display = ('id_ride', 'status', 'id_rider', 'id_driver', 'pickup_time')
-    list_filter = ('status', 'pickup_time')
+    list_select_related = ('id_rider', 'id_driver')
+    list_filter = ('status', ('pickup_time', DateRangeFilter))
     search_fields = ('id_rider__email', 'id_driver__email')
+    search_help_text = 'A ride id, or the start of the rider or driver email.'
     raw_id_fields = ('id_rider', 'id_driver')
-    date_hierarchy = 'pickup_time'
     ordering = ('-pickup_time',)
 
 
 @admin.register(RideEvent)
-class RideEventAdmin(admin.ModelAdmin):
+class RideEventAdmin(LargeTableAdmin):
     list_display = ('id_ride_event', 'id_ride', 'description', 'created_at')
-    list_filter = ('created_at',)
-    search_fields = ('description', 'id_ride__id_ride')
+    list_select_related = ('id_ride',)
+    list_filter = (('created_at', DateRangeFilter),)
+    search_fields = ('description',)
+    search_id_fields = ('pk', 'id_ride')
+    search_help_text = 'A ride event or ride id, or the start of the description.'
     raw_id_fields = ('id_ride',)
-    date_hierarchy = 'created_at'
     ordering = ('-created_at',)
+
+
+@admin.register(SlowQueryLog)
+class SlowQueryLogAdmin(admin.ModelAdmin):
+    """
+    Read-only view of the slow query log.
+    """
+    list_display = ('id_slow_query', 'created_at', 'duration_ms', 'route', 'query_string', 'has_plan')
+    list_filter = ('route', 'database')
+    search_fields = ('sql', 'path', 'query_string')
+    ordering = ('-id_slow_query',)
+    readonly_fields = [field.name for field in SlowQueryLog._meta.fields]
+
+    @admin.display(boolean=True, description='Plan')
+    def has_plan(self, obj):
+        return obj.plan is not None
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class RidesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rides'
+
+    def ready(self):
+        from django.conf import settings
+        from . import signals  # noqa: F401
+
+        if settings.MEMORY_TRACING_ENABLED:
+            from .memory import start_tracing
+            start_tracing()
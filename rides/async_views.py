@@ -0,0 +1,229 @@
+"""
+Async versions of the read-only ride endpoints.
+
+These are plain Django async views built on the async ORM, so under an
+ASGI server (see docker_startup.sh) a request waiting on the database
+doesn't hold a worker thread. They return the same JSON as the matching
+DRF endpoints:
+
+    /api/async/rides/            -> /api/rides/
+    /api/async/rides/<id>/       -> /api/rides/<id>/
+    /api/async/ride-events/      -> /api/ride-events/
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from functools import wraps
+import math
+from rest_framework import exceptions
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .filters import RideFilter
+from .pagination import EstimatedCountPaginator
+from .models import Ride, RideEvent
+from .permissions import IsAdminUser
+from .renderers import ORJSONRenderer, StreamingJSONRenderer, orjson
+from .replicas import reads_from_replica
+from .serializers import RideEventSerializer, RideListSerializer, RideSerializer
+from .sharding import events_queryset, prefetch_todays_events, sharding_enabled
+from .throttling import throttle_wait
+from .views import get_distance_origin, order_by_distance, ride_queryset
+
+
+renderer = ORJSONRenderer() if orjson is not None else StreamingJSONRenderer()
+
+
+def json_response(data, status=200):
+    return HttpResponse(renderer.render(data), status=status, content_type=renderer.media_type)
+
+
+def error_response(exc, status=None):
+    return json_response({'detail': exc.detail}, status=status or exc.status_code)
+
+
+def admin_required(view_func):
+    """
+    Apply the same authentication and IsAdminUser checks as the DRF views.
+    """
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return error_response(exceptions.MethodNotAllowed(request.method))
+
+        user = await request.auser()
+        if not user.is_authenticated:
+            # Session auth has no WWW-Authenticate challenge, so DRF sends 403
+            return error_response(exceptions.NotAuthenticated(), status=403)
+        if not await IsAdminUser().ahas_permission(request, None):
+            return error_response(exceptions.PermissionDenied())
+
+        return await view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def throttled(get_scope):
+    """
+    Apply the token bucket throttle of the DRF views, in the scope that
+    `get_scope(request)` returns (see rides/throttling.py).
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            wait = throttle_wait(request, await request.auser(), get_scope(request))
+            if wait is not None:
+                response = error_response(exceptions.Throttled(wait))
+                response['Retry-After'] = str(math.ceil(wait))
+                return response
+            return await view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def ride_list_scope(request):
+    return 'gps' if get_distance_origin(request.GET) is not None else 'api'
+
+
+def get_ordering(request, allowed, default):
+    ordering = request.GET.get(api_settings.ORDERING_PARAM)
+    if ordering and ordering.lstrip('-') in allowed:
+        return ordering
+    return default
+
+
+async def paginated_response(request, queryset, serializer_class, prefetch=None):
+    """
+    Page number pagination matching EstimatedCountPagination.
+
+    `queryset` may also be a ScatterGather over the ride event shards.
+    `prefetch`, if given, is called with the rows of the page.
+    """
+    page_size = api_settings.PAGE_SIZE
+    try:
+        requested_size = int(request.GET['page_size'])
+        if requested_size > 0:
+            page_size = min(requested_size, settings.API_MAX_PAGE_SIZE)
+    except (KeyError, ValueError):
+        pass
+
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        page_number = 0
+
+    # Estimated for large lists, as by EstimatedCountPagination
+    paginator = EstimatedCountPaginator(queryset, page_size)
+    count = await sync_to_async(lambda: paginator.count)()
+    num_pages = max(1, -(-count // page_size))
+    if page_number < 1 or (not paginator.approximate and page_number > num_pages):
+        return error_response(exceptions.NotFound('Invalid page.'))
+
+    offset = (page_number - 1) * page_size
+    # With an approximate count, one more row tells if there is a next page
+    limit = page_size + 1 if paginator.approximate else page_size
+    if isinstance(queryset, QuerySet):
+        rows = [
+            ride async for ride in
+            queryset[offset:offset + limit].aiterator(chunk_size=limit)
+        ]
+    else:
+        rows = await sync_to_async(queryset.__getitem__)(slice(offset, offset + limit))
+    if paginator.approximate:
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        if page_number > 1 and not rows:
+            return error_response(exceptions.NotFound('Invalid page.'))
+    else:
+        has_next = page_number < num_pages
+    if prefetch is not None:
+        await sync_to_async(prefetch)(rows)
+
+    url = request.build_absolute_uri()
+    next_link = previous_link = None
+    if has_next:
+        next_link = replace_query_param(url, 'page', page_number + 1)
+    if page_number > 1:
+        previous_link = (
+            remove_query_param(url, 'page') if page_number == 2
+            else replace_query_param(url, 'page', page_number - 1)
+        )
+
+    return json_response({
+        'count': count,
+        'count_approximate': paginator.approximate,
+        'next': next_link,
+        'previous': previous_link,
+        'results': serializer_class(rows, many=True, context={'request': request}).data,
+    })
+
+
+@reads_from_replica
+@admin_required
+@throttled(ride_list_scope)
+async def ride_list(request):
+    """
+    Async version of the ride list: filters, ordering and distance sorting.
+    """
+    queryset = ride_queryset()
+
+    filterset = RideFilter(request.GET, queryset=queryset)
+    if not filterset.is_valid():
+        return json_response(filterset.errors, status=400)
+    queryset = filterset.qs
+
+    origin = get_distance_origin(request.GET)
+    ordering = get_ordering(request, ['pickup_time'], None if origin else '-pickup_time')
+    if ordering:
+        queryset = queryset.order_by(ordering)
+    else:
+        queryset = order_by_distance(queryset, *origin)
+
+    prefetch = prefetch_todays_events if sharding_enabled() else None
+    return await paginated_response(request, queryset, RideListSerializer, prefetch)
+
+
+@reads_from_replica
+@admin_required
+@throttled(lambda request: 'api')
+async def ride_detail(request, pk):
+    """
+    Async version of the ride detail, with all of the ride's events.
+    """
+    queryset = ride_queryset().prefetch_related('ride_events')
+    try:
+        ride = await queryset.aget(pk=pk)
+    except Ride.DoesNotExist:
+        return error_response(exceptions.NotFound())
+    if sharding_enabled():
+        await sync_to_async(prefetch_todays_events)([ride])
+
+    return json_response(RideSerializer(ride, context={'request': request}).data)
+
+
+@reads_from_replica
+@admin_required
+@throttled(lambda request: 'api')
+async def ride_event_list(request):
+    """
+    Async version of the ride event list, filterable by ride and description.
+    """
+    queryset = RideEvent.objects.all()
+
+    id_ride = request.GET.get('id_ride') or None
+    if id_ride is not None:
+        # Not str.isdigit(): it accepts digits such as '²' that int() rejects
+        try:
+            id_ride = int(id_ride)
+        except ValueError:
+            return json_response({'id_ride': ['Enter a valid ride id.']}, status=400)
+        queryset = queryset.filter(id_ride=id_ride)
+
+    description = request.GET.get('description')
+    if description:
+        queryset = queryset.filter(description=description)
+
+    queryset = queryset.order_by(get_ordering(request, ['created_at'], '-created_at'))
+    queryset = events_queryset(queryset, id_ride)
+
+    return await paginated_response(request, queryset, RideEventSerializer)
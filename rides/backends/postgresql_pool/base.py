@@ -0,0 +1,321 @@
+"""
+PostgreSQL backend with a bounded connection pool per worker process.
+
+With persistent connections (CONN_MAX_AGE > 0) every thread of every
+worker keeps its own connection open, so idle backends multiply with
+threads and machines. This backend shares at most POOL['MAX_SIZE']
+connections between the threads of a process instead:
+
+    DATABASES['default'] = {
+        'ENGINE': 'rides.backends.postgresql_pool',
+        'CONN_MAX_AGE': 0,
+        'POOL': {'MAX_SIZE': 4, 'TIMEOUT': 10},
+        ...
+    }
+
+With CONN_MAX_AGE = 0 Django "closes" the connection when each request
+finishes, which returns it to the pool; the next query, in any thread,
+checks one out again. When all are in use, a checkout waits up to
+TIMEOUT seconds for one to be returned, then fails with OperationalError.
+
+Connections are rolled back if returned inside a transaction, checked with
+`SELECT 1` before reuse when idle longer than HEALTH_CHECK_INTERVAL, and
+closed once older than MAX_LIFETIME or idle longer than MAX_IDLE seconds.
+Session state set with a plain SET outlives the request; use SET LOCAL.
+"""
+from collections import deque
+from django.db.backends.postgresql import base, creation
+import os
+import psycopg2
+import threading
+import time
+
+from rides import metrics
+
+POOL_DEFAULTS = {
+    'MAX_SIZE': 4,
+    'TIMEOUT': 10,
+    'MAX_IDLE': 300,
+    'MAX_LIFETIME': 3600,
+    'HEALTH_CHECK_INTERVAL': 30,
+}
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+        # The thread it is checked out to
+        self.thread = None
+
+
+class ConnectionPool:
+    """
+    At most `max_size` connections to one database, shared by the threads
+    of a process.
+    """
+
+    def __init__(self, alias, max_size, timeout, max_idle, max_lifetime, health_check_interval):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # Most recently returned last, so the oldest go idle and get closed
+        self.idle = deque()
+        self.checked_out = {}
+        self.opened = 0
+        # Set by close_pools(): connections are closed when returned
+        self.closing = False
+        self.created = 0
+        self.waits = 0
+        self.timeouts = 0
+        metrics.db_pool_max_size.labels(alias).set(max_size)
+
+    def checkout(self, connect):
+        """
+        Return an idle connection, or one opened with `connect()` if the
+        pool isn't full, waiting for one to be returned otherwise.
+        """
+        if self.is_full():
+            self.reclaim_abandoned()
+        while True:
+            entry = self.reserve()
+            if entry is None:
+                try:
+                    entry = PooledConnection(connect())
+                except Exception:
+                    self.release_slot()
+                    raise
+                with self.condition:
+                    self.created += 1
+                break
+            reason = self.unusable_reason(entry)
+            if reason is None:
+                break
+            self.discard(entry, reason)
+
+        entry.thread = threading.current_thread()
+        with self.condition:
+            self.checked_out[id(entry.connection)] = entry
+            self.report()
+        return entry.connection
+
+    def is_full(self):
+        with self.condition:
+            return not self.idle and self.opened >= self.max_size
+
+    def reclaim_abandoned(self):
+        """
+        Take back the connections of threads that ended without closing
+        them, which Django only does at the end of a request.
+        """
+        with self.condition:
+            abandoned = [entry for entry in self.checked_out.values() if not entry.thread.is_alive()]
+        for entry in abandoned:
+            self.checkin(entry.connection)
+
+    def reserve(self):
+        """
+        Take an idle connection, or a free slot (None) to open one in.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self.condition:
+            waited = False
+            while not self.idle and self.opened >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    metrics.db_pool_timeouts.labels(self.alias).inc()
+                    raise PoolTimeout(
+                        f"No connection to '{self.alias}' became free within {self.timeout}s "
+                        f'({self.max_size} in use)'
+                    )
+                waited = True
+                self.condition.wait(remaining)
+            if waited:
+                self.waits += 1
+            metrics.db_pool_wait.labels(self.alias).observe(time.monotonic() - start)
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+            return None
+
+    def unusable_reason(self, entry):
+        """
+        Why `entry` can't be handed out, or None if it can.
+        """
+        now = time.monotonic()
+        if entry.connection.closed:
+            return 'broken'
+        if self.max_lifetime is not None and now - entry.created_at > self.max_lifetime:
+            return 'max_lifetime'
+        if self.health_check_interval is not None and now - entry.returned_at > self.health_check_interval:
+            try:
+                with entry.connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                if entry.connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    entry.connection.rollback()
+            except psycopg2.Error:
+                return 'health_check'
+        return None
+
+    def checkin(self, connection):
+        """
+        Put a connection back, rolling back any transaction left open.
+        """
+        with self.condition:
+            entry = self.checked_out.pop(id(connection), None)
+        if entry is None:
+            # Opened by the parent before this process forked: closing it
+            # would end the parent's session, so just let go of it
+            inherited_connections.append(connection)
+            return
+
+        if connection.closed:
+            self.discard(entry, 'broken')
+            return
+        if self.closing:
+            self.discard(entry, 'closed')
+            return
+        if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                self.discard(entry, 'broken')
+                return
+
+        now = time.monotonic()
+        entry.returned_at = now
+        expired = []
+        with self.condition:
+            self.idle.append(entry)
+            while self.max_idle is not None and now - self.idle[0].returned_at > self.max_idle:
+                expired.append(self.idle.popleft())
+            self.condition.notify()
+        for entry in expired:
+            self.discard(entry, 'max_idle')
+        self.report()
+
+    def discard(self, entry, reason):
+        """
+        Close a connection and free its slot.
+        """
+        try:
+            entry.connection.close()
+        except psycopg2.Error:
+            pass
+        metrics.db_pool_discarded.labels(self.alias, reason).inc()
+        self.release_slot()
+
+    def release_slot(self):
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+            self.report()
+
+    def close_idle(self):
+        """
+        Close every idle connection, e.g. before the process exits.
+        """
+        with self.condition:
+            entries, self.idle = list(self.idle), deque()
+        for entry in entries:
+            self.discard(entry, 'closed')
+
+    def report(self):
+        in_use = len(self.checked_out)
+        metrics.db_pool_connections.labels(self.alias, 'in_use').set(in_use)
+        metrics.db_pool_connections.labels(self.alias, 'idle').set(len(self.idle))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'max_size': self.max_size,
+                'open': self.opened,
+                'in_use': len(self.checked_out),
+                'idle': len(self.idle),
+                'created': self.created,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+            }
+
+
+pools = {}
+pools_lock = threading.Lock()
+# Pools and connections inherited from a parent process. They belong to
+# the parent: closing them here (even by garbage collection) would end the
+# parent's sessions.
+inherited_pools = []
+inherited_connections = []
+
+
+def pool_key(alias, settings_dict):
+    # The test runner points an alias at another database under the same name
+    return (alias, settings_dict['NAME'], settings_dict['HOST'], settings_dict['PORT'], settings_dict['USER'])
+
+
+def get_pool(alias, settings_dict):
+    """
+    The pool of `alias` in this process, created on first use.
+    """
+    key = pool_key(alias, settings_dict)
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is not None and pool.pid != os.getpid():
+            inherited_pools.append(pool)
+            pool = None
+        if pool is None:
+            options = {**POOL_DEFAULTS, **settings_dict.get('POOL', {})}
+            pool = pools[key] = ConnectionPool(
+                alias,
+                max_size=options['MAX_SIZE'],
+                timeout=options['TIMEOUT'],
+                max_idle=options['MAX_IDLE'],
+                max_lifetime=options['MAX_LIFETIME'],
+                health_check_interval=options['HEALTH_CHECK_INTERVAL'],
+            )
+        return pool
+
+
+def close_pools(database_name=None):
+    """
+    Close the idle connections of the pools (of one database name, if
+    given) and forget them. Connections still checked out are closed
+    when they are returned.
+    """
+    with pools_lock:
+        keys = [key for key in pools if database_name is None or key[1] == database_name]
+        closed = [pools.pop(key) for key in keys]
+    for pool in closed:
+        pool.closing = True
+        pool.close_idle()
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database in use
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        self.connection_pool = get_pool(self.alias, self.settings_dict)
+        return self.connection_pool.checkout(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.connection_pool.checkin(self.connection)
@@ -0,0 +1,226 @@
+"""
+Helpers for benchmarking the API against generated datasets.
+
+seed_dataset() fills the database with riders, drivers, rides and ride
+events generated by PostgreSQL itself (INSERT ... SELECT generate_series),
+which loads a million rides in well under a minute. The rows bypass model
+signals, so nothing is published or invalidated while seeding.
+
+measure() runs an endpoint through the whole Django stack with the test
+client, and records latency and query counts per request. The rate limits
+are off while it runs (a benchmark sends far more requests than a client
+may), and a run with any response that isn't a 2xx fails: error responses
+would otherwise be timed as if they were the endpoint.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+import math
+import random
+import statistics
+import time
+
+from .models import Ride, RideEvent, User
+from .throttling import buckets
+
+# San Francisco area, like generate_sample_data
+LATITUDE_RANGE = (37.7, 37.8)
+LONGITUDE_RANGE = (-122.5, -122.4)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def clear_dataset():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'TRUNCATE {RideEvent._meta.db_table}, {Ride._meta.db_table}, '
+            f'"{User._meta.db_table}" RESTART IDENTITY CASCADE'
+        )
+
+
+def seed_dataset(rides, events_per_ride=5, riders=None, drivers=None, seed=0):
+    """
+    Replace all users, rides and events with a generated dataset.
+
+    Rides are spread over the last 30 days, each with `events_per_ride`
+    events in the hour after pickup; the events of the last day are the
+    ones the ride list embeds. Returns the number of rows per table.
+    """
+    riders = riders or max(rides // 50, 1)
+    drivers = drivers or max(rides // 100, 1)
+    min_lat, max_lat = LATITUDE_RANGE
+    min_lon, max_lon = LONGITUDE_RANGE
+    user_table = User._meta.db_table
+    ride_table = Ride._meta.db_table
+    event_table = RideEvent._meta.db_table
+
+    clear_dataset()
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT setseed(%s)', [seed / 2 ** 31])
+        cursor.execute(
+            f'''
+            INSERT INTO "{user_table}" (role, first_name, last_name, email, phone_number)
+            SELECT role, initcap(role) || n, 'User' || n, role || n || '@example.com',
+                   '+1555' || lpad(n::text, 7, '0')
+            FROM (SELECT 'rider' AS role, n FROM generate_series(1, %(riders)s) AS n
+                  UNION ALL
+                  SELECT 'driver', n FROM generate_series(1, %(drivers)s) AS n) AS users
+            ''',
+            {'riders': riders, 'drivers': drivers},
+        )
+        # Riders have ids 1..riders, drivers riders+1..riders+drivers
+        cursor.execute(
+            f'''
+            INSERT INTO {ride_table} (status, id_rider, id_driver, pickup_latitude,
+                pickup_longitude, dropoff_latitude, dropoff_longitude, pickup_time, updated_at)
+            SELECT (ARRAY['en-route', 'pickup', 'dropoff'])[1 + floor(random() * 3)::int],
+                   1 + floor(random() * %(riders)s)::int,
+                   %(riders)s + 1 + floor(random() * %(drivers)s)::int,
+                   %(min_lat)s + random() * %(lat_span)s,
+                   %(min_lon)s + random() * %(lon_span)s,
+                   %(min_lat)s + random() * %(lat_span)s,
+                   %(min_lon)s + random() * %(lon_span)s,
+                   now() - random() * interval '30 days',
+                   now()
+            FROM generate_series(1, %(rides)s)
+            ''',
+            {
+                'rides': rides, 'riders': riders, 'drivers': drivers,
+                'min_lat': min_lat, 'lat_span': max_lat - min_lat,
+                'min_lon': min_lon, 'lon_span': max_lon - min_lon,
+            },
+        )
+        cursor.execute(
+            f'''
+            INSERT INTO {event_table} (id_ride, description, created_at, updated_at)
+            SELECT id_ride,
+                   (ARRAY['Status changed to pickup', 'Status changed to dropoff',
+                          'Driver assigned', 'Driver arrived'])[1 + (n - 1) %% 4],
+                   pickup_time + n * random() * interval '15 minutes',
+                   now()
+            FROM {ride_table}, generate_series(1, %(events)s) AS n
+            ''',
+            {'events': events_per_ride},
+        )
+        cursor.execute(f'ANALYZE "{user_table}", {ride_table}, {event_table}')
+
+    return {
+        'users': riders + drivers,
+        'rides': rides,
+        'ride_events': rides * events_per_ride,
+    }
+
+
+def percentile(values, percent):
+    """
+    The `percent` percentile of `values`, interpolating between ranks.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * percent / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(durations, query_counts, status_codes):
+    """
+    Latency percentiles in milliseconds, and query counts, of a run.
+    """
+    milliseconds = [duration * 1000 for duration in durations]
+    return {
+        'iterations': len(durations),
+        'p50_ms': round(percentile(milliseconds, 50), 3),
+        'p95_ms': round(percentile(milliseconds, 95), 3),
+        'p99_ms': round(percentile(milliseconds, 99), 3),
+        'mean_ms': round(statistics.fmean(milliseconds), 3),
+        'max_ms': round(max(milliseconds), 3),
+        'queries': max(query_counts),
+        'status_codes': sorted(set(status_codes)),
+    }
+
+
+def admin_client():
+    """
+    A test client authenticated as a Django superuser.
+    """
+    from django.contrib.auth.models import User as DjangoUser
+    user, created = DjangoUser.objects.get_or_create(
+        username='bench-admin', defaults={'is_staff': True, 'is_superuser': True}
+    )
+    client = APIClient()
+    client.force_authenticate(user=user)
+    return client
+
+
+@contextmanager
+def unthrottled():
+    """
+    Turn every throttle scope off (see rides/throttling.py).
+    """
+    rates = {scope: None for scope in settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']}
+    with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+        buckets.reset()
+        try:
+            yield
+        finally:
+            buckets.reset()
+
+
+def measure(client, make_request, iterations, warmup=3):
+    """
+    Run `make_request(client)` repeatedly, with the rate limits off, and
+    summarize it.
+
+    Streamed responses are read to the end, so the time covers the
+    whole body. Raises BenchmarkError if a response isn't a 2xx.
+    """
+    durations, query_counts, status_codes = [], [], []
+    with unthrottled():
+        for iteration in range(warmup + iterations):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = make_request(client)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                duration = time.perf_counter() - start
+            if not 200 <= response.status_code < 300:
+                detail = '' if response.streaming else f': {response.content[:200]!r}'
+                raise BenchmarkError(
+                    f'{response.request["PATH_INFO"]} answered {response.status_code}{detail}'
+                )
+            if iteration >= warmup:
+                durations.append(duration)
+                query_counts.append(len(queries))
+                status_codes.append(response.status_code)
+    return summarize(durations, query_counts, status_codes)
+
+
+def endpoint_requests(counts, rng=None):
+    """
+    The benchmarked requests, as {name: make_request(client)}.
+
+    Detail and event requests pick a random ride each time.
+    """
+    rng = rng or random.Random(0)
+    rides = counts['rides']
+    latitude = sum(LATITUDE_RANGE) / 2
+    longitude = sum(LONGITUDE_RANGE) / 2
+
+    return {
+        'list': lambda client: client.get('/api/rides/'),
+        'distance_list': lambda client: client.get(
+            '/api/rides/', {'latitude': latitude, 'longitude': longitude}
+        ),
+        'filtered_list': lambda client: client.get(
+            '/api/rides/', {'status': 'pickup', 'rider_email': 'rider1@example.com'}
+        ),
+        'detail': lambda client: client.get(f'/api/rides/{rng.randint(1, rides)}/'),
+        'ride_events': lambda client: client.get(
+            '/api/ride-events/', {'id_ride': rng.randint(1, rides)}
+        ),
+    }
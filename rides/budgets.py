@@ -0,0 +1,158 @@
+"""
+Performance budgets for API tests.
+
+A budget caps what one request may cost: SQL statements, rows fetched
+from the database and bytes in the response. Test methods declare the
+budget of the route they exercise with @performance_budget and return the
+response:
+
+    @performance_budget('ride-list', max_queries=3, max_rows=40, max_bytes=12000)
+    def test_ride_list(self):
+        return self.client.get(reverse('ride-list'))
+
+Everything the test method does is measured, so build fixtures in
+setUpTestData() or setUp(). When a request goes over budget the test fails
+with every statement it ran, identical statements grouped, so an N+1
+shows up as one line run many times.
+
+Each decorated route is added to BUDGETS, which lets a test check that
+every route has a budget.
+"""
+from contextlib import ExitStack, contextmanager
+from django.db import connections
+from functools import wraps
+import re
+
+# Route name -> Budget, filled in by @performance_budget
+BUDGETS = {}
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# Statements only there because TestCase wraps each test in a transaction
+TEST_TRANSACTION_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class Budget:
+    """
+    The most a single request to `route` may cost. None means no limit.
+    """
+
+    def __init__(self, route, max_queries, max_rows=None, max_bytes=None):
+        self.route = route
+        self.max_queries = max_queries
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+    def violations(self, measurement):
+        """
+        Describe each limit the measurement exceeds.
+        """
+        checks = [
+            ('queries', self.max_queries, len(measurement.queries)),
+            ('rows fetched', self.max_rows, measurement.rows),
+            ('response bytes', self.max_bytes, measurement.bytes),
+        ]
+        return [
+            f'{name}: {actual} (budget {limit})'
+            for name, limit, actual in checks
+            if limit is not None and actual > limit
+        ]
+
+
+class Measurement:
+    """
+    The statements a request ran, rows they returned and response size.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.bytes = 0
+
+    @property
+    def rows(self):
+        return sum(rows for sql, rows in self.queries)
+
+    def record_query(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if sql.startswith(TEST_TRANSACTION_STATEMENTS):
+            return result
+        rows = 0
+        if sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            rows = max(context['cursor'].rowcount, 0)
+        self.queries.append((sql, rows))
+        return result
+
+    def record_response(self, response):
+        """
+        Count the response body, reading streamed responses to the end.
+        """
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+            response.streaming_content = [content]
+        else:
+            content = response.content
+        self.bytes = len(content)
+
+    def report(self):
+        """
+        Every statement run, identical statements (literals aside) grouped
+        with the number of times they ran, most repeated first.
+        """
+        groups = {}
+        for sql, rows in self.queries:
+            shape = LITERALS.sub('?', sql)
+            count, total_rows = groups.get(shape, (0, 0))
+            groups[shape] = (count + 1, total_rows + rows)
+
+        lines = []
+        for shape, (count, rows) in sorted(groups.items(), key=lambda item: -item[1][0]):
+            marker = '  <-- repeated' if count > 1 else ''
+            lines.append(f'  {count:>3} x  {rows:>6} rows  {shape}{marker}')
+        return '\n'.join(lines)
+
+
+@contextmanager
+def measure():
+    """
+    Record the statements run on every database inside the block.
+
+    Server-side cursors are turned off while measuring, as their row
+    counts aren't known when the statement runs.
+    """
+    measurement = Measurement()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            previous = connection.settings_dict.get('DISABLE_SERVER_SIDE_CURSORS', False)
+            connection.settings_dict['DISABLE_SERVER_SIDE_CURSORS'] = True
+            stack.callback(connection.settings_dict.__setitem__, 'DISABLE_SERVER_SIDE_CURSORS', previous)
+            stack.enter_context(connection.execute_wrapper(measurement.record_query))
+        yield measurement
+
+
+def check(testcase, budget, measurement):
+    violations = budget.violations(measurement)
+    if violations:
+        testcase.fail(
+            f'{budget.route} is over its performance budget:\n'
+            + '\n'.join(f'  {violation}' for violation in violations)
+            + f'\n\nQueries ({len(measurement.queries)}):\n{measurement.report()}'
+        )
+
+
+def performance_budget(route, max_queries, max_rows=None, max_bytes=None):
+    """
+    Fail the decorated test if the request it returns goes over budget.
+    """
+    budget = Budget(route, max_queries, max_rows, max_bytes)
+    BUDGETS[route] = budget
+
+    def decorator(test_method):
+        @wraps(test_method)
+        def wrapper(self, *args, **kwargs):
+            with measure() as measurement:
+                response = test_method(self, *args, **kwargs)
+                measurement.record_response(response)
+            self.assertLess(response.status_code, 400, f'{route} returned {response.status_code}')
+            check(self, budget, measurement)
+        return wrapper
+    return decorator
@@ -0,0 +1,113 @@
+"""
+Change feed over rides and ride events.
+
+Every ride and ride event has an `updated_at` timestamp, set on each save.
+Consumers keep a cursor holding, for each table, the (updated_at, pk) of
+the last row they have seen, and ask for the rows that come after it. Rows
+are read in (updated_at, pk) order, which the change feed indexes cover.
+
+Only creates and updates are reported; deletions don't leave a row behind.
+Rows changed through `QuerySet.update()` don't get a new `updated_at`
+either, unless the update sets it.
+
+`updated_at` is the time of the save on the clock of the machine that
+saved, not the time of the commit. Holding back the last
+CHANGE_FEED_SETTLE_SECONDS is therefore a heuristic, not a guarantee: a
+row saved by a transaction that takes longer than that to commit, or by a
+machine whose clock runs behind by more, can land behind a cursor that
+has already gone past it and be skipped.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import binascii
+import json
+
+from .models import Ride, RideEvent
+from .replicas import reading_from_replica
+from .sharding import events_queryset
+
+
+# Tables in the feed, keyed by the name used in cursors and responses
+FEED_MODELS = {
+    'rides': Ride,
+    'ride_events': RideEvent,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(positions):
+    """
+    Encode {table: (updated_at, pk)} positions into an opaque cursor.
+    """
+    data = {
+        table: [updated_at.isoformat(), pk]
+        for table, (updated_at, pk) in positions.items()
+    }
+    return urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor(), raising InvalidCursor.
+    """
+    try:
+        data = json.loads(urlsafe_b64decode(cursor.encode()))
+        positions = {}
+        for table, (updated_at, pk) in data.items():
+            updated_at = parse_datetime(updated_at)
+            if table not in FEED_MODELS or updated_at is None or not isinstance(pk, int):
+                raise InvalidCursor(cursor)
+            positions[table] = (updated_at, pk)
+        return positions
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError, AttributeError):
+        raise InvalidCursor(cursor)
+
+
+def get_changes(positions, limit):
+    """
+    Fetch up to `limit` changed rows per table after the given positions.
+
+    Returns ({table: [instances]}, new positions, has_more). Rows changed
+    in the last CHANGE_FEED_SETTLE_SECONDS are held back until the next
+    call, so that a transaction that saved earlier but commits later is
+    not skipped over by the cursor. Read from a replica, rows are held
+    back REPLICA_LAG_SECONDS longer, for the replica to catch up.
+    """
+    settle_seconds = settings.CHANGE_FEED_SETTLE_SECONDS
+    if reading_from_replica():
+        settle_seconds += settings.REPLICA_LAG_SECONDS
+    upper_bound = timezone.now() - timedelta(seconds=settle_seconds)
+    changes = {}
+    new_positions = dict(positions)
+    has_more = False
+
+    for table, model in FEED_MODELS.items():
+        pk_name = model._meta.pk.name
+        queryset = model.objects.filter(updated_at__lte=upper_bound)
+        if table in positions:
+            updated_at, pk = positions[table]
+            queryset = queryset.filter(
+                Q(updated_at__gt=updated_at) |
+                Q(updated_at=updated_at, **{f'{pk_name}__gt': pk})
+            )
+
+        queryset = queryset.order_by('updated_at', pk_name)
+        if model is RideEvent:
+            # From every shard, when ride events are sharded
+            queryset = events_queryset(queryset)
+        rows = list(queryset[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            has_more = True
+        if rows:
+            new_positions[table] = (rows[-1].updated_at, rows[-1].pk)
+        changes[table] = rows
+
+    return changes, new_positions, has_more
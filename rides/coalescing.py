@@ -0,0 +1,144 @@
+"""
+Single-flight: run identical expensive computations once.
+
+When several requests ask for the same thing at the same time, the first
+one computes the result and the others wait for it and share it, instead
+of all running the same queries.
+
+Within a worker process this uses a threading.Event per key. Across
+workers and machines it is optional: with SINGLE_FLIGHT_CACHE_ALIAS set to
+a cache every worker shares (e.g. a DatabaseCache), the computing request
+holds a PostgreSQL advisory lock on the key and stores its result in that
+cache for SINGLE_FLIGHT_CACHE_SECONDS, and other workers wait for the lock
+and read the stored result.
+
+The lock is a transaction lock, taken in a transaction on the primary, as
+API requests run in one (see rides/timeouts.py) and a DatabaseCache
+writes its entry in it: the lock is released when the entry becomes
+visible, at commit, not before. If the request rolls back, both go.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+import hashlib
+import logging
+import threading
+import time
+
+from .replicas import PRIMARY_ALIAS
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class Flight:
+    """
+    One in-progress computation, and its result once done.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Shares the result of concurrent calls with the same key.
+    """
+    # How often a worker waiting for another worker's lock checks again
+    lock_poll_interval = 0.05
+
+    def __init__(self, namespace, using=PRIMARY_ALIAS):
+        self.namespace = namespace
+        self.using = using
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, compute):
+        """
+        Return `compute()`, or the result of an identical call in progress.
+
+        Exceptions raised by `compute()` are raised in every waiting call.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            if not flight.done.wait(settings.SINGLE_FLIGHT_WAIT_SECONDS):
+                logger.warning('Gave up waiting for %s %s', self.namespace, key)
+                return compute()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.do_shared(key, compute)
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def do_shared(self, key, compute):
+        """
+        Coordinate with other workers, if a shared cache is configured.
+        """
+        alias = settings.SINGLE_FLIGHT_CACHE_ALIAS
+        if not alias:
+            return compute()
+
+        cache = caches[alias]
+        digest = hashlib.blake2b(f'{self.namespace}:{key}'.encode(), digest_size=8).digest()
+        cache_key = f'single-flight:{self.namespace}:{digest.hex()}'
+        # Signed, as pg_advisory_lock takes a bigint
+        lock_id = int.from_bytes(digest, 'big', signed=True)
+        deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT_SECONDS
+
+        while True:
+            result = cache.get(cache_key, MISSING)
+            if result is not MISSING:
+                return result
+            with transaction.atomic(using=self.using):
+                if self.try_lock(lock_id):
+                    # Another worker may have stored the result just before we locked
+                    result = cache.get(cache_key, MISSING)
+                    if result is MISSING:
+                        result = compute()
+                        cache.set(cache_key, result, settings.SINGLE_FLIGHT_CACHE_SECONDS)
+                    return result
+            if time.monotonic() >= deadline:
+                logger.warning('Gave up waiting for the lock on %s %s', self.namespace, key)
+                return compute()
+            time.sleep(self.lock_poll_interval)
+
+    def try_lock(self, lock_id):
+        """
+        Lock `lock_id` until the end of the current transaction, if no one
+        else holds it.
+        """
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [lock_id])
+            return cursor.fetchone()[0]
+
+
+def request_key(request):
+    """
+    Key for a GET request: host, path and query params in a fixed order.
+
+    The host is included because paginated responses hold absolute links.
+    """
+    params = sorted(
+        (name, value)
+        for name, values in request.query_params.lists()
+        for value in values
+    )
+    query = '&'.join(f'{name}={value}' for name, value in params)
+    return f'{request.get_host()}{request.path}?{query}'
@@ -0,0 +1,206 @@
+"""
+Server-Sent Events stream of newly created ride events.
+
+Creating a RideEvent sends a NOTIFY on the `ride_events` channel (see
+signals.py). Each worker process LISTENs once, through the shared
+notifications listener, and fans every notification out to the streams
+open in that process whose filters match. Open streams just wait on a
+queue, so watching costs no queries.
+
+Each open stream holds a worker thread, so a process serves at most
+RIDE_EVENT_STREAM_MAX_CONNECTIONS of them at once, for at most
+RIDE_EVENT_STREAM_MAX_SECONDS each; further streams get a 503.
+"""
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import APIException
+import json
+import logging
+import queue
+import threading
+import time
+
+from .notifications import listener, notify
+from .replicas import PRIMARY_ALIAS
+from .serializers import RideEventSerializer
+from .sharding import shard_aliases
+
+logger = logging.getLogger(__name__)
+
+RIDE_EVENTS_CHANNEL = 'ride_events'
+
+
+class StreamsFull(APIException):
+    status_code = 503
+    default_detail = 'Too many open event streams, try again shortly.'
+    default_code = 'streams_full'
+    # Sent as Retry-After
+    wait = 5
+
+
+def publish_ride_event(event, using='default'):
+    """
+    Notify stream watchers about a new ride event once it is committed.
+    """
+    payload = json.dumps({
+        'status': event.id_ride.status,
+        'event': RideEventSerializer(event).data,
+    })
+    if using in shard_aliases():
+        # Watchers listen on the primary: tell them once the shard commits
+        transaction.on_commit(
+            lambda: notify(RIDE_EVENTS_CHANNEL, payload, using=PRIMARY_ALIAS), using=using
+        )
+        return
+    notify(RIDE_EVENTS_CHANNEL, payload, using=using)
+
+
+def format_sse(data, event=None, event_id=None):
+    """
+    Format one Server-Sent Events message.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in data.splitlines() or [''])
+    return '\n'.join(lines) + '\n\n'
+
+
+def format_ride_event(message):
+    return format_sse(
+        json.dumps(message['event']),
+        event='ride_event',
+        event_id=message['event']['id_ride_event'],
+    )
+
+
+class Subscription:
+    """
+    One open stream, and the filters it was opened with.
+    """
+    # Messages waiting to be sent. A stream whose client can't keep up
+    # drops new messages rather than growing without bound.
+    max_queued = 1000
+
+    def __init__(self, id_ride=None, status=None):
+        self.id_ride = id_ride
+        self.status = status
+        self.queue = queue.Queue(self.max_queued)
+
+    def matches(self, message):
+        if self.id_ride is not None and message['event']['id_ride'] != self.id_ride:
+            return False
+        if self.status is not None and message['status'] != self.status:
+            return False
+        return True
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            logger.warning('Ride event stream is full, dropping event %s',
+                           message['event']['id_ride_event'])
+
+
+class RideEventHub:
+    """
+    Fans ride event notifications out to the subscriptions in this process.
+    """
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.listening = False
+
+    def subscribe(self, id_ride=None, status=None):
+        """
+        Open a subscription, raising StreamsFull when this process already
+        has RIDE_EVENT_STREAM_MAX_CONNECTIONS of them.
+        """
+        subscription = Subscription(id_ride=id_ride, status=status)
+        with self.lock:
+            if len(self.subscriptions) >= settings.RIDE_EVENT_STREAM_MAX_CONNECTIONS:
+                raise StreamsFull()
+            if not self.listening:
+                listener.subscribe(RIDE_EVENTS_CHANNEL, self.dispatch)
+                self.listening = True
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def reset(self):
+        """
+        Forget all subscriptions, e.g. after the listener was stopped.
+        """
+        with self.lock:
+            self.subscriptions = set()
+            self.listening = False
+
+    def dispatch(self, payload):
+        message = json.loads(payload)
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            if subscription.matches(message):
+                subscription.put(message)
+
+
+hub = RideEventHub()
+
+
+def stream_ride_events(subscription, backlog=(), duration=None, keepalive=None):
+    """
+    Yield SSE messages for a subscription until `duration` seconds pass.
+
+    Streams are closed after a while so they don't hold a worker thread
+    forever; EventSource clients reconnect on their own, sending the last
+    event id they saw so the backlog can be replayed.
+    """
+    duration = duration or settings.RIDE_EVENT_STREAM_MAX_SECONDS
+    keepalive = keepalive or settings.RIDE_EVENT_STREAM_KEEPALIVE_SECONDS
+    deadline = time.monotonic() + duration
+
+    try:
+        # Ask clients to reconnect after 1s
+        yield 'retry: 1000\n\n'
+        for message in backlog:
+            yield format_ride_event(message)
+
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                message = subscription.queue.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield format_ride_event(message)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+class RideEventStream:
+    """
+    The messages of stream_ride_events(), for a StreamingHttpResponse.
+
+    Closing the response unsubscribes even when streaming never started
+    (a generator's `finally` only runs once it has), so the subscription
+    can't keep its place among RIDE_EVENT_STREAM_MAX_CONNECTIONS.
+    """
+
+    def __init__(self, subscription, backlog=(), duration=None):
+        self.subscription = subscription
+        self.messages = stream_ride_events(subscription, backlog, duration=duration)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.messages)
+
+    def close(self):
+        self.messages.close()
+        hub.unsubscribe(self.subscription)
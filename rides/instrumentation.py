@@ -0,0 +1,140 @@
+"""
+Per-request timing breakdown.
+
+MetricsMiddleware creates a RequestTimings for each request and makes it
+the current one for the duration of the request. The phases are:
+
+    db           time spent executing SQL (all databases)
+    permissions  authentication and permission checks of DRF views using
+                 InstrumentedViewMixin, SQL included
+    view         time in the view, from process_view() to the response
+    serialize    view time not spent in SQL or permission checks; for API
+                 views that is mostly the serializers
+    render       time rendering the response (DRF renderers)
+"""
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+import time
+
+current_timings = ContextVar('current_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Timings and SQL statistics collected while handling one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.view_started = None
+        self.view_finished = None
+        self.render_started = None
+        self.render_finished = None
+        self.db_time = 0.0
+        self.db_queries = 0
+        # SQL run during the view, as opposed to middleware or rendering
+        self.view_db_time = 0.0
+        self.permissions_time = 0.0
+        self.permissions_db_time = 0.0
+        self.checking_permissions = False
+        # Bytes allocated above the starting point at the peak, when tracing
+        self.peak_memory = None
+        # (alias, sql, params, many, seconds) of statements slower than
+        # SLOW_QUERY_THRESHOLD_MS, for the slow query log
+        self.slow_queries = []
+        self.slow_query_threshold = (
+            settings.SLOW_QUERY_THRESHOLD_MS / 1000 if settings.SLOW_QUERY_LOG_ENABLED else None
+        )
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper that counts and times statements.
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.db_time += duration
+            self.db_queries += 1
+            if self.view_started is not None and self.view_finished is None:
+                self.view_db_time += duration
+            if self.checking_permissions:
+                self.permissions_db_time += duration
+            if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+                self.slow_queries.append(
+                    (context['connection'].alias, sql, params, many, duration)
+                )
+
+    @contextmanager
+    def recording_queries(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self.record_query))
+            yield
+
+    @contextmanager
+    def timing_permissions(self):
+        start = time.perf_counter()
+        self.checking_permissions = True
+        try:
+            yield
+        finally:
+            self.checking_permissions = False
+            self.permissions_time += time.perf_counter() - start
+
+    def mark(self, phase):
+        setattr(self, phase, time.perf_counter())
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        if self.view_started is not None and self.view_finished is None:
+            # No render step (not a TemplateResponse)
+            self.view_finished = self.finished
+
+    @property
+    def total(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def view_time(self):
+        if self.view_started is None or self.view_finished is None:
+            return None
+        return self.view_finished - self.view_started
+
+    @property
+    def serialize_time(self):
+        if self.view_time is None:
+            return None
+        other = self.view_db_time + self.permissions_time - self.permissions_db_time
+        return max(self.view_time - other, 0.0)
+
+    @property
+    def render_time(self):
+        if self.render_started is None or self.render_finished is None:
+            return None
+        return self.render_finished - self.render_started
+
+    def server_timing(self):
+        """
+        Server-Timing header value, durations in milliseconds.
+        """
+        metrics = [
+            ('db', self.db_time, f'{self.db_queries} queries'),
+            ('permissions', self.permissions_time, None),
+            ('serialize', self.serialize_time, None),
+            ('render', self.render_time, None),
+            ('total', self.total, None),
+        ]
+        entries = []
+        for name, duration, description in metrics:
+            if duration is None:
+                continue
+            entry = f'{name};dur={duration * 1000:.1f}'
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        return ', '.join(entries)
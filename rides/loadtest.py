@@ -0,0 +1,205 @@
+"""
+An asyncio load generator for soak testing a running server.
+
+LoadTest logs in through the auth endpoints like the frontend does
+(CSRF cookie first, then a session), then sends a weighted mix of ride
+requests at a fixed rate. Requests are started on schedule whether or not
+earlier ones have finished, up to a concurrency limit, and latency is
+measured from when each request was due: a server that falls behind shows
+up in the percentiles instead of silently lowering the request rate.
+
+Requires httpx (requirements/development.txt).
+"""
+import asyncio
+import random
+import time
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .benchmarks import LATITUDE_RANGE, LONGITUDE_RANGE, percentile
+
+REQUEST_KINDS = ['list', 'filtered', 'gps', 'detail', 'ingest']
+
+DEFAULT_MIX = 'list=40,filtered=20,gps=15,detail=20,ingest=5'
+
+RIDE_STATUSES = ['en-route', 'pickup', 'dropoff']
+
+
+class LoadTestError(Exception):
+    pass
+
+
+def parse_mix(mix):
+    """
+    Parse 'list=40,detail=20,...' into {kind: weight}.
+    """
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.strip().partition('=')
+        if kind not in REQUEST_KINDS:
+            raise LoadTestError(
+                f"Unknown request kind '{kind}', expected one of: {', '.join(REQUEST_KINDS)}"
+            )
+        try:
+            weights[kind] = float(weight)
+        except ValueError:
+            raise LoadTestError(f"Invalid weight for '{kind}': '{weight}'")
+        if weights[kind] < 0:
+            raise LoadTestError(f"Weight for '{kind}' must not be negative")
+    if not any(weights.values()):
+        raise LoadTestError('At least one request kind needs a positive weight')
+    return weights
+
+
+def summarize(results, elapsed):
+    """
+    Throughput, error rate and latency percentiles (in milliseconds) of
+    `results`, a list of (latency in seconds, status code or None on a
+    connection error).
+    """
+    latencies = [latency * 1000 for latency, status_code in results]
+    errors = sum(1 for latency, status_code in results if status_code is None or status_code >= 400)
+    status_codes = {}
+    for latency, status_code in results:
+        key = str(status_code) if status_code is not None else 'connection_error'
+        status_codes[key] = status_codes.get(key, 0) + 1
+
+    summary = {
+        'requests': len(results),
+        'throughput_rps': round(len(results) / elapsed, 2) if elapsed else 0.0,
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'status_codes': dict(sorted(status_codes.items())),
+    }
+    for percent in (50, 95, 99):
+        value = percentile(latencies, percent)
+        summary[f'p{percent}_ms'] = round(value, 3) if value is not None else None
+    summary['max_ms'] = round(max(latencies), 3) if latencies else None
+    return summary
+
+
+class LoadTest:
+    """
+    Send `rps` requests per second for `duration` seconds to `base_url`,
+    as the given user, picking each request from `mix` ({kind: weight}).
+    """
+
+    def __init__(self, base_url, username, password, rps, duration, mix,
+                 concurrency=100, timeout=30, seed=None):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.rps = rps
+        self.duration = duration
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.ride_ids = []
+        self.rider_emails = []
+        self.results = {kind: [] for kind in self.kinds}
+
+    async def login(self, client):
+        """
+        Get a CSRF cookie, then log in to get a session cookie.
+        """
+        response = await client.get('/api/auth/csrf/')
+        response.raise_for_status()
+        response = await client.post(
+            '/api/auth/login/',
+            json={'username': self.username, 'password': self.password},
+            headers={'X-CSRFToken': client.cookies.get('csrftoken', '')},
+        )
+        if response.status_code != 200:
+            raise LoadTestError(f'Login as {self.username} failed with status {response.status_code}')
+
+    async def discover(self, client):
+        """
+        Collect ride ids and rider emails to build detail, filtered and
+        ingest requests from.
+        """
+        response = await client.get('/api/rides/', params={'page_size': 500})
+        response.raise_for_status()
+        rides = response.json()['results']
+        if not rides:
+            raise LoadTestError('The server has no rides. Run generate_sample_data first.')
+        self.ride_ids = [ride['id_ride'] for ride in rides]
+        self.rider_emails = sorted({ride['rider']['email'] for ride in rides if ride.get('rider')})
+
+    def build_request(self, kind):
+        """
+        The (method, path, keyword arguments) of a request of `kind`.
+        """
+        if kind == 'list':
+            return 'GET', '/api/rides/', {'params': {'page': self.rng.randint(1, 10)}}
+        if kind == 'filtered':
+            params = {'status': self.rng.choice(RIDE_STATUSES)}
+            if self.rider_emails:
+                params['rider_email'] = self.rng.choice(self.rider_emails)
+            return 'GET', '/api/rides/', {'params': params}
+        if kind == 'gps':
+            return 'GET', '/api/rides/', {'params': {
+                'latitude': self.rng.uniform(*LATITUDE_RANGE),
+                'longitude': self.rng.uniform(*LONGITUDE_RANGE),
+            }}
+        if kind == 'detail':
+            return 'GET', f'/api/rides/{self.rng.choice(self.ride_ids)}/', {}
+        if kind == 'ingest':
+            return 'POST', '/api/ride-events/', {'json': {
+                'id_ride': self.rng.choice(self.ride_ids),
+                'description': 'Load test event',
+            }}
+        raise LoadTestError(f"Unknown request kind '{kind}'")
+
+    async def send(self, client, semaphore, kind, due):
+        method, path, kwargs = self.build_request(kind)
+        if method != 'GET':
+            kwargs['headers'] = {'X-CSRFToken': client.cookies.get('csrftoken', '')}
+        async with semaphore:
+            try:
+                response = await client.request(method, path, **kwargs)
+                status_code = response.status_code
+            except httpx.HTTPError:
+                status_code = None
+        self.results[kind].append((time.perf_counter() - due, status_code))
+
+    async def run(self):
+        """
+        Log in, run the load and return the report.
+        """
+        limits = httpx.Limits(max_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=self.timeout) as client:
+            await self.login(client)
+            await self.discover(client)
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            total = int(self.rps * self.duration)
+            interval = 1 / self.rps
+            tasks = []
+            start = time.perf_counter()
+            for index in range(total):
+                due = start + index * interval
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                kind = self.rng.choices(self.kinds, self.weights)[0]
+                tasks.append(asyncio.create_task(self.send(client, semaphore, kind, due)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - start
+
+        all_results = [result for results in self.results.values() for result in results]
+        return {
+            'target_rps': self.rps,
+            'duration_seconds': round(elapsed, 3),
+            'concurrency': self.concurrency,
+            'total': summarize(all_results, elapsed),
+            'kinds': {
+                kind: summarize(results, elapsed)
+                for kind, results in self.results.items()
+                if results
+            },
+        }
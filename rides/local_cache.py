@@ -0,0 +1,140 @@
+"""
+In-process cache kept coherent across workers and machines.
+
+Each worker caches lookups in its own memory (the LOCAL_CACHE_ALIAS cache,
+a LocMemCache). Only user roles are cached (see permissions.py): when a
+User changes, the signal handlers in signals.py call invalidate() with the
+cache keys derived from it. The keys are deleted
+locally and sent with NOTIFY on the `cache_invalidation` channel, and every
+worker that has used the cache LISTENs there and deletes them too.
+
+NOTIFY is transactional, so other workers evict once the change is
+committed. If a worker's LISTEN connection drops it may have missed some
+messages, so it clears its whole cache on reconnect. Entries also expire
+after LOCAL_CACHE_TIMEOUT seconds as a backstop.
+
+A value read from the database just before an invalidation, and stored
+just after it, would stay stale until it expires. Every eviction bumps a
+generation counter, and get_or_fill() doesn't store what it read if the
+generation changed meanwhile.
+
+Changes that don't send model signals (QuerySet.update(), bulk_create(),
+raw SQL) are not invalidated.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+import json
+import logging
+import threading
+
+from .notifications import listener, notify
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache_invalidation'
+
+# Distinguishes a cached None from a miss
+MISSING = object()
+
+
+def get_cache():
+    return caches[settings.LOCAL_CACHE_ALIAS]
+
+
+def user_role_key(email):
+    """
+    Cache key for the role of the rides User with this email.
+    """
+    return f'user-role:{email}'
+
+
+class InvalidationBus:
+    """
+    Listens for invalidations from other processes and applies them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listening = False
+        # Bumped by every eviction; guarded by generation_lock
+        self.generation = 0
+        self.generation_lock = threading.Lock()
+
+    def ensure_listening(self):
+        """
+        Start listening before the first cache fill, so that no
+        invalidation committed after the value was read is missed.
+        """
+        if self.listening:
+            return
+        with self.lock:
+            if not self.listening:
+                listener.subscribe(INVALIDATION_CHANNEL, self.handle)
+                listener.on_reconnect(self.clear)
+                self.listening = True
+
+    def reset(self):
+        """
+        Forget the subscription, e.g. after the listener was stopped.
+        """
+        with self.lock:
+            self.listening = False
+
+    def evict(self, keys=None):
+        """
+        Delete `keys` (or everything, with None) from this process's cache,
+        and keep fills already in progress from storing what they read.
+        """
+        with self.generation_lock:
+            self.generation += 1
+            if keys is None:
+                get_cache().clear()
+            else:
+                get_cache().delete_many(keys)
+
+    def store(self, key, value, timeout, generation):
+        """
+        Cache `value` unless something was evicted since `generation`.
+        """
+        with self.generation_lock:
+            if self.generation == generation:
+                get_cache().set(key, value, timeout)
+
+    def handle(self, payload):
+        self.evict(json.loads(payload))
+
+    def clear(self):
+        logger.warning('Clearing the local cache after missing invalidations')
+        self.evict()
+
+
+bus = InvalidationBus()
+
+
+def get_or_fill(key, fill, timeout=None):
+    """
+    Return the cached value for `key`, calling `fill()` on a miss.
+    """
+    bus.ensure_listening()
+    generation = bus.generation
+    value = get_cache().get(key, MISSING)
+    if value is MISSING:
+        value = fill()
+        bus.store(key, value, settings.LOCAL_CACHE_TIMEOUT if timeout is None else timeout, generation)
+    return value
+
+
+def invalidate(keys, using='default'):
+    """
+    Evict `keys` from this process now, and from every process once the
+    current transaction commits.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    bus.evict(keys)
+    # Evict again on commit, in case a request in this process re-read the
+    # old row before the transaction committed
+    transaction.on_commit(lambda: bus.evict(keys), using=using)
+    notify(INVALIDATION_CHANNEL, json.dumps(keys, separators=(',', ':')), using=using)
@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+import django
+import json
+import platform
+import subprocess
+import time
+
+from rides.benchmarks import BenchmarkError, admin_client, endpoint_requests, measure, seed_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the ride endpoints on generated datasets of several sizes, '
+        'in a throwaway test database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            default='10000,100000,1000000',
+            help='Comma separated numbers of rides to benchmark with'
+        )
+        parser.add_argument(
+            '--events-per-ride',
+            type=int,
+            default=5,
+            help='Number of events generated for each ride'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=50,
+            help='Measured requests per endpoint and scale'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=5,
+            help='Unmeasured requests per endpoint and scale, run first'
+        )
+        parser.add_argument(
+            '--endpoints',
+            help='Comma separated endpoints to run (default: all)'
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of stdout'
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Keep the benchmark database between runs'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('--scales must be a comma separated list of numbers')
+        endpoints = options['endpoints'].split(',') if options['endpoints'] else None
+
+        # Never touch the configured database: work in a test database
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment(debug=False)
+        connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'], serialize=False)
+        try:
+            results = [
+                self.run_scale(scale, options, endpoints) for scale in scales
+            ]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'git_commit': self.git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'page_size': settings.REST_FRAMEWORK.get('PAGE_SIZE'),
+            'iterations': options['iterations'],
+            'scales': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def run_scale(self, scale, options, endpoints):
+        self.stderr.write(self.style.SUCCESS(f'Seeding {scale} rides...'))
+        start = time.perf_counter()
+        counts = seed_dataset(scale, events_per_ride=options['events_per_ride'])
+        seed_seconds = time.perf_counter() - start
+
+        client = admin_client()
+        requests = endpoint_requests(counts)
+        unknown = set(endpoints or []) - set(requests)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+        results = {}
+        for name, make_request in requests.items():
+            if endpoints and name not in endpoints:
+                continue
+            try:
+                results[name] = summary = measure(
+                    client, make_request, options['iterations'], options['warmup']
+                )
+            except BenchmarkError as e:
+                raise CommandError(f'{name} at {scale} rides: {e}')
+            self.stderr.write(
+                f"{scale:>9} rides  {name:<14} p50 {summary['p50_ms']:9.2f} ms  "
+                f"p95 {summary['p95_ms']:9.2f} ms  p99 {summary['p99_ms']:9.2f} ms  "
+                f"{summary['queries']} queries"
+            )
+
+        return {
+            'rides': counts['rides'],
+            'ride_events': counts['ride_events'],
+            'users': counts['users'],
+            'seed_seconds': round(seed_seconds, 3),
+            'endpoints': results,
+        }
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,196 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+import gc
+import json
+import os
+import psycopg2
+import threading
+import time
+
+from rides.backends.postgresql_pool.base import close_pools, get_pool
+from rides.benchmarks import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare persistent connections with the per-worker connection pool, '
+        'running simulated requests in bursts of fresh threads'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=8,
+            help='Threads per burst, like the threads of a gunicorn worker'
+        )
+        parser.add_argument(
+            '--bursts',
+            type=int,
+            default=5,
+            help='Number of bursts; each starts new threads'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=50,
+            help='Requests per thread and burst'
+        )
+        parser.add_argument(
+            '--query-ms',
+            type=float,
+            default=2,
+            help='Time each request spends in the database (pg_sleep)'
+        )
+        parser.add_argument(
+            '--pool-size',
+            type=int,
+            default=4,
+            help='Connections in the pool'
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of stdout'
+        )
+
+    def handle(self, *args, **options):
+        if min(options['threads'], options['bursts'], options['requests'], options['pool_size']) < 1:
+            raise CommandError('--threads, --bursts, --requests and --pool-size must be positive')
+
+        modes = {
+            'persistent': {'ENGINE': 'django.db.backends.postgresql', 'CONN_MAX_AGE': 600},
+            'pooled': {
+                'ENGINE': 'rides.backends.postgresql_pool',
+                'CONN_MAX_AGE': 0,
+                'POOL': {'MAX_SIZE': options['pool_size'], 'TIMEOUT': 30},
+            },
+        }
+        results = {mode: self.run_mode(mode, overrides, options) for mode, overrides in modes.items()}
+
+        output = json.dumps({
+            'threads': options['threads'],
+            'bursts': options['bursts'],
+            'requests_per_thread': options['requests'],
+            'query_ms': options['query_ms'],
+            'pool_size': options['pool_size'],
+            'modes': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def run_mode(self, mode, overrides, options):
+        alias = f'bench_{mode}'
+        application_name = f'bench-{mode}-{os.getpid()}'
+        settings_dict = dict(connections['default'].settings_dict)
+        settings_dict.update(overrides)
+        settings_dict['OPTIONS'] = {**settings_dict['OPTIONS'], 'application_name': application_name}
+        connections.settings[alias] = settings_dict
+
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            if connection.alias == alias:
+                opened.append(1)
+
+        # Pooled checkouts also send connection_created: the pool counts those
+        connection_created.connect(count_connection, weak=False)
+        sampler = BackendSampler(connections['default'].get_connection_params(), application_name)
+        sampler.start()
+        latencies = []
+        try:
+            start = time.perf_counter()
+            for burst in range(options['bursts']):
+                threads = [
+                    threading.Thread(target=self.run_requests, args=(alias, options, latencies))
+                    for _ in range(options['threads'])
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            elapsed = time.perf_counter() - start
+            stats = get_pool(alias, settings_dict).stats() if mode == 'pooled' else None
+        finally:
+            sampler.stop()
+            connection_created.disconnect(count_connection)
+            close_pools(settings_dict['NAME'])
+            # Close the persistent connections left behind by the threads
+            gc.collect()
+            del connections.settings[alias]
+
+        milliseconds = [latency * 1000 for latency in latencies]
+        summary = {
+            'requests': len(latencies),
+            'seconds': round(elapsed, 3),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(milliseconds, 50), 3),
+            'p95_ms': round(percentile(milliseconds, 95), 3),
+            'p99_ms': round(percentile(milliseconds, 99), 3),
+            'connections_opened': stats['created'] if stats is not None else len(opened),
+            'peak_backends': sampler.peak,
+        }
+        if stats is not None:
+            summary['pool_waits'] = stats['waits']
+            summary['pool_timeouts'] = stats['timeouts']
+        self.stderr.write(
+            f"{mode:<11} {summary['throughput_rps']:>8.1f} req/s  p50 {summary['p50_ms']:7.2f} ms  "
+            f"p99 {summary['p99_ms']:7.2f} ms  {summary['connections_opened']:>4} connections opened  "
+            f"{summary['peak_backends']:>3} backends at peak"
+        )
+        return summary
+
+    def run_requests(self, alias, options, latencies):
+        """
+        Simulate requests in a fresh thread, with the signals Django sends
+        around each request (which close or return connections).
+
+        Like threads of recycled workers, the thread ends without closing
+        its connection: a persistent one stays open until garbage
+        collected, a pooled one is taken back by the pool.
+        """
+        for _ in range(options['requests']):
+            start = time.perf_counter()
+            request_started.send(sender=self.__class__)
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(%s)', [options['query_ms'] / 1000])
+            request_finished.send(sender=self.__class__)
+            latencies.append(time.perf_counter() - start)
+
+
+class BackendSampler(threading.Thread):
+    """
+    Samples how many server backends an application name has open.
+    """
+
+    def __init__(self, conn_params, application_name, interval=0.01):
+        super().__init__(daemon=True)
+        self.conn_params = conn_params
+        self.application_name = application_name
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.peak = 0
+
+    def run(self):
+        connection = psycopg2.connect(**self.conn_params)
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                while not self.stopping.is_set():
+                    cursor.execute(
+                        'SELECT count(*) FROM pg_stat_activity WHERE application_name = %s',
+                        [self.application_name],
+                    )
+                    self.peak = max(self.peak, cursor.fetchone()[0])
+                    self.stopping.wait(self.interval)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
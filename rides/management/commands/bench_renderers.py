@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+import time
+
+from rides.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+from rides.views import RideViewSet
+
+
+class Command(BaseCommand):
+    help = 'Compare JSON, orjson and MessagePack rendering of a ride list page'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=100,
+            help='Number of rides in the rendered page'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='Number of times each renderer renders the page'
+        )
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        iterations = options['iterations']
+
+        data = self.get_ride_list_page(page_size)
+        if not data['results']:
+            raise CommandError('No rides found. Run generate_sample_data first.')
+
+        renderers = [('json', JSONRenderer())]
+        if orjson is not None:
+            renderers.append(('orjson', ORJSONRenderer()))
+        if msgpack is not None:
+            renderers.append(('msgpack', MessagePackRenderer()))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendering a page of {len(data['results'])} rides {iterations} times"
+        ))
+
+        baseline = None
+        for name, renderer in renderers:
+            content = renderer.render(data)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                renderer.render(data)
+            per_render = (time.perf_counter() - start) / iterations * 1000
+
+            if baseline is None:
+                baseline, json_content = per_render, content
+            line = (
+                f'{name:<8} {per_render:8.3f} ms/render  {len(content):>8} bytes  '
+                f'{baseline / per_render:5.2f}x'
+            )
+            self.stdout.write(line)
+
+            if name == 'orjson' and content != json_content:
+                self.stdout.write(self.style.ERROR('orjson output differs from JSONRenderer output'))
+
+    def get_ride_list_page(self, page_size):
+        """
+        Build the payload the ride list endpoint returns for one page.
+        """
+        request = Request(APIRequestFactory().get('/api/rides/', {'page_size': page_size}))
+        view = RideViewSet(request=request, action='list', format_kwarg=None, kwargs={})
+        queryset = view.filter_queryset(view.get_queryset())[:page_size]
+        serializer = view.get_serializer(queryset, many=True)
+        return {
+            'count': len(serializer.data),
+            'next': None,
+            'previous': None,
+            'results': serializer.data,
+        }
@@ -0,0 +1,121 @@
+from django.core.management.base import BaseCommand, CommandError
+import asyncio
+import json
+
+from rides.loadtest import DEFAULT_MIX, LoadTest, LoadTestError, httpx, parse_mix
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive a running server with a mix of ride requests at a target rate, '
+        'and report throughput, latency percentiles and error rates'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default='http://localhost:8000',
+            help='Base URL of the server to load'
+        )
+        parser.add_argument(
+            '--username',
+            required=True,
+            help='User to log in as. Event ingest requests need an admin'
+        )
+        parser.add_argument(
+            '--password',
+            required=True,
+            help='Password of the user'
+        )
+        parser.add_argument(
+            '--rps',
+            type=float,
+            default=20,
+            help='Target requests per second'
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=30,
+            help='Seconds to run for'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=100,
+            help='Most requests in flight at once'
+        )
+        parser.add_argument(
+            '--mix',
+            default=DEFAULT_MIX,
+            help=f'Relative weights of the request kinds (default: {DEFAULT_MIX})'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=30,
+            help='Seconds before a request counts as a connection error'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            help='Random seed, to replay the same sequence of requests'
+        )
+        parser.add_argument(
+            '--output',
+            help='Also write the JSON report to this file'
+        )
+
+    def handle(self, *args, **options):
+        if httpx is None:
+            raise CommandError(
+                'loadtest needs httpx: pip install -r requirements/development.txt'
+            )
+        if options['rps'] <= 0 or options['duration'] <= 0 or options['concurrency'] < 1:
+            raise CommandError('--rps, --duration and --concurrency must be positive')
+        if options['rps'] * options['duration'] < 1:
+            raise CommandError('--rps times --duration must be at least one request')
+        try:
+            mix = parse_mix(options['mix'])
+        except LoadTestError as e:
+            raise CommandError(str(e))
+
+        self.stderr.write(self.style.SUCCESS(
+            f"Sending {options['rps']:g} requests/s for {options['duration']:g}s to {options['url']}"
+        ))
+        load_test = LoadTest(
+            options['url'], options['username'], options['password'],
+            rps=options['rps'], duration=options['duration'], mix=mix,
+            concurrency=options['concurrency'], timeout=options['timeout'], seed=options['seed'],
+        )
+        try:
+            report = asyncio.run(load_test.run())
+        except (LoadTestError, httpx.HTTPError) as e:
+            raise CommandError(str(e))
+
+        rows = [('total', report['total'])] + list(report['kinds'].items())
+        self.stdout.write(
+            f"{'kind':<10} {'requests':>8} {'req/s':>8} {'errors':>7} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+        )
+        for kind, summary in rows:
+            self.stdout.write(
+                f"{kind:<10} {summary['requests']:>8} {summary['throughput_rps']:>8.1f} "
+                f"{summary['error_rate']:>7.1%} {summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} "
+                f"{summary['p99_ms']:>9.1f} {summary['max_ms']:>9.1f}"
+            )
+        throttled = report['total']['status_codes'].get('429', 0)
+        if throttled:
+            self.stderr.write(self.style.WARNING(
+                f'{throttled} requests were throttled (429) and count as errors in the '
+                "percentiles: raise the server's API_THROTTLE_RATE* settings for the run"
+            ))
+        if report['total']['throughput_rps'] < options['rps'] * 0.95:
+            self.stderr.write(self.style.WARNING(
+                'Throughput stayed below the target rate: the server (or --concurrency) is the limit'
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(json.dumps(report, indent=2) + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Report written to {options['output']}"))
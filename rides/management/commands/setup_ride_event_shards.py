@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rides.sharding import setup_sequences, shard_aliases, sharding_enabled
+
+
+class Command(BaseCommand):
+    help = (
+        'Offset the ride event id sequence of each shard in RIDE_EVENT_SHARDS, '
+        'so ids are unique across shards and tell which shard holds an event'
+    )
+
+    def handle(self, *args, **options):
+        if not sharding_enabled():
+            raise CommandError('RIDE_EVENT_SHARDS is empty: ride events are not sharded')
+
+        count = len(shard_aliases())
+        for alias, next_id in setup_sequences().items():
+            self.stdout.write(f'{alias}: next id {next_id}, increment {count}')
+        self.stdout.write(self.style.SUCCESS(f'Sequences of {count} shards set up'))
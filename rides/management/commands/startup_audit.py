@@ -0,0 +1,78 @@
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import json
+
+from rides.warmup import COLD_START_TARGET_SECONDS, measure_startup
+
+
+class Command(BaseCommand):
+    help = (
+        'Start the application in a fresh interpreter with python -X importtime, '
+        'and report the time spent in each startup phase, package and module'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=20,
+            help='Number of packages and modules to list'
+        )
+        parser.add_argument(
+            '--connect',
+            action='store_true',
+            help='Also time connecting to the databases'
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of stdout'
+        )
+
+    def handle(self, *args, **options):
+        if options['top'] < 1:
+            raise CommandError('--top must be positive')
+        try:
+            # Timed without -X importtime, which slows imports down
+            startup = measure_startup(settings.SETTINGS_MODULE, connect=options['connect'])
+            imports = measure_startup(settings.SETTINGS_MODULE, import_times=True)['imports']
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        packages = defaultdict(float)
+        for module in imports:
+            packages[module['module'].split('.')[0]] += module['self_ms']
+        top = options['top']
+        results = {
+            'total_seconds': round(startup['total'], 3),
+            'target_seconds': COLD_START_TARGET_SECONDS,
+            'phases': startup['phases'],
+            'import_ms': round(sum(packages.values()), 1),
+            'packages': [
+                {'package': package, 'self_ms': round(ms, 1)}
+                for package, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]
+            ],
+            # Slowest modules on their own, not counting what they import
+            'modules': sorted(imports, key=lambda module: -module['self_ms'])[:top],
+        }
+
+        phases = ', '.join(
+            f'{phase} {seconds * 1000:.0f} ms'
+            for phase, seconds in startup['phases'].items() if not isinstance(seconds, dict)
+        )
+        self.stderr.write(f"Cold start in {startup['total'] * 1000:.0f} ms: {phases}")
+        self.stderr.write(f"Imports: {results['import_ms']:.0f} ms in {len(imports)} modules")
+        for package in results['packages'][:10]:
+            self.stderr.write(f"  {package['self_ms']:8.1f} ms  {package['package']}")
+        if startup['total'] > COLD_START_TARGET_SECONDS:
+            self.stderr.write(self.style.WARNING(
+                f'Above the cold start target of {COLD_START_TARGET_SECONDS}s'
+            ))
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
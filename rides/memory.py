@@ -0,0 +1,142 @@
+"""
+Memory instrumentation with tracemalloc.
+
+With MEMORY_TRACING_ENABLED (or after an admin starts tracing through
+/api/memory/), Python allocations are traced. Then:
+
+- MetricsMiddleware records, per route, how far allocations peaked above
+  what was in use when the request started. Workers run several threads,
+  so when requests overlap the peak is shared between them: read it as an
+  upper bound for a single request.
+- /api/memory/ takes heap snapshots and diffs them, to find what keeps
+  growing between two points in time.
+
+Tracing costs CPU and memory, so it is off by default. Everything here is
+per worker process.
+"""
+from django.conf import settings
+import threading
+import tracemalloc
+
+# Frames that only show the tracing machinery itself
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def start_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(settings.MEMORY_TRACING_FRAMES)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+
+
+class PeakTracker:
+    """
+    Tracks the allocation peak of requests, resetting tracemalloc's peak
+    only when no other request is in flight.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def request_started(self):
+        """
+        Return the memory in use now, or None when not tracing.
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        with self.lock:
+            self.in_flight += 1
+            if self.in_flight == 1:
+                tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, baseline):
+        """
+        Return how far allocations peaked above `baseline`, in bytes.
+        """
+        if baseline is None:
+            return None
+        with self.lock:
+            self.in_flight -= 1
+        peak = tracemalloc.get_traced_memory()[1]
+        return max(peak - baseline, 0)
+
+
+peak_tracker = PeakTracker()
+
+
+class SnapshotStore:
+    """
+    The baseline heap snapshot later snapshots are compared with.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.baseline = None
+        self.taken_at = None
+
+    def take_baseline(self, taken_at):
+        snapshot = take_snapshot()
+        with self.lock:
+            self.baseline = snapshot
+            self.taken_at = taken_at
+        return snapshot
+
+    def clear(self):
+        with self.lock:
+            self.baseline = None
+            self.taken_at = None
+
+
+snapshots = SnapshotStore()
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+def top_allocations(snapshot, limit, key_type='lineno'):
+    """
+    The `limit` places holding the most memory in a snapshot.
+    """
+    return [
+        {
+            'location': str(stat.traceback),
+            'size_bytes': stat.size,
+            'count': stat.count,
+        }
+        for stat in snapshot.statistics(key_type)[:limit]
+    ]
+
+
+def allocation_diff(snapshot, baseline, limit, key_type='lineno'):
+    """
+    The `limit` places whose memory grew (or shrank) most since `baseline`.
+    """
+    return [
+        {
+            'location': str(stat.traceback),
+            'size_bytes': stat.size,
+            'size_diff_bytes': stat.size_diff,
+            'count': stat.count,
+            'count_diff': stat.count_diff,
+        }
+        for stat in snapshot.compare_to(baseline, key_type)[:limit]
+    ]
+
+
+def traced_memory():
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'tracing': tracemalloc.is_tracing(),
+        'current_bytes': current,
+        'peak_bytes': peak,
+    }
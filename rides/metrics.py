@@ -0,0 +1,166 @@
+"""
+Prometheus metrics for the API, labelled by route name.
+
+Under gunicorn each worker is a separate process. When the
+PROMETHEUS_MULTIPROC_DIR environment variable is set (docker_startup.sh
+does), prometheus_client keeps every worker's metrics in memory-mapped
+files in that directory and /api/metrics adds them up, so a scrape sees
+the whole machine whichever worker answers it. Without it, metrics are
+those of the answering process only.
+"""
+from django.conf import settings
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+MEMORY_BUCKETS = (65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+WAIT_BUCKETS = (.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+requests_total = Counter(
+    'api_requests_total',
+    'Requests handled, by route, method and status code.',
+    ['route', 'method', 'status'],
+)
+request_duration = Histogram(
+    'api_request_duration_seconds',
+    'Time to produce the response, by route and method.',
+    ['route', 'method'],
+    buckets=LATENCY_BUCKETS,
+)
+db_queries = Histogram(
+    'api_request_db_queries',
+    'SQL statements executed per request, by route.',
+    ['route'],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+db_duration = Histogram(
+    'api_request_db_seconds',
+    'Time spent executing SQL per request, by route.',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+permissions_duration = Histogram(
+    'api_request_permissions_seconds',
+    'Time in authentication and permission checks, by route.',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+serialize_duration = Histogram(
+    'api_request_serialize_seconds',
+    'Time in the view outside SQL and permission checks (mostly serialization), by route.',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+render_duration = Histogram(
+    'api_request_render_seconds',
+    'Time rendering the response body, by route.',
+    ['route'],
+    buckets=LATENCY_BUCKETS,
+)
+response_size = Histogram(
+    'api_response_size_bytes',
+    'Response body size, by route. Streamed responses are not counted.',
+    ['route'],
+    buckets=SIZE_BUCKETS,
+)
+peak_memory = Histogram(
+    'api_request_peak_memory_bytes',
+    'Peak Python allocations during a request above the memory in use when '
+    'it started, by route. Only recorded while tracemalloc is tracing.',
+    ['route'],
+    buckets=MEMORY_BUCKETS,
+)
+
+# Connection pools (rides/backends/postgresql_pool). Saturation is
+# db_pool_connections{state="in_use"} / db_pool_max_connections.
+db_pool_connections = Gauge(
+    'db_pool_connections',
+    'Pooled database connections, by database and state (in_use, idle).',
+    ['database', 'state'],
+    multiprocess_mode='livesum',
+)
+db_pool_max_size = Gauge(
+    'db_pool_max_connections',
+    'Most connections the pools may open, by database.',
+    ['database'],
+    multiprocess_mode='livesum',
+)
+db_pool_wait = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting to check out a pooled connection, by database.',
+    ['database'],
+    buckets=WAIT_BUCKETS,
+)
+db_pool_timeouts = Counter(
+    'db_pool_timeouts_total',
+    'Checkouts that gave up waiting for a free connection, by database.',
+    ['database'],
+)
+db_pool_discarded = Counter(
+    'db_pool_discarded_connections_total',
+    'Pooled connections closed, by database and reason '
+    '(broken, health_check, max_lifetime, max_idle, closed).',
+    ['database', 'reason'],
+)
+
+throttled_requests = Counter(
+    'api_throttled_requests_total',
+    'Requests refused by the token bucket throttle, by throttle scope.',
+    ['scope'],
+)
+statement_timeouts = Counter(
+    'api_statement_timeouts_total',
+    'Queries canceled by the statement timeout of a request, by the part of '
+    'the response they were for (request when the whole request failed).',
+    ['part'],
+)
+
+
+def route_name(request):
+    """
+    The resolved URL name of a request (e.g. `ride-list`), or None.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.url_name:
+        return None
+    return match.view_name
+
+
+def observe(request, response, timings):
+    """
+    Record one handled request.
+    """
+    route = route_name(request)
+    if route is None:
+        return
+
+    requests_total.labels(route, request.method, str(response.status_code)).inc()
+    request_duration.labels(route, request.method).observe(timings.total)
+    db_queries.labels(route).observe(timings.db_queries)
+    db_duration.labels(route).observe(timings.db_time)
+    if timings.permissions_time:
+        permissions_duration.labels(route).observe(timings.permissions_time)
+    if timings.serialize_time is not None:
+        serialize_duration.labels(route).observe(timings.serialize_time)
+    if timings.render_time is not None:
+        render_duration.labels(route).observe(timings.render_time)
+    if timings.peak_memory is not None:
+        peak_memory.labels(route).observe(timings.peak_memory)
+    if not response.streaming:
+        response_size.labels(route).observe(len(response.content))
+
+
+def render_metrics():
+    """
+    Return (body, content type) for a scrape, covering every worker.
+    """
+    if settings.METRICS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=settings.METRICS_DIR)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
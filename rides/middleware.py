@@ -0,0 +1,314 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .instrumentation import RequestTimings, current_timings
+from .memory import peak_tracker
+from .metrics import observe
+from .permissions import is_admin_user
+from .profiling import SORT_KEYS, aprofile_request, profile_report, profile_request, profiling_lock, raw_profile
+from .replicas import RoutingState, current_routing, replica_configured, view_handler_name, view_replica_actions
+from .slow_queries import record_slow_queries
+
+
+class HybridMiddleware:
+    """
+    Base for middleware that runs in both modes: sync under WSGI, async
+    under ASGI.
+
+    Django's ASGI handler runs the whole middleware chain in a thread as
+    soon as one middleware is sync only, and the async views in
+    rides/async_views.py would then be run back through async_to_sync.
+    Subclasses implement handle() for WSGI and __acall__() for ASGI; Django
+    tells which one applies when it builds the chain, by passing a sync or
+    an async get_response.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def __acall__(self, request):
+        raise NotImplementedError
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+    Time each request and record it in the Prometheus metrics, and in the
+    slow query log if some of its SQL was slow.
+
+    Keep this first in MIDDLEWARE so the timings cover the whole request.
+    See rides/instrumentation.py for what each phase measures.
+    """
+
+    def handle(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        memory_baseline = peak_tracker.request_started()
+        try:
+            with timings.recording_queries():
+                response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+            timings.peak_memory = peak_tracker.request_finished(memory_baseline)
+
+        timings.finish()
+        observe(request, response, timings)
+        record_slow_queries(request, timings)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        memory_baseline = peak_tracker.request_started()
+        # The SQL runs in the request's sync_to_async thread, whose
+        # connections aren't the event loop's: record it there
+        recording = timings.recording_queries()
+        await sync_to_async(recording.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(recording.__exit__)(None, None, None)
+            current_timings.reset(token)
+            timings.peak_memory = peak_tracker.request_finished(memory_baseline)
+
+        timings.finish()
+        observe(request, response, timings)
+        if timings.slow_queries:
+            await sync_to_async(record_slow_queries)(request, timings)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = current_timings.get()
+        if timings is not None:
+            timings.mark('view_started')
+
+    def process_template_response(self, request, response):
+        timings = current_timings.get()
+        if timings is not None:
+            timings.mark('view_finished')
+            timings.mark('render_started')
+            response.add_post_render_callback(lambda response: timings.mark('render_finished'))
+        return response
+
+
+class ServerTimingMiddleware(HybridMiddleware):
+    """
+    Add a Server-Timing header splitting the response time into db,
+    permissions, serialize and render.
+
+    Off by default. With SERVER_TIMING_ENABLED every response gets it;
+    otherwise admins can ask for it per request with `?server_timing=1`
+    or an `X-Server-Timing: 1` header. Browsers show it in the network
+    panel of the developer tools.
+
+    Relies on the timings collected by MetricsMiddleware, so it must come
+    after it in MIDDLEWARE.
+    """
+
+    def handle(self, request):
+        response = self.get_response(request)
+        timings = current_timings.get()
+        if timings is not None and self.is_enabled(request):
+            response['Server-Timing'] = timings.server_timing()
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        timings = current_timings.get()
+        if timings is not None and (
+            settings.SERVER_TIMING_ENABLED or
+            # The admin check may query the database
+            self.is_requested(request) and await sync_to_async(self.is_enabled)(request)
+        ):
+            response['Server-Timing'] = timings.server_timing()
+        return response
+
+    def is_requested(self, request):
+        return (
+            request.GET.get('server_timing') == '1' or
+            request.headers.get('X-Server-Timing') == '1'
+        )
+
+    def is_enabled(self, request):
+        if settings.SERVER_TIMING_ENABLED:
+            return True
+        # request.user is set by DRF's authentication by now, for API views
+        return self.is_requested(request) and is_admin_user(getattr(request, 'user', None))
+
+
+class ReplicaMiddleware(HybridMiddleware):
+    """
+    Let GET requests to replica-enabled views read from the replica, and
+    keep clients that just wrote on the primary (see rides/replicas.py).
+
+    Place it before SessionMiddleware, so that saving a session counts as
+    a write.
+    """
+
+    def handle(self, request):
+        if not replica_configured():
+            return self.get_response(request)
+
+        state = RoutingState()
+        token = current_routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.pin_to_primary(state, response)
+
+    async def __acall__(self, request):
+        if not replica_configured():
+            return await self.get_response(request)
+
+        state = RoutingState()
+        token = current_routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.pin_to_primary(state, response)
+
+    def pin_to_primary(self, state, response):
+        if state.wrote:
+            response.set_cookie(
+                settings.REPLICA_PIN_COOKIE, '1',
+                max_age=settings.REPLICA_LAG_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = current_routing.get()
+        if state is None or request.method not in ('GET', 'HEAD'):
+            return
+        if settings.REPLICA_PIN_COOKIE in request.COOKIES:
+            return
+        state.use_replica = view_handler_name(request, view_func) in view_replica_actions(view_func)
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+    Run a request under cProfile when an admin asks for it, and return the
+    profile instead of the response (see rides/profiling.py).
+
+    `?profile=1` or `X-Profile: 1` returns a JSON report; `?profile_sort=`
+    ranks functions by `cumulative` (default), `tottime` or `calls`.
+    `?profile=pstats` returns the raw profile.
+
+    The admin check uses the session user, so it must come after
+    AuthenticationMiddleware.
+    """
+
+    def handle(self, request):
+        mode = self.profile_mode(request)
+        if mode is None or not is_admin_user(request.user):
+            return self.get_response(request)
+        sort, refusal = self.start_profiling(request)
+        if refusal is not None:
+            return refusal
+        try:
+            profiled = profile_request(self.get_response, request)
+        finally:
+            profiling_lock.release()
+        return self.profile_response(request, mode, sort, *profiled)
+
+    async def __acall__(self, request):
+        mode = self.profile_mode(request)
+        # The admin check may query the database
+        if mode is None or not await sync_to_async(is_admin_user)(request.user):
+            return await self.get_response(request)
+        sort, refusal = self.start_profiling(request)
+        if refusal is not None:
+            return refusal
+        try:
+            profiled = await aprofile_request(self.get_response, request)
+        finally:
+            profiling_lock.release()
+        return self.profile_response(request, mode, sort, *profiled)
+
+    def profile_mode(self, request):
+        mode = request.GET.get('profile') or request.headers.get('X-Profile')
+        if not settings.PROFILING_ENABLED or mode not in ('1', 'pstats'):
+            return None
+        return mode
+
+    def start_profiling(self, request):
+        """
+        Returns (sort key, None) holding the profiling lock, or (None, the
+        response refusing to profile).
+        """
+        sort = request.GET.get('profile_sort', 'cumulative')
+        if sort not in SORT_KEYS:
+            return None, JsonResponse(
+                {'profile_sort': [f'"{sort}" is not a valid choice.']}, status=400
+            )
+        if not profiling_lock.acquire(blocking=False):
+            return None, JsonResponse(
+                {'detail': 'Another request is being profiled, try again shortly.'}, status=409
+            )
+        return sort, None
+
+    def profile_response(self, request, mode, sort, response, profiler, query_log, wall_time):
+        if mode == 'pstats':
+            profile = HttpResponse(raw_profile(profiler), content_type='application/octet-stream')
+            profile['Content-Disposition'] = 'attachment; filename="request.prof"'
+            return profile
+
+        return JsonResponse(profile_report(
+            request, response, profiler, query_log, wall_time,
+            sort=sort, limit=settings.PROFILING_TOP_FUNCTIONS,
+        ))
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise's middleware (used in production), made async capable so
+    that it doesn't put the ASGI middleware chain in a thread either (see
+    HybridMiddleware).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            # Looks for the file on disk
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.14 on 2026-10-19 06:49
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The change feed indexes are built without locking out writes to the
+    # ride and ride_event tables
+    atomic = False
+
+    dependencies = [
+        ('rides', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='rideevent',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        AddIndexConcurrently(
+            model_name='ride',
+            index=models.Index(fields=['updated_at', 'id_ride'], name='ride_updated_b7dfaf_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rideevent',
+            index=models.Index(fields=['updated_at', 'id_ride_event'], name='ride_event_updated_3de26e_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.14 on 2026-10-19 06:59
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0002_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQueryLog',
+            fields=[
+                ('id_slow_query', models.AutoField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('duration_ms', models.FloatField()),
+                ('route', models.CharField(blank=True, max_length=200)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=500)),
+                ('query_string', models.TextField(blank=True)),
+                ('database', models.CharField(max_length=50)),
+                ('sql', models.TextField()),
+                ('params', models.TextField(blank=True)),
+                ('plan', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'slow_query_log',
+                'ordering': ['-id_slow_query'],
+            },
+        ),
+    ]
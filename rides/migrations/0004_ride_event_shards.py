@@ -0,0 +1,46 @@
+# Generated by Django 5.0.14 on 2026-10-19 07:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def drop_constraint_on_shards(apps, schema_editor):
+    """
+    Drop the foreign key from ride_event to ride on ride event shards,
+    whose ride tables stay empty (see rides/sharding.py). Other databases
+    keep it.
+    """
+    if schema_editor.connection.alias not in settings.RIDE_EVENT_SHARDS:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = 'ride_event'::regclass AND contype = 'f'"
+        )
+        names = [name for name, in cursor.fetchall()]
+    for name in names:
+        schema_editor.execute(f'ALTER TABLE ride_event DROP CONSTRAINT {schema_editor.quote_name(name)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0003_slow_query_log'),
+    ]
+
+    operations = [
+        # The model has no constraint, as it can't tell which database it's
+        # in; the databases that aren't shards keep theirs
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='rideevent',
+                    name='id_ride',
+                    field=models.ForeignKey(db_column='id_ride', db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='ride_events', to='rides.ride'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(drop_constraint_on_shards, migrations.RunPython.noop),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.14 on 2026-10-19 07:58
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without locking out writes to ride_event, and
+    # the new ones before the old ones go, so lookups stay indexed
+    atomic = False
+
+    dependencies = [
+        ('rides', '0004_ride_event_shards'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='rideevent',
+            index=models.Index(fields=['description'], name='ride_event_descr_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(fields=['email'], name='user_email_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        RemoveIndexConcurrently(
+            model_name='rideevent',
+            name='ride_event_descrip_3849aa_idx',
+        ),
+        RemoveIndexConcurrently(
+            model_name='user',
+            name='user_email_7bbb4c_idx',
+        ),
+    ]
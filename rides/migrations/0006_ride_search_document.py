@@ -0,0 +1,88 @@
+# Generated by Django 5.0.14 on 2026-10-19 08:00
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+# The search document of a ride from its rider and driver (see
+# rides/search.py). Emails are also split at their punctuation, and phone
+# numbers into their groups of digits as well as all of them, so parts of
+# them can be searched.
+DOCUMENT_FUNCTION = r'''
+CREATE OR REPLACE FUNCTION ride_search_document(rider integer, driver integer)
+RETURNS tsvector AS $$
+    SELECT
+        setweight(to_tsvector('simple', coalesce(string_agg(
+            u.first_name || ' ' || u.last_name, ' '), '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(string_agg(
+            u.email || ' ' || translate(u.email, '@.+_-', '     '), ' '), '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(string_agg(
+            regexp_replace(u.phone_number, '\D+', ' ', 'g') || ' ' ||
+            regexp_replace(u.phone_number, '\D', '', 'g'), ' '), '')), 'C')
+    FROM "user" u
+    WHERE u.id_user IN (rider, driver)
+$$ LANGUAGE sql STABLE;
+'''
+
+TRIGGERS = '''
+CREATE OR REPLACE FUNCTION ride_search_document_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_document := ride_search_document(NEW.id_rider, NEW.id_driver);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER ride_search_document
+BEFORE INSERT OR UPDATE OF id_rider, id_driver ON ride
+FOR EACH ROW EXECUTE FUNCTION ride_search_document_update();
+
+CREATE OR REPLACE FUNCTION user_ride_search_documents_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE ride SET search_document = ride_search_document(id_rider, id_driver)
+    WHERE id_rider = NEW.id_user OR id_driver = NEW.id_user;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER user_ride_search_documents
+AFTER UPDATE OF first_name, last_name, email, phone_number ON "user"
+FOR EACH ROW
+WHEN ((OLD.first_name, OLD.last_name, OLD.email, OLD.phone_number)
+      IS DISTINCT FROM (NEW.first_name, NEW.last_name, NEW.email, NEW.phone_number))
+EXECUTE FUNCTION user_ride_search_documents_update();
+'''
+
+DROP_TRIGGERS = '''
+DROP TRIGGER IF EXISTS user_ride_search_documents ON "user";
+DROP FUNCTION IF EXISTS user_ride_search_documents_update();
+DROP TRIGGER IF EXISTS ride_search_document ON ride;
+DROP FUNCTION IF EXISTS ride_search_document_update();
+DROP FUNCTION IF EXISTS ride_search_document(integer, integer);
+'''
+
+BACKFILL = 'UPDATE ride SET search_document = ride_search_document(id_rider, id_driver)'
+
+
+class Migration(migrations.Migration):
+    # The GIN index is built without locking out writes to ride, after the
+    # documents are filled in
+    atomic = False
+
+    dependencies = [
+        ('rides', '0005_prefix_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='search_document',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(DOCUMENT_FUNCTION + TRIGGERS, DROP_TRIGGERS),
+        migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+        AddIndexConcurrently(
+            model_name='ride',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='ride_search_document_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.14 on 2026-10-19 08:04
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The indexes are built without locking out writes to user
+    atomic = False
+
+    dependencies = [
+        ('rides', '0006_ride_search_document'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(models.F('role'), django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Lower('email'), name='text_pattern_ops'), name='user_role_email_lookup_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(models.F('role'), django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Lower('first_name'), name='text_pattern_ops'), name='user_role_first_lookup_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(models.F('role'), django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Lower('last_name'), name='text_pattern_ops'), name='user_role_last_lookup_idx'),
+        ),
+    ]
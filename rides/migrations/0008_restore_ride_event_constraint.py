@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def restore_constraint(apps, schema_editor):
+    """
+    Add back the foreign key from ride_event to ride that earlier versions
+    of 0004_ride_event_shards dropped from every database, except on ride
+    event shards.
+
+    It is added NOT VALID, then validated, so writes to ride_event aren't
+    blocked while existing rows are checked. Validation fails if events
+    of deleted rides are left over; delete them and migrate again.
+    """
+    if schema_editor.connection.alias in settings.RIDE_EVENT_SHARDS:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = 'ride_event'::regclass AND contype = 'f'"
+        )
+        if cursor.fetchone():
+            return
+    schema_editor.execute(
+        'ALTER TABLE ride_event ADD CONSTRAINT ride_event_id_ride_fk_ride_id_ride '
+        'FOREIGN KEY (id_ride) REFERENCES ride (id_ride) DEFERRABLE INITIALLY DEFERRED NOT VALID'
+    )
+    schema_editor.execute('ALTER TABLE ride_event VALIDATE CONSTRAINT ride_event_id_ride_fk_ride_id_ride')
+
+
+class Migration(migrations.Migration):
+    # Each statement commits on its own, so the validation doesn't hold the
+    # lock taken to add the constraint
+    atomic = False
+
+    dependencies = [
+        ('rides', '0007_user_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_constraint, migrations.RunPython.noop),
+    ]
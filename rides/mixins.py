@@ -0,0 +1,153 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+
+from . import metrics
+from .instrumentation import current_timings
+from .renderers import StreamingJSONRenderer
+from .replicas import PRIMARY_ALIAS, REPLICA_ALIAS, reading_from_replica
+from .timeouts import StatementTimeout, current_timeout, is_statement_timeout, statement_timeout
+
+
+class InstrumentedViewMixin:
+    """
+    Time a DRF view's authentication and permission checks.
+
+    The time is reported as `permissions` in the request timings (see
+    rides/instrumentation.py), rather than counted as serialization.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        timings = current_timings.get()
+        if timings is None:
+            return super().initial(request, *args, **kwargs)
+        with timings.timing_permissions():
+            return super().initial(request, *args, **kwargs)
+
+    def check_object_permissions(self, request, obj):
+        timings = current_timings.get()
+        if timings is None:
+            return super().check_object_permissions(request, obj)
+        with timings.timing_permissions():
+            return super().check_object_permissions(request, obj)
+
+
+class StatementTimeoutMixin:
+    """
+    Run a DRF view's GET requests with a statement timeout (see
+    rides/timeouts.py).
+
+    Queries running longer than `statement_timeout` milliseconds (by
+    default API_STATEMENT_TIMEOUT_MS) are canceled. Unless the view left
+    the timed out part out of the response, the client gets a 503.
+    """
+    statement_timeout = None
+
+    def get_statement_timeout(self, request):
+        """
+        The request's timeout in milliseconds, or None for no timeout.
+        """
+        if request.method not in ('GET', 'HEAD') or not settings.API_STATEMENT_TIMEOUT_MS:
+            return None
+        return self.statement_timeout or settings.API_STATEMENT_TIMEOUT_MS
+
+    def dispatch(self, request, *args, **kwargs):
+        timeout = self.get_statement_timeout(request)
+        if timeout is None:
+            return super().dispatch(request, *args, **kwargs)
+
+        using = REPLICA_ALIAS if reading_from_replica() else PRIMARY_ALIAS
+        with statement_timeout(timeout, using) as state:
+            response = super().dispatch(request, *args, **kwargs)
+        if state.degraded:
+            response['X-Degraded'] = ', '.join(dict.fromkeys(state.degraded))
+        return response
+
+    def handle_exception(self, exc):
+        if is_statement_timeout(exc):
+            metrics.statement_timeouts.labels('request').inc()
+            state = current_timeout.get()
+            if state is not None:
+                # The transaction is aborted: roll it back, not commit it
+                transaction.set_rollback(True, using=state.using)
+            exc = StatementTimeout()
+        return super().handle_exception(exc)
+
+
+class StreamingListMixin:
+    """
+    Stream large list responses instead of building them in memory.
+
+    DRF's `list()` serializes the whole page into a list of dicts and then
+    renders the whole JSON document before sending a byte. For unpaginated
+    views and for pages of at least API_STREAMING_MIN_PAGE_SIZE rows, this
+    mixin instead iterates the queryset in chunks and writes each row out
+    as soon as it is serialized, so peak memory is bounded by the chunk
+    size rather than by the size of the response.
+
+    Small pages, and renderers that can't stream (e.g. the browsable API),
+    go through the regular DRF code path.
+    """
+    streaming_chunk_size = 100
+
+    def list(self, request, *args, **kwargs):
+        if not self.should_stream(request):
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if isinstance(queryset, QuerySet):
+            # Pick the database now: the rows are read after the view returns,
+            # outside of the request's database routing (see rides/replicas.py)
+            queryset = queryset.using(queryset.db)
+
+        if self.paginator is None:
+            rows, envelope = queryset, None
+        else:
+            rows = self.paginate_queryset(queryset)
+            envelope = self.get_paginated_response([]).data
+
+        return self.get_streaming_response(rows, envelope)
+
+    def should_stream(self, request):
+        """
+        Whether list() streams this request rather than using DRF's list().
+        """
+        if not isinstance(request.accepted_renderer, StreamingJSONRenderer):
+            return False
+        if self.paginator is None:
+            return True
+        page_size = self.paginator.get_page_size(request)
+        return bool(page_size) and page_size >= settings.API_STREAMING_MIN_PAGE_SIZE
+
+    def get_throttle_scope(self, request):
+        """
+        Large pages are throttled as exports (see rides/throttling.py).
+
+        Unpaginated lists also stream, but they are regular reads (e.g. the
+        user list) and keep the view's scope.
+        """
+        if self.action == 'list' and self.paginator is not None and self.should_stream(request):
+            return 'export'
+        return getattr(self, 'throttle_scope', 'api')
+
+    def iter_rows(self, rows):
+        """
+        Serialize `rows` one at a time, fetching querysets in chunks.
+        """
+        if isinstance(rows, QuerySet):
+            rows = rows.iterator(chunk_size=self.streaming_chunk_size)
+        # Reuse one child serializer so its fields are only built once
+        serializer = self.get_serializer(many=True).child
+        for instance in rows:
+            yield serializer.to_representation(instance)
+
+    def get_streaming_response(self, rows, envelope=None):
+        renderer = self.request.accepted_renderer
+        content = renderer.render_stream(
+            self.iter_rows(rows),
+            envelope=envelope,
+            accepted_media_type=self.request.accepted_media_type,
+            renderer_context=self.get_renderer_context(),
+        )
+        return StreamingHttpResponse(content, content_type=renderer.media_type)
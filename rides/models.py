@@ -1,4 +1,7 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models.functions import Lower
 from django.utils import timezone
 
 
@@ -23,14 +26,35 @@ class User(models.Model):
     class Meta:
         db_table = 'user'
         indexes = [
-            models.Index(fields=['email']),
+            # Also serves prefix searches (LIKE 'abc%') in any collation;
+            # exact matches use the unique constraint's index
+            models.Index(fields=['email'], name='user_email_prefix_idx', opclasses=['varchar_pattern_ops']),
             models.Index(fields=['role']),
+            # Typeahead lookups by role (see rides/search.py)
+            models.Index(
+                'role', OpClass(Lower('email'), name='text_pattern_ops'),
+                name='user_role_email_lookup_idx'
+            ),
+            models.Index(
+                'role', OpClass(Lower('first_name'), name='text_pattern_ops'),
+                name='user_role_first_lookup_idx'
+            ),
+            models.Index(
+                'role', OpClass(Lower('last_name'), name='text_pattern_ops'),
+                name='user_role_last_lookup_idx'
+            ),
         ]
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.role})"
 
 
+class RideManager(models.Manager):
+    def get_queryset(self):
+        # Only searches read the search document
+        return super().get_queryset().defer('search_document')
+
+
 class Ride(models.Model):
     """
     Ride model representing a ride request.
@@ -60,6 +84,12 @@ class Ride(models.Model):
     dropoff_latitude = models.FloatField()
     dropoff_longitude = models.FloatField()
     pickup_time = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+    # The rider's and driver's names, emails and phone numbers, kept up to
+    # date by database triggers (see rides/search.py)
+    search_document = SearchVectorField(null=True, editable=False)
+
+    objects = RideManager()
 
     class Meta:
         db_table = 'ride'
@@ -70,6 +100,10 @@ class Ride(models.Model):
             models.Index(fields=['id_driver']),
             # For GPS-based distance sorting
             models.Index(fields=['pickup_latitude', 'pickup_longitude']),
+            # For the change feed
+            models.Index(fields=['updated_at', 'id_ride']),
+            # For searches
+            GinIndex(fields=['search_document'], name='ride_search_document_idx'),
         ]
         ordering = ['-pickup_time']
 
@@ -77,6 +111,19 @@ class Ride(models.Model):
         return f"Ride {self.id_ride} - {self.status}"
 
 
+class RideEventQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        """
+        Like QuerySet.create(), but unless a database was picked with
+        using(), the router picks it from the new event: with sharded ride
+        events, its ride's shard (see rides/sharding.py).
+        """
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+
 class RideEvent(models.Model):
     """
     RideEvent model for tracking events during a ride.
@@ -87,19 +134,55 @@ class RideEvent(models.Model):
         Ride,
         on_delete=models.CASCADE,
         related_name='ride_events',
-        db_column='id_ride'
+        db_column='id_ride',
+        # Sharded events reference rides in another database (see
+        # rides/sharding.py), so shards have no foreign key constraint.
+        # Unsharded databases keep theirs (see migration 0004).
+        db_constraint=False
     )
     description = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = RideEventQuerySet.as_manager()
 
     class Meta:
         db_table = 'ride_event'
         indexes = [
             models.Index(fields=['id_ride', 'created_at']),
             models.Index(fields=['created_at']),
-            models.Index(fields=['description']),
+            # Exact matches and prefix searches (LIKE 'abc%')
+            models.Index(fields=['description'], name='ride_event_descr_prefix_idx', opclasses=['varchar_pattern_ops']),
+            # For the change feed
+            models.Index(fields=['updated_at', 'id_ride_event']),
         ]
         ordering = ['-created_at']
 
     def __str__(self):
         return f"Event {self.id_ride_event} - {self.description}"
+
+
+class SlowQueryLog(models.Model):
+    """
+    A SQL statement that took longer than SLOW_QUERY_THRESHOLD_MS during a
+    request, with its query plan when one was captured.
+    Only the latest SLOW_QUERY_LOG_SIZE entries are kept.
+    """
+    id_slow_query = models.AutoField(primary_key=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    duration_ms = models.FloatField()
+    route = models.CharField(max_length=200, blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    query_string = models.TextField(blank=True)
+    database = models.CharField(max_length=50)
+    sql = models.TextField()
+    params = models.TextField(blank=True)
+    plan = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'slow_query_log'
+        ordering = ['-id_slow_query']
+
+    def __str__(self):
+        return f"{self.duration_ms:.0f} ms - {self.route or self.path}"
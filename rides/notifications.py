@@ -0,0 +1,174 @@
+"""
+PostgreSQL LISTEN/NOTIFY plumbing.
+
+`notify()` sends a payload on a channel as part of the current transaction,
+so listeners only hear about changes that were committed.
+
+`listener` is a per-process background thread with its own database
+connection. It LISTENs on every channel something has subscribed to and
+calls the subscribed callbacks with each payload. While nothing is
+happening it blocks in select() on the connection's socket, so waiting
+costs no queries.
+"""
+from django.db import connections
+from psycopg2.extensions import quote_ident
+import logging
+import os
+import select
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def notify(channel, payload, using='default'):
+    """
+    Send `payload` (a string) to everyone listening on `channel`.
+
+    The listener is connected to the primary: for changes made in another
+    database (a ride event shard), call this from that database's
+    on_commit instead, with the default `using`.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+
+class Listener:
+    """
+    Dispatches notifications from PostgreSQL to in-process callbacks.
+    """
+    # How long select() waits before checking the connection again
+    poll_interval = 30
+    # Delay before reconnecting after the connection is lost
+    reconnect_delay = 1
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.callbacks = {}
+        self.reconnect_callbacks = []
+        self.lock = threading.Lock()
+        self.connection = None
+        self.thread = None
+        self.stopping = threading.Event()
+        # Written to by stop() to wake the thread up from select()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+    def subscribe(self, channel, callback):
+        """
+        Call `callback(payload)` from the listener thread for every
+        notification on `channel`. LISTEN has been issued by the time this
+        returns, so no notification committed afterwards is missed.
+        """
+        with self.lock:
+            self.ensure_started()
+            if channel not in self.callbacks:
+                self.callbacks[channel] = []
+                self.listen(channel)
+            self.callbacks[channel].append(callback)
+
+    def unsubscribe(self, channel, callback):
+        with self.lock:
+            callbacks = self.callbacks.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def on_reconnect(self, callback):
+        """
+        Call `callback()` after the connection was lost and re-established.
+        Notifications sent while it was down are gone, so anything relying
+        on them should assume it missed some.
+        """
+        with self.lock:
+            if callback not in self.reconnect_callbacks:
+                self.reconnect_callbacks.append(callback)
+
+    def ensure_started(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.connect()
+        self.thread = threading.Thread(target=self.run, name='pg-listener', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the thread and close its connection. Subscriptions are dropped.
+        """
+        self.stopping.set()
+        os.write(self.wakeup_write, b'x')
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.callbacks = {}
+            self.reconnect_callbacks = []
+            self.close()
+
+    def connect(self):
+        wrapper = connections[self.using]
+        self.connection = wrapper.Database.connect(**wrapper.get_connection_params())
+        self.connection.autocommit = True
+        for channel in self.callbacks:
+            self.listen(channel)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def listen(self, channel):
+        with self.connection.cursor() as cursor:
+            cursor.execute('LISTEN %s' % quote_ident(channel, self.connection))
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.wait_and_dispatch()
+            except Exception:
+                logger.exception('Lost the LISTEN connection, reconnecting')
+                with self.lock:
+                    self.close()
+                time.sleep(self.reconnect_delay)
+                try:
+                    with self.lock:
+                        self.connect()
+                        reconnect_callbacks = list(self.reconnect_callbacks)
+                except Exception:
+                    logger.exception('Could not reconnect the LISTEN connection')
+                    continue
+                for callback in reconnect_callbacks:
+                    try:
+                        callback()
+                    except Exception:
+                        logger.exception('Error handling LISTEN reconnect')
+
+    def wait_and_dispatch(self):
+        connection = self.connection
+        if connection is None:
+            raise ConnectionError('No LISTEN connection')
+        readable, _, _ = select.select(
+            [connection, self.wakeup_read], [], [], self.poll_interval
+        )
+        if self.wakeup_read in readable:
+            os.read(self.wakeup_read, 1)
+
+        with self.lock:
+            # Also run on timeouts: polling a broken connection raises, which
+            # triggers a reconnect
+            connection.poll()
+            notifies = list(connection.notifies)
+            connection.notifies.clear()
+            callbacks = {channel: list(cbs) for channel, cbs in self.callbacks.items()}
+
+        for notification in notifies:
+            for callback in callbacks.get(notification.channel, []):
+                try:
+                    callback(notification.payload)
+                except Exception:
+                    logger.exception('Error handling notification on %s', notification.channel)
+
+
+listener = Listener()
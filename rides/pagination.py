@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+import json
+
+from .timeouts import optional_query
+
+
+def estimate_count(queryset):
+    """
+    PostgreSQL's estimate of the number of rows of `queryset`, or None
+    when it has none.
+
+    Unfiltered querysets use the row count of the table statistics
+    (pg_class.reltuples, kept up to date by autovacuum), others the
+    planner's estimate for the query (EXPLAIN).
+    """
+    if queryset.query.where:
+        plan = json.loads(queryset.order_by().explain(format='json'))
+        return plan[0]['Plan']['Plan Rows']
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            [queryset.model._meta.db_table]
+        )
+        reltuples = cursor.fetchone()[0]
+    # -1 until the table is first vacuumed or analyzed
+    return int(reltuples) if reltuples >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A Paginator that takes PostgreSQL's estimate (see estimate_count())
+    as the count of large querysets.
+
+    Querysets estimated at API_ESTIMATED_COUNT_THRESHOLD rows or more get
+    the estimate, and `approximate` is set; smaller ones, those without an
+    estimate and object lists that aren't querysets (e.g. a ScatterGather)
+    are counted exactly. Used by the API and by the admin of large tables.
+    """
+    approximate = False
+
+    @cached_property
+    def count(self):
+        threshold = settings.API_ESTIMATED_COUNT_THRESHOLD
+        if threshold and isinstance(self.object_list, QuerySet):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= threshold:
+                self.approximate = True
+                return estimate
+        return super().count
+
+    def page(self, number):
+        page = super().page(number)
+        if self.approximate:
+            # Don't cut the last page off at the estimate, which may be short
+            bottom = (page.number - 1) * self.per_page
+            page.object_list = self.object_list[bottom:bottom + self.per_page]
+        return page
+
+
+class UncountedPage:
+    """
+    A page of rows whose total count isn't known exactly.
+
+    One row more than the page size is fetched, to tell whether there is
+    a next page.
+    """
+
+    def __init__(self, queryset, number, page_size):
+        self.number = number
+        offset = (number - 1) * page_size
+        rows = list(queryset[offset:offset + page_size + 1])
+        self.object_list = rows[:page_size]
+        self._has_next = len(rows) > page_size
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+class StandardPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination with a client-selectable, bounded page size.
+
+    Clients can ask for up to API_MAX_PAGE_SIZE rows with `?page_size=`.
+    The page is returned as a lazy sliced queryset rather than a list, so
+    streaming list responses can iterate it in chunks instead of loading
+    every row of a large page into memory at once.
+
+    The total count is optional (see rides/timeouts.py): when counting
+    times out, the page is returned with `"count": null`, and `next` tells
+    whether there are more rows. The same goes for approximate counts
+    (see EstimatedCountPagination), which can't tell where the rows end.
+    """
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return settings.API_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        page_number = self.get_page_number(request, paginator)
+        self.request = request
+
+        self.count = optional_query('count', lambda: paginator.count)
+        self.count_approximate = getattr(paginator, 'approximate', False)
+        if self.count is None or self.count_approximate:
+            self.page = self.get_uncounted_page(queryset, page_number, page_size)
+            return self.page.object_list
+
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            )
+            raise NotFound(msg)
+
+        if paginator.num_pages > 1 and self.template is not None:
+            # The browsable API should display pagination controls.
+            self.display_page_controls = True
+
+        # Unlike the DRF base class, don't force the page into a list here
+        return self.page.object_list
+
+    def get_uncounted_page(self, queryset, page_number, page_size):
+        def invalid(message):
+            return NotFound(self.invalid_page_message.format(page_number=page_number, message=message))
+
+        try:
+            number = int(page_number)
+        except (TypeError, ValueError):
+            raise invalid('That page number is not an integer')
+        if number < 1:
+            raise invalid('That page number is less than 1')
+        page = UncountedPage(queryset, number, page_size)
+        if number > 1 and not page.object_list:
+            raise invalid('That page contains no results')
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class EstimatedCountPagination(StandardPageNumberPagination):
+    """
+    StandardPageNumberPagination that counts large lists from PostgreSQL's
+    estimates instead of COUNT(*) (see EstimatedCountPaginator), telling
+    clients with `count_approximate`.
+    """
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_approximate', self.count_approximate),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
@@ -1,5 +1,52 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from rest_framework import permissions
+from .local_cache import MISSING, get_cache, get_or_fill, user_role_key
 from .models import User
+from .replicas import PRIMARY_ALIAS
+import hmac
+
+
+def get_user_role(email):
+    """
+    Role of the rides User with this email, or None. Cached per process and
+    evicted everywhere when the User changes (see local_cache.py).
+    """
+    def fill():
+        # Not from a replica: the eviction comes as soon as a change commits
+        # on the primary, and a lagging replica would refill the old role
+        return User.objects.using(PRIMARY_ALIAS).filter(email=email).values_list('role', flat=True).first()
+    return get_or_fill(user_role_key(email), fill)
+
+
+async def aget_user_role(email):
+    """
+    Async version of get_user_role().
+    """
+    role = get_cache().get(user_role_key(email), MISSING)
+    if role is MISSING:
+        # Misses query the database, and may start the listener
+        role = await sync_to_async(get_user_role)(email)
+    return role
+
+
+def is_admin_user(user):
+    """
+    Whether `user` (a Django auth user) may use the admin-only API.
+    """
+    # User must be authenticated
+    if not user or not user.is_authenticated:
+        return False
+
+    # For Django's built-in User (superuser), allow access
+    if getattr(user, 'is_superuser', False):
+        return True
+
+    # Check if it's our custom User model with role='admin'
+    try:
+        return get_user_role(user.email) == 'admin'
+    except Exception:
+        return False
 
 
 class IsAdminUser(permissions.BasePermission):
@@ -14,21 +61,32 @@ class IsAdminUser(permissions.BasePermission):
         """
         Check if the user is authenticated and has admin role.
         """
-        # User must be authenticated
-        if not request.user or not request.user.is_authenticated:
+        return is_admin_user(request.user)
+
+    async def ahas_permission(self, request, view):
+        """
+        Async version of has_permission(), for plain Django async views.
+        """
+        user = await request.auser()
+        if not user or not user.is_authenticated:
             return False
 
-        # For Django's built-in User (superuser), allow access
-        if hasattr(request.user, 'is_superuser') and request.user.is_superuser:
+        if getattr(user, 'is_superuser', False):
             return True
 
-        # Check if it's our custom User model with role='admin'
-        try:
-            # Try to get the custom User model instance
-            custom_user = User.objects.filter(email=request.user.email).first()
-            if custom_user and custom_user.role == 'admin':
-                return True
-        except Exception:
-            pass
+        return await aget_user_role(user.email) == 'admin'
 
-        return False
+
+class HasMetricsToken(permissions.BasePermission):
+    """
+    Allow scrapers presenting `Authorization: Bearer <METRICS_TOKEN>`.
+
+    Always denies when METRICS_TOKEN is not set.
+    """
+
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        if not token:
+            return False
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), token.encode())
@@ -0,0 +1,154 @@
+"""
+On-demand profiling of single requests.
+
+Admins add `?profile=1` (or an `X-Profile: 1` header) to any request to
+have it run under cProfile. Instead of the normal response they get JSON
+with the functions that took the most time and every SQL statement that
+ran. `?profile=pstats` returns the raw profile instead, for tools such as
+snakeviz or `python -m pstats`.
+
+Under ASGI the profiler runs on the event loop thread: work an async view
+hands to a thread with sync_to_async shows up as the time spent awaiting
+it, but its SQL is in the query log all the same.
+"""
+from asgiref.sync import sync_to_async
+from contextlib import ExitStack, contextmanager
+from django.db import connections
+import cProfile
+import marshal
+import pstats
+import threading
+import time
+
+from .slow_queries import format_params
+
+# cProfile can only profile one request at a time on Python 3.12+, and
+# profiling is meant for one-off investigations anyway
+profiling_lock = threading.Lock()
+
+SORT_KEYS = {
+    'cumulative': 'cumulative_ms',
+    'tottime': 'total_ms',
+    'calls': 'calls',
+}
+
+
+class QueryLog:
+    """
+    Execute wrapper that keeps every statement with its duration.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'params': format_params(params),
+                'many': many,
+                'database': context['connection'].alias,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+@contextmanager
+def logging_queries(query_log):
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(query_log))
+        yield
+
+
+def profile_request(get_response, request):
+    """
+    Handle `request` under the profiler, including streamed content.
+
+    Returns (response, profiler, query log, wall time in seconds).
+    """
+    profiler = cProfile.Profile()
+    query_log = QueryLog()
+
+    def handle():
+        with logging_queries(query_log):
+            response = get_response(request)
+            # Streamed responses do their work while being iterated
+            if response.streaming:
+                response.streaming_content = [b''.join(response.streaming_content)]
+            return response
+
+    start = time.perf_counter()
+    response = profiler.runcall(handle)
+    return response, profiler, query_log, time.perf_counter() - start
+
+
+async def aprofile_request(get_response, request):
+    """
+    Async version of profile_request(), for an async middleware chain.
+    """
+    profiler = cProfile.Profile()
+    query_log = QueryLog()
+    # The SQL runs in the request's sync_to_async thread, whose connections
+    # aren't the event loop's
+    logging = logging_queries(query_log)
+    await sync_to_async(logging.__enter__)()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        response = await get_response(request)
+        if response.streaming:
+            response.streaming_content = [b''.join([chunk async for chunk in response])]
+    finally:
+        profiler.disable()
+        wall_time = time.perf_counter() - start
+        await sync_to_async(logging.__exit__)(None, None, None)
+    return response, profiler, query_log, wall_time
+
+
+def function_name(func):
+    filename, line, name = func
+    if filename == '~':
+        # Built-in functions
+        return name
+    return f'{filename}:{line}({name})'
+
+
+def profile_report(request, response, profiler, query_log, wall_time, sort='cumulative', limit=50):
+    """
+    Summarize a profiled request as JSON-serializable data.
+    """
+    stats = pstats.Stats(profiler)
+    functions = [
+        {
+            'function': function_name(func),
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_ms': round(total_time * 1000, 3),
+            'cumulative_ms': round(cumulative_time * 1000, 3),
+        }
+        for func, (primitive_calls, calls, total_time, cumulative_time, _) in stats.stats.items()
+    ]
+    functions.sort(key=lambda function: function[SORT_KEYS[sort]], reverse=True)
+
+    return {
+        'path': request.get_full_path(),
+        'method': request.method,
+        'status_code': response.status_code,
+        'wall_ms': round(wall_time * 1000, 3),
+        'sort': sort,
+        'functions': functions[:limit],
+        'sql_count': len(query_log.queries),
+        'sql_ms': round(sum(query['duration_ms'] for query in query_log.queries), 3),
+        'sql': query_log.queries,
+    }
+
+
+def raw_profile(profiler):
+    """
+    The profile in the format pstats.Stats() loads from a file.
+    """
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
@@ -0,0 +1,144 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class StreamingJSONRenderer(JSONRenderer):
+    """
+    JSON renderer that can also encode a list response incrementally.
+
+    `render()` behaves exactly like DRF's JSONRenderer. `render_stream()`
+    yields the same document in chunks: the envelope around the rows,
+    then each row encoded on its own as it comes out of `rows`, so only
+    one chunk of rows is held in memory at a time.
+    """
+    # Stand-in for the row list while the envelope is encoded. The bytes it
+    # encodes to mark where the streamed rows are spliced in.
+    results_placeholder = '\x00results\x00'
+
+    # Rows are buffered into chunks of roughly this many bytes before being
+    # yielded, so the server doesn't issue one write per row.
+    buffer_size = 64 * 1024
+
+    def render_stream(self, rows, envelope=None, results_key='results',
+                      accepted_media_type=None, renderer_context=None):
+        """
+        Yield a JSON document as bytes, encoding `rows` one at a time.
+
+        Without an `envelope` the document is a bare JSON array. With one,
+        `envelope[results_key]` is replaced by the streamed array and the
+        other keys are rendered as usual, in their original order.
+        """
+        def encode(data):
+            return self.render(data, accepted_media_type, renderer_context)
+
+        if envelope is None:
+            prefix, suffix = b'', b''
+        else:
+            envelope = dict(envelope)
+            envelope[results_key] = self.results_placeholder
+            prefix, suffix = encode(envelope).split(encode(self.results_placeholder))
+
+        buffer = [prefix, b'[']
+        buffered = 0
+        for index, row in enumerate(rows):
+            chunk = encode(row)
+            if index:
+                buffer.append(b',')
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= self.buffer_size:
+                yield b''.join(buffer)
+                buffer, buffered = [], 0
+        buffer.extend([b']', suffix])
+        yield b''.join(buffer)
+
+
+class ORJSONRenderer(StreamingJSONRenderer):
+    """
+    Drop-in replacement for the JSON renderer backed by orjson.
+
+    Produces the same bytes as DRF's JSONRenderer for this API's payloads,
+    whose floats (coordinates, durations) are of ordinary magnitude:
+    datetimes and other non-native types are passed through to DRF's own
+    encoder, and U+2028/U+2029 are escaped the same way. Anything orjson
+    can't reproduce exactly (indented output, ASCII-only output, integers
+    wider than 64 bits) falls back to the stdlib renderer.
+
+    Other floats differ, as checking for them would mean walking every
+    payload in Python:
+
+    - Very large and very small floats are written in orjson's shortest
+      form (`1e16` and `0.00001` rather than `1e+16` and `1e-05`); both
+      parse to the same values.
+    - NaN and Infinity are written as `null`, where JSONRenderer raises
+      ValueError.
+    """
+    options = (
+        orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if orjson is not None else 0
+    )
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=JSONEncoder().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Escape \u2028 and \u2029 like JSONRenderer does
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders data as MessagePack, selected with `Accept: application/msgpack`.
+
+    Values that MessagePack has no type for (datetimes, decimals, ...) are
+    converted exactly as they would be for JSON, so both formats decode to
+    the same data.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
+
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets views negotiate `text/event-stream` for Server-Sent Events.
+
+    Streams are written by the view itself; this only renders error
+    responses, as a single `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        from .event_stream import format_sse
+
+        if data is None:
+            return b''
+        return format_sse(JSONRenderer().render(data).decode(), event='error').encode()
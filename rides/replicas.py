@@ -0,0 +1,120 @@
+"""
+Routing reads to a read replica.
+
+When DATABASES has a 'replica' entry, ReplicaMiddleware lets the read
+queries of GET requests to replica-enabled views go to it. Views opt in
+with `replica_actions`, the handlers whose reads may run there:
+
+    class RideViewSet(...):
+        replica_actions = ('list', 'retrieve')
+
+Function views use the @reads_from_replica decorator instead.
+
+Everything else reads from the primary ('default'), and all writes go
+there. A replica lags behind the primary, so a client shouldn't read
+from it just after writing:
+
+- Once a request writes, its later reads in the same request go to the
+  primary.
+- A response to a request that wrote sets a cookie that keeps the
+  client's reads on the primary for REPLICA_LAG_SECONDS.
+"""
+from contextvars import ContextVar
+from django.db import connections
+
+REPLICA_ALIAS = 'replica'
+PRIMARY_ALIAS = 'default'
+
+# The app label of DatabaseCache entries
+CACHE_APP_LABEL = 'django_cache'
+
+
+class RoutingState:
+    """
+    Where the current request may read from, and whether it wrote.
+    """
+
+    def __init__(self, use_replica=False):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+current_routing = ContextVar('current_routing', default=None)
+
+
+def replica_configured():
+    return REPLICA_ALIAS in connections.settings
+
+
+def reading_from_replica():
+    """
+    Whether reads of the current request go to the replica.
+    """
+    state = current_routing.get()
+    return (
+        state is not None and state.use_replica and not state.wrote
+        and replica_configured()
+    )
+
+
+def view_handler_name(request, view_func):
+    """
+    The name of the handler that will serve `request`: the action of a
+    viewset ('list', 'retrieve', ...), otherwise the lowercase method.
+    """
+    method = 'get' if request.method == 'HEAD' else request.method.lower()
+    actions = getattr(view_func, 'actions', None)
+    if actions:
+        return actions.get(method)
+    return method
+
+
+def view_replica_actions(view_func):
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    return getattr(view_class or view_func, 'replica_actions', ())
+
+
+def reads_from_replica(view_func):
+    """
+    Let the GET requests of a function view read from the replica.
+    """
+    view_func.replica_actions = ('get',)
+    return view_func
+
+
+class ReplicaRouter:
+    """
+    Send reads to the replica when the current request allows it, and
+    everything else to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == CACHE_APP_LABEL:
+            # Shared caches (e.g. rides/coalescing.py) must see the latest
+            # entries
+            return PRIMARY_ALIAS
+        instance = hints.get('instance')
+        state = current_routing.get()
+        if instance is not None and instance._state.db and not (state and state.wrote):
+            # Related objects come from where the instance came from
+            return instance._state.db
+        if reading_from_replica():
+            return REPLICA_ALIAS
+        return PRIMARY_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == CACHE_APP_LABEL:
+            # Not something the client would read back
+            return PRIMARY_ALIAS
+        state = current_routing.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema from the primary through replication
+        return db != REPLICA_ALIAS
@@ -0,0 +1,108 @@
+"""
+Full-text search over rides by their rider and driver, and typeahead
+lookups of users.
+
+Each ride has a `search_document` tsvector holding the names (weight A),
+emails (B) and phone numbers (C) of its rider and driver, behind a GIN
+index. PostgreSQL keeps it up to date with triggers (see migration
+0006_ride_search_document): when a ride is written with its rider or
+driver set, and when one of those users changes. Bulk inserts and
+updates are covered too, which signals would miss.
+
+A search matches rides having every word of the query as the start of a
+word of the document: "jan rid" finds Jane Rider, "jane@ex" her email
+and "555 01" a phone number. Results come best ranked first, and are
+paged with a cursor holding the (rank, id) of the last row, so later
+pages cost no more than the first.
+
+User lookups (for rider and driver pickers) match the start of an email
+or of names with plain B-tree indexes, and return a few rows at most.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast, Lower
+import binascii
+import json
+import re
+
+from .changes import InvalidCursor
+
+# No stemming or stop words: the documents are names, emails and numbers
+SEARCH_CONFIG = 'simple'
+
+# Letters and digits; anything else separates words, as in the documents
+WORD = re.compile(r'[^\W_]+')
+
+
+def search_query(text):
+    """
+    A query matching documents with every word of `text` as a prefix, or
+    None when `text` has no words.
+    """
+    words = WORD.findall(text.lower())
+    if not words:
+        return None
+    return SearchQuery(' & '.join(f'{word}:*' for word in words), search_type='raw', config=SEARCH_CONFIG)
+
+
+def search_rides(queryset, query, after=None):
+    """
+    The rides of `queryset` matching `query`, annotated with their `rank`
+    and sorted best first, starting after the (rank, pk) position `after`.
+    """
+    queryset = queryset.filter(search_document=query).annotate(
+        # As double precision, which round-trips through the cursor exactly
+        rank=Cast(SearchRank(F('search_document'), query), FloatField())
+    )
+    if after is not None:
+        rank, pk = after
+        queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, pk__lt=pk))
+    return queryset.order_by('-rank', '-pk')
+
+
+def encode_search_cursor(ride):
+    """
+    The cursor of the results after `ride`, a row of search_rides().
+    """
+    data = json.dumps([ride.rank, ride.pk], separators=(',', ':'))
+    return urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """
+    Decode a cursor produced by encode_search_cursor() into (rank, pk), raising
+    InvalidCursor.
+    """
+    try:
+        rank, pk = json.loads(urlsafe_b64decode(cursor.encode()))
+        if not isinstance(rank, (int, float)) or not isinstance(pk, int):
+            raise InvalidCursor(cursor)
+        return rank, pk
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def lookup_users(queryset, text):
+    """
+    The users of `queryset` whose email starts with `text`, or whose first
+    or last name starts with each of its words, in name order.
+
+    Matching is case-insensitive, and each condition is served by one of
+    the (role, LOWER(column)) indexes of User when `queryset` is filtered
+    by role. An empty `text` matches nothing.
+    """
+    text = text.strip().lower()
+    if not text:
+        return queryset.none()
+    names = Q()
+    for word in WORD.findall(text):
+        names &= Q(first_name_lower__startswith=word) | Q(last_name_lower__startswith=word)
+    matches = Q(email_lower__startswith=text)
+    if names:
+        matches |= names
+    return queryset.alias(
+        email_lower=Lower('email'),
+        first_name_lower=Lower('first_name'),
+        last_name_lower=Lower('last_name'),
+    ).filter(matches).order_by('first_name', 'last_name', 'pk')
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import User, Ride, RideEvent
+from .sharding import shard_for_ride, sharding_enabled
 from django.utils import timezone
 from datetime import timedelta
 
@@ -24,6 +25,18 @@ class RideEventSerializer(serializers.ModelSerializer):
         fields = ['id_ride_event', 'id_ride', 'description', 'created_at']
         read_only_fields = ['id_ride_event', 'created_at']
 
+    def validate_id_ride(self, ride):
+        """
+        Keep an event on its shard: saving it through ShardRouter would
+        otherwise insert a copy on the new ride's shard (see rides/sharding.py).
+        """
+        if (
+            self.instance is not None and sharding_enabled() and
+            shard_for_ride(ride.pk) != shard_for_ride(self.instance.id_ride_id)
+        ):
+            raise serializers.ValidationError("A ride event can't be moved to a ride on another shard.")
+        return ride
+
 
 class RideSerializer(serializers.ModelSerializer):
     """
@@ -79,6 +92,9 @@ class RideSerializer(serializers.ModelSerializer):
         # Check if we have prefetched data
         if hasattr(obj, 'todays_ride_events_prefetch'):
             events = obj.todays_ride_events_prefetch
+            if events is None:
+                # Left out, as the prefetch timed out
+                return None
         else:
             # Fallback (not ideal - should use prefetch in ViewSet)
             cutoff_time = timezone.now() - timedelta(hours=24)
@@ -113,12 +129,44 @@ class RideListSerializer(serializers.ModelSerializer):
 
     def get_todays_ride_events(self, obj):
         """
-        Get today's ride events using prefetched data.
+        Get today's ride events using prefetched data (None when the
+        prefetch timed out).
         """
         if hasattr(obj, 'todays_ride_events_prefetch'):
             events = obj.todays_ride_events_prefetch
+            if events is None:
+                return None
         else:
             cutoff_time = timezone.now() - timedelta(hours=24)
             events = obj.ride_events.filter(created_at__gte=cutoff_time)
 
         return RideEventSerializer(events, many=True).data
+
+
+class RideChangeSerializer(serializers.ModelSerializer):
+    """
+    Flat ride representation for the change feed.
+    """
+    class Meta:
+        model = Ride
+        fields = [
+            'id_ride',
+            'status',
+            'id_rider',
+            'id_driver',
+            'pickup_latitude',
+            'pickup_longitude',
+            'dropoff_latitude',
+            'dropoff_longitude',
+            'pickup_time',
+            'updated_at',
+        ]
+
+
+class RideEventChangeSerializer(serializers.ModelSerializer):
+    """
+    Ride event representation for the change feed.
+    """
+    class Meta:
+        model = RideEvent
+        fields = ['id_ride_event', 'id_ride', 'description', 'created_at', 'updated_at']
@@ -0,0 +1,235 @@
+"""
+Hash-sharded storage of ride events.
+
+The ride_event table grows far faster than anything else. With
+RIDE_EVENT_SHARDS set to a list of database aliases, ride events are
+stored across those databases instead of the primary, each ride's events
+together on the shard its id hashes to:
+
+    RIDE_EVENT_SHARDS = ['events_0', 'events_1']
+
+Every shard has the full schema (so migrations run unchanged) but only
+its ride_event table holds rows; rides and users stay on the primary.
+Shards have no foreign key from ride_event to ride, which the primary
+keeps.
+`python manage.py setup_ride_event_shards` sets the ride_event id
+sequence of shard i of N to i+1, i+1+N, i+1+2N, ..., which keeps ids
+unique across shards and lets an event be found from its id alone.
+
+ShardRouter sends the writes of an event, and reads through a ride
+(`ride.ride_events.all()`), to the right shard. Other RideEvent queries
+have to pick the database themselves:
+
+- Queries about one ride: `queryset.using(shard_for_ride(id_ride))`
+- Queries about one event: `queryset.using(shard_for_event(pk))`
+- Everything else: `ScatterGather(queryset)` runs the query on every
+  shard and merges the results in the queryset's order.
+
+An event can't be moved to a ride on another shard (its id would no
+longer tell its shard): the API rejects it. Events aren't moved when the
+list of shards changes either: enable sharding before storing events, or
+copy them over with their ids. The admin, the
+sample data and benchmark commands only see the primary's ride_event.
+"""
+from collections import defaultdict
+from django.conf import settings
+from django.db import connections
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils import timezone
+from datetime import timedelta
+from hashlib import blake2b
+from operator import attrgetter
+
+from .models import Ride, RideEvent
+from .replicas import PRIMARY_ALIAS, REPLICA_ALIAS, current_routing, reading_from_replica
+
+
+def shard_aliases():
+    return list(settings.RIDE_EVENT_SHARDS)
+
+
+def sharding_enabled():
+    return bool(settings.RIDE_EVENT_SHARDS)
+
+
+def shard_index(id_ride, shard_count):
+    """
+    The shard (0 to shard_count - 1) holding a ride's events.
+
+    The id is hashed rather than taken modulo the shard count, so ids
+    handed out in patterns (e.g. by a sequence with an increment) still
+    spread evenly.
+    """
+    digest = blake2b(int(id_ride).to_bytes(8, 'big', signed=True), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def shard_for_ride(id_ride):
+    """
+    The database alias holding the events of ride `id_ride`.
+    """
+    aliases = shard_aliases()
+    return aliases[shard_index(id_ride, len(aliases))]
+
+
+def shard_for_event(pk):
+    """
+    The database alias holding ride event `pk`, from its id's offset (see
+    setup_sequences()).
+    """
+    aliases = shard_aliases()
+    return aliases[(int(pk) - 1) % len(aliases)]
+
+
+def setup_sequences():
+    """
+    Make the ride_event id sequence of shard i of N hand out i+1 + k*N,
+    continuing after the highest id stored on any shard.
+
+    Returns {alias: next id}.
+    """
+    aliases = shard_aliases()
+    count = len(aliases)
+    table = RideEvent._meta.db_table
+    column = RideEvent._meta.pk.column
+
+    highest = 0
+    for alias in aliases:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f'SELECT coalesce(max({column}), 0) FROM {table}')
+            highest = max(highest, cursor.fetchone()[0])
+
+    next_ids = {}
+    for index, alias in enumerate(aliases):
+        # The first id above `highest` that belongs to this shard
+        next_id = highest + 1 + (index - highest) % count
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, column])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f'ALTER SEQUENCE {sequence} INCREMENT BY {count} RESTART WITH {next_id}')
+        next_ids[alias] = next_id
+    return next_ids
+
+
+class ScatterGather:
+    """
+    A RideEvent queryset run on every shard, with the results merged.
+
+    Supports what pagination and the list views need: count(), slicing
+    and iteration. Each slice fetches up to its end from every shard and
+    merges the rows in the queryset's ordering, so deep pages cost more
+    than on a single database; shards are queried one after the other.
+    """
+
+    def __init__(self, queryset, aliases=None):
+        self.queryset = queryset
+        self.aliases = aliases if aliases is not None else shard_aliases()
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        # The primary key breaks ties, as ids are unique across shards
+        self.ordering = ordering + ['pk']
+        self.model = queryset.model
+
+    def count(self):
+        return sum(self.queryset.using(alias).count() for alias in self.aliases)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+            raise ValueError('ScatterGather supports non-negative slices without a step')
+        rows = []
+        for alias in self.aliases:
+            queryset = self.queryset.using(alias)
+            rows.extend(queryset[:key.stop] if key.stop is not None else queryset)
+        return self.merge(rows)[key.start:key.stop]
+
+    def merge(self, rows):
+        # Stable sorts from the least to the most significant field
+        for field in reversed(self.ordering):
+            name = field.lstrip('-')
+            rows.sort(key=attrgetter(name), reverse=field.startswith('-'))
+        return rows
+
+
+def events_queryset(queryset, id_ride=None):
+    """
+    Run a RideEvent queryset where its rows are: on the shard of `id_ride`
+    when given, otherwise on every shard.
+    """
+    if not sharding_enabled():
+        return queryset
+    if id_ride is not None:
+        return queryset.using(shard_for_ride(id_ride))
+    return ScatterGather(queryset)
+
+
+def prefetch_todays_events(rides):
+    """
+    Shard-aware version of the today's events prefetch (see
+    rides.views.todays_events_prefetch): one query per shard holding any
+    of the rides, instead of one per ride.
+    """
+    cutoff_time = timezone.now() - timedelta(hours=24)
+    by_shard = defaultdict(list)
+    for ride in rides:
+        by_shard[shard_for_ride(ride.pk)].append(ride)
+
+    for alias, shard_rides in by_shard.items():
+        prefetch_related_objects(shard_rides, Prefetch(
+            'ride_events',
+            queryset=RideEvent.objects.using(alias).filter(created_at__gte=cutoff_time).order_by('-created_at'),
+            to_attr='todays_ride_events_prefetch',
+        ))
+    return rides
+
+
+class ShardRouter:
+    """
+    Route ride events to their shard, when RIDE_EVENT_SHARDS is set.
+
+    Goes before ReplicaRouter, which decides for everything it leaves
+    alone (by returning None).
+    """
+
+    def db_for_read(self, model, **hints):
+        if not sharding_enabled():
+            return None
+        instance = hints.get('instance')
+        if model is RideEvent:
+            if isinstance(instance, Ride) and instance.pk is not None:
+                # The events of a ride
+                return shard_for_ride(instance.pk)
+            if isinstance(instance, RideEvent) and instance._state.db:
+                return instance._state.db
+        elif isinstance(instance, RideEvent):
+            # The ride of an event lives on the primary, not on the shard
+            return REPLICA_ALIAS if reading_from_replica() else PRIMARY_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not sharding_enabled() or model is not RideEvent:
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, RideEvent) and instance.id_ride_id is not None:
+            id_ride = instance.id_ride_id
+        elif isinstance(instance, Ride) and instance.pk is not None:
+            # e.g. ride.ride_events.update(...)
+            id_ride = instance.pk
+        else:
+            return None
+        state = current_routing.get()
+        if state is not None:
+            # Later reads of the request stay off the replica
+            state.wrote = True
+        return shard_for_ride(id_ride)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if sharding_enabled() and {type(obj1), type(obj2)} == {Ride, RideEvent}:
+            return True
+        return None
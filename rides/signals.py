@@ -0,0 +1,63 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .event_stream import publish_ride_event
+from .local_cache import invalidate, user_role_key
+from .models import Ride, RideEvent, User
+from .sharding import shard_for_ride, sharding_enabled
+
+
+@receiver(post_save, sender=RideEvent)
+def ride_event_created(sender, instance, created, using, raw=False, **kwargs):
+    """
+    Push newly created ride events to the event stream.
+    """
+    if created and not raw:
+        publish_ride_event(instance, using=using)
+
+
+def cache_keys(user):
+    """
+    Local cache keys that go stale when `user` changes: its role, under its
+    current and previous email.
+    """
+    keys = [user_role_key(user.email)]
+    previous_email = getattr(user, '_previous_email', None)
+    if previous_email:
+        keys.append(user_role_key(previous_email))
+    return keys
+
+
+@receiver(pre_save, sender=User)
+def remember_previous_email(sender, instance, raw=False, **kwargs):
+    """
+    Keep the stored email, so the role cached under it can be evicted too.
+    """
+    if instance.pk is not None and not raw:
+        instance._previous_email = (
+            User.objects.filter(pk=instance.pk).values_list('email', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_rows(sender, instance, using, **kwargs):
+    """
+    Evict the cached role of a changed user in every worker.
+
+    Users are the only rows the local cache holds (see get_or_fill()), so
+    rides and ride events, written far more often, send nothing.
+    """
+    invalidate(cache_keys(instance), using=using)
+
+
+@receiver(post_delete, sender=Ride)
+def delete_sharded_ride_events(sender, instance, using, **kwargs):
+    """
+    Delete a ride's events from its shard, which the cascade of the delete
+    (run in the ride's database) doesn't reach.
+    """
+    if sharding_enabled():
+        shard = shard_for_ride(instance.pk)
+        if shard != using:
+            RideEvent.objects.using(shard).filter(id_ride=instance.pk).delete()
@@ -0,0 +1,89 @@
+"""
+Slow query log.
+
+MetricsMiddleware's execute wrapper notes every statement that takes at
+least SLOW_QUERY_THRESHOLD_MS. Once the response is ready they are saved
+as SlowQueryLog rows with the route and query string of the request, so a
+filter combination that turns into a sequential scan shows up in the
+Django admin.
+
+A sample of them (SLOW_QUERY_EXPLAIN_RATE) also gets its plan from
+`EXPLAIN (FORMAT JSON)`. EXPLAIN without ANALYZE only plans the statement,
+so this doesn't run the slow query again. The table is a ring buffer
+holding the latest SLOW_QUERY_LOG_SIZE entries.
+"""
+from django.conf import settings
+from django.db import connections
+import json
+import logging
+import random
+
+from .metrics import route_name
+from .models import SlowQueryLog
+
+logger = logging.getLogger(__name__)
+
+# Statements EXPLAIN accepts
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+
+def format_params(params):
+    if params is None:
+        return ''
+    return json.dumps(params, default=str)
+
+
+def explain(alias, sql, params):
+    """
+    Return the JSON plan of a statement, or None if it can't be explained.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql' or connection.needs_rollback:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+    except Exception:
+        logger.warning('Could not EXPLAIN slow query', exc_info=True)
+        return None
+    # psycopg2 decodes json columns, but be safe with other drivers
+    return json.loads(plan) if isinstance(plan, str) else plan
+
+
+def record_slow_queries(request, timings):
+    """
+    Save the slow statements of a request to the slow query log.
+    """
+    if not timings.slow_queries:
+        return
+
+    entries = []
+    for alias, sql, params, many, duration in timings.slow_queries:
+        plan = None
+        if (
+            not many and sql.lstrip().lower().startswith(EXPLAINABLE) and
+            random.random() < settings.SLOW_QUERY_EXPLAIN_RATE
+        ):
+            plan = explain(alias, sql, params)
+
+        logger.warning('Slow query (%.0f ms) in %s: %s', duration * 1000, request.path, sql)
+        entries.append(SlowQueryLog(
+            duration_ms=duration * 1000,
+            route=route_name(request) or '',
+            method=request.method,
+            path=request.path[:500],
+            query_string=request.META.get('QUERY_STRING', ''),
+            database=alias,
+            sql=sql,
+            params=format_params(params),
+            plan=plan,
+        ))
+
+    try:
+        entries = SlowQueryLog.objects.bulk_create(entries)
+        # Keep only the latest entries
+        oldest_kept = entries[-1].pk - settings.SLOW_QUERY_LOG_SIZE
+        SlowQueryLog.objects.filter(pk__lte=oldest_kept).delete()
+    except Exception:
+        logger.exception('Could not save the slow query log')
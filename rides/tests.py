@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 from django.urls import reverse
 from django.contrib.auth import get_user_model
@@ -8,6 +8,7 @@ from datetime import timedelta
 from decimal import Decimal
 from .models import User, Ride, RideEvent
 from .serializers import RideSerializer, RideEventSerializer
+from .budgets import performance_budget
 
 
 class RideModelTest(TestCase):
@@ -146,6 +147,18 @@ class RideEventModelTest(TestCase):
         self.assertGreaterEqual(event.created_at, before)
         self.assertLessEqual(event.created_at, after)
 
+    def test_events_need_an_existing_ride(self):
+        """Test that unsharded databases keep the foreign key to rides"""
+        from django.db import IntegrityError, connection, transaction
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO ride_event (id_ride, description, created_at, updated_at) "
+                    "VALUES (%s, 'Orphan', now(), now())",
+                    [self.ride.id_ride + 1000]
+                )
+            connection.check_constraints()
+
 
 class RideSerializerTest(TestCase):
     """Test the Ride serializer"""
@@ -625,3 +638,2679 @@ class PerformanceOptimizationTest(APITestCase):
             # Allow some flexibility for session queries, but should not exceed 5
             self.assertLessEqual(query_count, 5,
                 f"Too many queries executed: {query_count}. Expected <= 5.")
+
+
+class StreamingListTest(APITestCase):
+    """Test streamed list responses for large pages"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        self.rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        Ride.objects.bulk_create([
+            Ride(
+                status='en-route',
+                id_rider=self.rider,
+                id_driver=self.driver,
+                pickup_latitude=37.7749,
+                pickup_longitude=-122.4194,
+                dropoff_latitude=37.7849,
+                dropoff_longitude=-122.4094,
+                pickup_time=timezone.now() - timedelta(minutes=i)
+            )
+            for i in range(120)
+        ])
+
+    def create_users(self, count, offset=0):
+        User.objects.bulk_create([
+            User(
+                role='rider',
+                first_name=f'Rider{i}',
+                last_name='Streamed',
+                email=f'stream{i}@example.com',
+                phone_number='+1555000000'
+            )
+            for i in range(offset, offset + count)
+        ])
+
+    def consume_with_peak_memory(self, response):
+        """Consume a streamed response chunk by chunk, returning the peak allocation"""
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            size = 0
+            for chunk in response.streaming_content:
+                size += len(chunk)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_small_pages_are_not_streamed(self):
+        """Test that default-sized pages use the regular response"""
+        response = self.client.get(reverse('ride-list'))
+        self.assertFalse(response.streaming)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_large_page_is_streamed(self):
+        """Test that a large page is streamed with the usual envelope"""
+        import json
+        response = self.client.get(reverse('ride-list'), {'page_size': 100})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(list(data.keys()), ['count', 'count_approximate', 'next', 'previous', 'results'])
+        self.assertEqual(data['count'], 120)
+        self.assertEqual(len(data['results']), 100)
+        self.assertIn('page=2', data['next'])
+        self.assertIn('todays_ride_events', data['results'][0])
+
+    def test_streamed_output_matches_regular_rendering(self):
+        """Test that streaming doesn't change the JSON document"""
+        url = reverse('ride-list')
+        with self.settings(API_STREAMING_MIN_PAGE_SIZE=1000):
+            regular = self.client.get(url, {'page_size': 100}).content
+        streamed = b''.join(self.client.get(url, {'page_size': 100}).streaming_content)
+        self.assertEqual(streamed, regular)
+
+    def test_page_size_is_capped(self):
+        """Test that page_size can't exceed API_MAX_PAGE_SIZE"""
+        with self.settings(API_MAX_PAGE_SIZE=20):
+            response = self.client.get(reverse('ride-list'), {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 20)
+
+    def test_user_list_peak_memory_is_bounded(self):
+        """Test that streaming peak memory doesn't grow with the number of rows"""
+        url = reverse('user-list')
+        self.create_users(1000)
+        small_peak = self.consume_with_peak_memory(self.client.get(url))
+
+        self.create_users(5000, offset=1000)
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        large_peak = self.consume_with_peak_memory(response)
+
+        self.assertLess(large_peak, small_peak * 2,
+            f"Peak memory grew from {small_peak} to {large_peak} bytes with 6x the rows.")
+
+
+class FastRendererTest(APITestCase):
+    """Test the orjson and MessagePack renderers and parsers"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        self.rider = User.objects.create(
+            role='rider',
+            first_name='Zoë',
+            last_name='Rider\u2028',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        self.ride = Ride.objects.create(
+            status='en-route',
+            id_rider=self.rider,
+            id_driver=self.driver,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+        RideEvent.objects.create(id_ride=self.ride, description='Driver en route')
+
+    def test_orjson_output_matches_json_renderer(self):
+        """Test that the orjson renderer produces byte-identical JSON"""
+        from rest_framework.renderers import JSONRenderer
+        from .renderers import ORJSONRenderer, orjson
+        if orjson is None:
+            self.skipTest('orjson is not installed')
+
+        response = self.client.get(reverse('ride-list'))
+        data = response.data
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            ORJSONRenderer().render({'when': self.ride.pickup_time, 'big': 2 ** 70}),
+            JSONRenderer().render({'when': self.ride.pickup_time, 'big': 2 ** 70})
+        )
+
+    def test_orjson_float_differences(self):
+        """Test the documented float differences from the JSON renderer"""
+        import json
+        from rest_framework.renderers import JSONRenderer
+        from .renderers import ORJSONRenderer, orjson
+        if orjson is None:
+            self.skipTest('orjson is not installed')
+
+        floats = [1e16, 1e-05, 0.1]
+        self.assertEqual(ORJSONRenderer().render(floats), b'[1e16,0.00001,0.1]')
+        self.assertEqual(JSONRenderer().render(floats), b'[1e+16,1e-05,0.1]')
+        self.assertEqual(json.loads(ORJSONRenderer().render(floats)), floats)
+
+        self.assertEqual(ORJSONRenderer().render([float('nan'), float('inf')]), b'[null,null]')
+        with self.assertRaises(ValueError):
+            JSONRenderer().render([float('nan')])
+
+    def test_msgpack_content_negotiation(self):
+        """Test that Accept: application/msgpack returns MessagePack"""
+        from .renderers import msgpack
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+
+        url = reverse('ride-detail', kwargs={'pk': self.ride.id_ride})
+        json_data = self.client.get(url).json()
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), json_data)
+
+    def test_msgpack_request_body(self):
+        """Test that rides can be updated with a MessagePack body"""
+        from .renderers import msgpack
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+
+        url = reverse('ride-detail', kwargs={'pk': self.ride.id_ride})
+        response = self.client.patch(
+            url, msgpack.packb({'status': 'pickup'}), content_type='application/msgpack'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, 'pickup')
+
+
+class AsyncRideEndpointTest(TestCase):
+    """Test the async versions of the ride endpoints"""
+
+    def setUp(self):
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_login(self.django_user)
+        self.async_client.force_login(self.django_user)
+
+        self.rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        self.near_ride = Ride.objects.create(
+            status='pickup',
+            id_rider=self.rider,
+            id_driver=self.driver,
+            pickup_latitude=37.7849,
+            pickup_longitude=-122.4294,
+            dropoff_latitude=37.7949,
+            dropoff_longitude=-122.4394,
+            pickup_time=timezone.now() - timedelta(hours=1)
+        )
+        self.far_ride = Ride.objects.create(
+            status='en-route',
+            id_rider=self.rider,
+            id_driver=self.driver,
+            pickup_latitude=38.5816,
+            pickup_longitude=-121.4944,
+            dropoff_latitude=38.5916,
+            dropoff_longitude=-121.4844,
+            pickup_time=timezone.now()
+        )
+        RideEvent.objects.create(id_ride=self.near_ride, description='Driver en route')
+        RideEvent.objects.create(id_ride=self.far_ride, description='Driver assigned')
+
+    async def get_both(self, sync_url, async_url, params=None):
+        """Fetch the same resource from the DRF view and its async version"""
+        from asgiref.sync import sync_to_async
+        sync_response = await sync_to_async(self.client.get)(sync_url, params)
+        async_response = await self.async_client.get(async_url, params)
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        return sync_response.json(), async_response.json()
+
+    async def test_ride_list_matches_sync_view(self):
+        """Test that the async ride list returns the same data"""
+        expected, data = await self.get_both(reverse('ride-list'), reverse('async-ride-list'))
+        self.assertEqual(data, expected)
+        self.assertEqual(data['count'], 2)
+
+    async def test_ride_list_filter_and_distance_sort(self):
+        """Test filtering and GPS sorting on the async ride list"""
+        params = {'latitude': 37.7849, 'longitude': -122.4294}
+        expected, data = await self.get_both(reverse('ride-list'), reverse('async-ride-list'), params)
+        self.assertEqual(data, expected)
+        self.assertEqual(data['results'][0]['id_ride'], self.near_ride.id_ride)
+
+        response = await self.async_client.get(reverse('async-ride-list'), {'status': 'en-route'})
+        self.assertEqual([r['id_ride'] for r in response.json()['results']], [self.far_ride.id_ride])
+
+    async def test_ride_detail_matches_sync_view(self):
+        """Test that the async ride detail returns the same data"""
+        expected, data = await self.get_both(
+            reverse('ride-detail', kwargs={'pk': self.near_ride.id_ride}),
+            reverse('async-ride-detail', kwargs={'pk': self.near_ride.id_ride}),
+        )
+        self.assertEqual(data, expected)
+        self.assertEqual(len(data['ride_events']), 1)
+
+        response = await self.async_client.get(reverse('async-ride-detail', kwargs={'pk': 0}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_ride_event_list_matches_sync_view(self):
+        """Test that the async ride event list returns the same data"""
+        params = {'id_ride': self.far_ride.id_ride}
+        expected, data = await self.get_both(
+            reverse('rideevent-list'), reverse('async-rideevent-list'), params
+        )
+        self.assertEqual(data, expected)
+        self.assertEqual(data['count'], 1)
+
+        for id_ride in ('ride', '²'):
+            response = await self.async_client.get(reverse('async-rideevent-list'), {'id_ride': id_ride})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_unauthenticated_access_denied(self):
+        """Test that the async endpoints require an admin session"""
+        await self.async_client.alogout()
+        response = await self.async_client.get(reverse('async-ride-list'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_middleware_chain_stays_async(self):
+        """Test that no middleware puts the ASGI chain in a thread, production's included"""
+        from unittest import mock
+        from asgiref.sync import SyncToAsync
+        from django.conf import settings
+        from django.core.handlers.asgi import ASGIHandler
+        from django.core.handlers.base import BaseHandler
+        adapted = []
+        adapt_method_mode = BaseHandler.adapt_method_mode
+
+        def spy(handler, is_async, method, method_is_async=None, debug=False, name=None):
+            adapted_method = adapt_method_mode(handler, is_async, method, method_is_async, debug, name)
+            # process_view() and the like are adapted per call, like Django's own
+            if name and adapted_method is not method:
+                adapted.append(name)
+            return adapted_method
+
+        middleware = list(settings.MIDDLEWARE)
+        middleware.insert(1, 'rides.middleware.StaticFilesMiddleware')
+        with self.settings(MIDDLEWARE=middleware), mock.patch.object(BaseHandler, 'adapt_method_mode', spy):
+            handler = ASGIHandler()
+        self.assertEqual(adapted, [])
+        self.assertNotIsInstance(handler._middleware_chain, SyncToAsync)
+
+    async def test_async_requests_are_measured(self):
+        """Test that the metrics, Server-Timing and profiling see the SQL of async views"""
+        response = await self.async_client.get(reverse('async-ride-list'), {'server_timing': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'], r'desc="[1-9]\d* queries"')
+
+        response = await self.async_client.get(reverse('async-ride-list'), {'profile': 1})
+        report = response.json()
+        self.assertEqual(report['status_code'], 200)
+        self.assertTrue(report['functions'])
+        self.assertTrue(any('FROM "ride"' in query['sql'] for query in report['sql']))
+
+
+class ChangeFeedAPITest(APITestCase):
+    """Test the rides and ride events change feed"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        self.rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        self.rides = [
+            Ride.objects.create(
+                status='en-route',
+                id_rider=self.rider,
+                id_driver=self.driver,
+                pickup_latitude=37.7749,
+                pickup_longitude=-122.4194,
+                dropoff_latitude=37.7849,
+                dropoff_longitude=-122.4094,
+                pickup_time=timezone.now()
+            )
+            for i in range(3)
+        ]
+        RideEvent.objects.create(id_ride=self.rides[0], description='Driver en route')
+
+    def get_changes(self, **params):
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0):
+            response = self.client.get(reverse('changes'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_initial_feed_returns_everything(self):
+        """Test that the feed starts from the beginning without a cursor"""
+        data = self.get_changes()
+        self.assertEqual([r['id_ride'] for r in data['rides']], [r.id_ride for r in self.rides])
+        self.assertEqual(len(data['ride_events']), 1)
+        self.assertIn('updated_at', data['rides'][0])
+        self.assertFalse(data['has_more'])
+
+    def test_feed_returns_only_rows_changed_after_cursor(self):
+        """Test that a cursor only sees later creates and updates"""
+        cursor = self.get_changes()['next']
+        self.assertEqual(self.get_changes(since=cursor)['rides'], [])
+
+        self.rides[1].status = 'pickup'
+        self.rides[1].save()
+        RideEvent.objects.create(id_ride=self.rides[1], description='Passenger picked up')
+
+        data = self.get_changes(since=cursor)
+        self.assertEqual([r['id_ride'] for r in data['rides']], [self.rides[1].id_ride])
+        self.assertEqual(data['rides'][0]['status'], 'pickup')
+        self.assertEqual([e['description'] for e in data['ride_events']], ['Passenger picked up'])
+
+    def test_feed_is_batched(self):
+        """Test that batches are bounded by limit and resume from the cursor"""
+        data = self.get_changes(limit=2)
+        self.assertEqual(len(data['rides']), 2)
+        self.assertTrue(data['has_more'])
+
+        data = self.get_changes(since=data['next'], limit=2)
+        self.assertEqual([r['id_ride'] for r in data['rides']], [self.rides[2].id_ride])
+        self.assertFalse(data['has_more'])
+
+    def test_recent_changes_are_held_back(self):
+        """Test that rows inside the settle window wait for the next poll"""
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=60):
+            response = self.client.get(reverse('changes'))
+        self.assertEqual(response.data['rides'], [])
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.client.get(reverse('changes'), {'since': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RideEventStreamTest(TransactionTestCase):
+    """Test the ride event stream (NOTIFY is only delivered on commit)"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        self.rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        self.ride = Ride.objects.create(
+            status='pickup',
+            id_rider=self.rider,
+            id_driver=self.driver,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+        self.other_ride = Ride.objects.create(
+            status='en-route',
+            id_rider=self.rider,
+            id_driver=self.driver,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+
+    def tearDown(self):
+        from .event_stream import hub
+        from .notifications import listener
+        listener.stop()
+        hub.reset()
+
+    def test_hub_receives_committed_events(self):
+        """Test that creating an event notifies matching subscriptions only"""
+        from .event_stream import hub
+        by_status = hub.subscribe(status='pickup')
+        by_ride = hub.subscribe(id_ride=self.other_ride.id_ride)
+
+        event = RideEvent.objects.create(id_ride=self.ride, description='Passenger picked up')
+
+        message = by_status.queue.get(timeout=5)
+        self.assertEqual(message['event']['id_ride_event'], event.id_ride_event)
+        self.assertEqual(message['status'], 'pickup')
+        self.assertTrue(by_ride.queue.empty())
+
+    def test_stream_endpoint(self):
+        """Test that the stream sends new events for the requested ride"""
+        import json
+        response = self.client.get(
+            reverse('rideevent-stream'), {'id_ride': self.ride.id_ride, 'timeout': 5}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = iter(response.streaming_content)
+        self.assertEqual(next(chunks), b'retry: 1000\n\n')
+
+        RideEvent.objects.create(id_ride=self.other_ride, description='Driver assigned')
+        event = RideEvent.objects.create(id_ride=self.ride, description='Driver en route')
+
+        lines = next(chunks).decode().splitlines()
+        self.assertEqual(lines[0], f'id: {event.id_ride_event}')
+        self.assertEqual(lines[1], 'event: ride_event')
+        self.assertEqual(json.loads(lines[2][len('data: '):])['description'], 'Driver en route')
+        response.close()
+
+    def test_stream_replays_missed_events(self):
+        """Test that reconnecting with Last-Event-ID replays the backlog"""
+        first = RideEvent.objects.create(id_ride=self.ride, description='Driver assigned')
+        missed = RideEvent.objects.create(id_ride=self.ride, description='Driver en route')
+
+        response = self.client.get(
+            reverse('rideevent-stream'), {'timeout': 1},
+            HTTP_LAST_EVENT_ID=str(first.id_ride_event)
+        )
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn(f'id: {missed.id_ride_event}', content)
+        self.assertNotIn(f'id: {first.id_ride_event}\n', content)
+
+    def test_stream_rejects_invalid_filters(self):
+        """Test that invalid filters are rejected before streaming"""
+        response = self.client.get(reverse('rideevent-stream'), {'status': 'flying'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(RIDE_EVENT_STREAM_MAX_CONNECTIONS=1)
+    def test_stream_connection_limit(self):
+        """Test that a process turns streams away once it has too many open"""
+        url = reverse('rideevent-stream')
+        first = self.client.get(url, {'timeout': 5})
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url, {'timeout': 5})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '5')
+
+        # Closing a stream frees its place
+        first.close()
+        response = self.client.get(url, {'timeout': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response.close()
+
+
+class LocalCacheInvalidationTest(TransactionTestCase):
+    """Test the local cache and its invalidation over NOTIFY"""
+
+    def setUp(self):
+        self.admin = User.objects.create(
+            role='admin',
+            first_name='Admin',
+            last_name='User',
+            email='admin@example.com',
+            phone_number='+1234567890'
+        )
+
+    def tearDown(self):
+        from .local_cache import bus, get_cache
+        from .notifications import listener
+        listener.stop()
+        bus.reset()
+        get_cache().clear()
+
+    def test_role_lookup_is_cached(self):
+        """Test that role lookups only query the database once"""
+        from .permissions import get_user_role
+        self.assertEqual(get_user_role('admin@example.com'), 'admin')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_role('admin@example.com'), 'admin')
+            self.assertEqual(get_user_role('admin@example.com'), 'admin')
+
+    def test_saving_user_evicts_role(self):
+        """Test that changing a user's role or email evicts the cached role"""
+        from .permissions import get_user_role
+        self.assertEqual(get_user_role('admin@example.com'), 'admin')
+
+        self.admin.role = 'rider'
+        self.admin.save()
+        self.assertEqual(get_user_role('admin@example.com'), 'rider')
+
+        self.admin.email = 'former-admin@example.com'
+        self.admin.save()
+        self.assertIsNone(get_user_role('admin@example.com'))
+
+    def test_deleting_user_evicts_role(self):
+        """Test that deleting a user evicts the cached role"""
+        from .permissions import get_user_role
+        self.assertEqual(get_user_role('admin@example.com'), 'admin')
+        self.admin.delete()
+        self.assertIsNone(get_user_role('admin@example.com'))
+
+    def test_invalidation_from_another_process(self):
+        """Test that invalidations sent by other processes evict entries"""
+        import json
+        import time
+        from .local_cache import INVALIDATION_CHANNEL, get_cache, get_or_fill
+        from .notifications import notify
+
+        get_or_fill('ride:1', lambda: 'cached ride')
+        # What another worker sends after saving ride 1
+        notify(INVALIDATION_CHANNEL, json.dumps(['ride:1']))
+
+        deadline = time.monotonic() + 5
+        while get_cache().get('ride:1') is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(get_cache().get('ride:1'))
+
+    def test_fill_racing_an_invalidation_is_not_stored(self):
+        """Test that a value read before an invalidation isn't cached after it"""
+        from .local_cache import get_cache, get_or_fill, invalidate
+
+        def fill():
+            # The row changes while the old value is being read
+            invalidate(['user-role:racing@example.com'])
+            return 'stale'
+
+        self.assertEqual(get_or_fill('user-role:racing@example.com', fill), 'stale')
+        self.assertIsNone(get_cache().get('user-role:racing@example.com'))
+        self.assertEqual(get_or_fill('user-role:racing@example.com', lambda: 'fresh'), 'fresh')
+        self.assertEqual(get_cache().get('user-role:racing@example.com'), 'fresh')
+
+    def test_rides_and_events_send_no_invalidations(self):
+        """Test that only users, the rows the cache holds, send invalidations"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            ride = Ride.objects.create(
+                status='pickup', id_rider=self.admin, id_driver=self.admin,
+                pickup_latitude=37.7749, pickup_longitude=-122.4194,
+                dropoff_latitude=37.8049, dropoff_longitude=-122.4294,
+                pickup_time=timezone.now()
+            )
+            RideEvent.objects.create(id_ride=ride, description='Driver assigned')
+            ride.delete()
+        self.assertFalse([query for query in queries if 'cache_invalidation' in query['sql']])
+
+    def test_admin_permission_uses_cached_role(self):
+        """Test that the admin permission check reads the cached role"""
+        from django.contrib.auth.models import User as DjangoUser
+        django_user = DjangoUser.objects.create_user(
+            username='roleadmin',
+            password='testpass123',
+            email='admin@example.com'
+        )
+        client = APIClient()
+        client.force_authenticate(user=django_user)
+        url = reverse('user-list')
+
+        self.assertEqual(client.get(url).status_code, status.HTTP_200_OK)
+        self.admin.role = 'rider'
+        self.admin.save()
+        self.assertEqual(client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class SingleFlightTest(APITestCase):
+    """Test sharing the result of identical concurrent ride list requests"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        driver = User.objects.create(
+            role='driver',
+            first_name='Bob',
+            last_name='Driver',
+            email='driver@example.com',
+            phone_number='+2222222222'
+        )
+        for i in range(3):
+            Ride.objects.create(
+                status='pickup',
+                id_rider=rider,
+                id_driver=driver,
+                pickup_latitude=37.7749 + i,
+                pickup_longitude=-122.4194,
+                dropoff_latitude=37.7849,
+                dropoff_longitude=-122.4094,
+                pickup_time=timezone.now()
+            )
+
+    def tearDown(self):
+        from django.core.cache import caches
+        caches['default'].clear()
+
+    def test_concurrent_calls_share_one_computation(self):
+        """Test that concurrent calls with the same key compute once"""
+        import threading
+        import time
+        from .coalescing import SingleFlight
+        flight = SingleFlight('test')
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'rides': [1, 2, 3]}
+
+        def call():
+            results.append(flight.do('key', compute))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=call) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        # Give the followers time to start waiting on the leader
+        time.sleep(0.2)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result == {'rides': [1, 2, 3]} for result in results))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.flights, {})
+
+    def test_errors_are_raised_in_waiting_calls(self):
+        """Test that an error while computing reaches every waiting call"""
+        import threading
+        from .coalescing import SingleFlight
+        flight = SingleFlight('test')
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def compute():
+            started.set()
+            release.wait(5)
+            raise ValueError('boom')
+
+        def call():
+            try:
+                flight.do('key', compute)
+            except ValueError as exc:
+                errors.append(exc)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(errors), 2)
+
+    def test_query_params_are_normalized(self):
+        """Test that parameter order doesn't change the request key"""
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from .coalescing import request_key
+        factory = APIRequestFactory()
+        first = Request(factory.get('/api/rides/?latitude=1&longitude=2&status=pickup'))
+        second = Request(factory.get('/api/rides/?status=pickup&longitude=2&latitude=1'))
+        self.assertEqual(request_key(first), request_key(second))
+
+    def test_result_shared_across_workers(self):
+        """Test that other workers read the result from the shared cache"""
+        from django.test import override_settings
+        url = reverse('ride-list')
+        params = {'latitude': 37.7749, 'longitude': -122.4194}
+
+        with override_settings(SINGLE_FLIGHT_CACHE_ALIAS='default'):
+            first = self.client.get(url, params)
+            with self.assertNumQueries(0):
+                second = self.client.get(url, params)
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.json()['count'], 3)
+
+
+class MetricsTest(APITestCase):
+    """Test the per-route Prometheus metrics"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        Ride.objects.create(
+            status='pickup',
+            id_rider=rider,
+            id_driver=rider,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+
+    def sample(self, name, **labels):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_recorded_per_route(self):
+        """Test that a request updates the metrics of its route"""
+        requests = self.sample('api_requests_total', route='ride-list', method='GET', status='200')
+        queries = self.sample('api_request_db_queries_sum', route='ride-list')
+        responses = self.sample('api_response_size_bytes_count', route='ride-list')
+
+        response = self.client.get(reverse('ride-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(
+            self.sample('api_requests_total', route='ride-list', method='GET', status='200'),
+            requests + 1
+        )
+        # Count, rides, today's events
+        self.assertEqual(self.sample('api_request_db_queries_sum', route='ride-list'), queries + 3)
+        self.assertEqual(self.sample('api_response_size_bytes_count', route='ride-list'), responses + 1)
+        self.assertGreater(self.sample('api_request_serialize_seconds_count', route='ride-list'), 0)
+        self.assertGreater(self.sample('api_request_render_seconds_count', route='ride-list'), 0)
+
+    def test_metrics_endpoint(self):
+        """Test that admins can read the metrics in text format"""
+        self.client.get(reverse('ride-list'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'api_request_duration_seconds_bucket{', response.content)
+        self.assertIn(b'route="ride-list"', response.content)
+
+    def test_metrics_token(self):
+        """Test that scrapers can authenticate with the metrics token"""
+        from django.test import override_settings
+        client = APIClient()
+        url = reverse('metrics')
+        self.assertEqual(client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(METRICS_TOKEN='scrape-secret'):
+            response = client.get(url, HTTP_AUTHORIZATION='Bearer scrape-secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = client.get(url, HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ServerTimingTest(APITestCase):
+    """Test the opt-in Server-Timing header"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+        self.url = reverse('ride-list')
+
+    def test_header_is_opt_in(self):
+        """Test that responses have no Server-Timing header by default"""
+        response = self.client.get(self.url)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_admin_requests_header(self):
+        """Test that admins get the breakdown with a query param or header"""
+        for response in [
+            self.client.get(self.url, {'server_timing': 1}),
+            self.client.get(self.url, HTTP_X_SERVER_TIMING='1'),
+        ]:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            names = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+            self.assertEqual(names, ['db', 'permissions', 'serialize', 'render', 'total'])
+            self.assertIn('db;dur=', response['Server-Timing'])
+            self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    def test_non_admin_cannot_request_header(self):
+        """Test that non-admin users don't get the header"""
+        from django.contrib.auth.models import User as DjangoUser
+        user = DjangoUser.objects.create_user(username='rider', password='testpass123')
+        self.client.force_authenticate(user=user)
+        response = self.client.get(self.url, {'server_timing': 1})
+        self.assertNotIn('Server-Timing', response)
+
+    def test_enabled_for_everyone(self):
+        """Test that SERVER_TIMING_ENABLED adds the header to every response"""
+        from django.test import override_settings
+        with override_settings(SERVER_TIMING_ENABLED=True):
+            response = APIClient().get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+
+class SlowQueryLogTest(APITestCase):
+    """Test the slow query log"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+
+        rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        Ride.objects.create(
+            status='pickup',
+            id_rider=rider,
+            id_driver=rider,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+
+    def test_fast_queries_are_not_logged(self):
+        """Test that queries under the threshold are not logged"""
+        from .models import SlowQueryLog
+        self.client.get(reverse('ride-list'))
+        self.assertFalse(SlowQueryLog.objects.exists())
+
+    def test_slow_queries_are_logged_with_plan(self):
+        """Test that slow queries are saved with their request and plan"""
+        from django.test import override_settings
+        from .models import SlowQueryLog
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_RATE=1):
+            with self.assertLogs('rides.slow_queries', 'WARNING') as logs:
+                response = self.client.get(reverse('ride-list'), {'status': 'pickup'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(logs.records), 3)
+
+        # Count, rides, today's events
+        entries = list(SlowQueryLog.objects.order_by('id_slow_query'))
+        self.assertEqual(len(entries), 3)
+        entry = entries[1]
+        self.assertEqual(entry.route, 'ride-list')
+        self.assertEqual(entry.query_string, 'status=pickup')
+        self.assertIn('FROM "ride"', entry.sql)
+        self.assertIn('pickup', entry.params)
+        self.assertIn('Plan', entry.plan[0])
+
+    def test_log_keeps_latest_entries(self):
+        """Test that the log only keeps the latest SLOW_QUERY_LOG_SIZE entries"""
+        from django.test import override_settings
+        from .models import SlowQueryLog
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_RATE=0,
+                               SLOW_QUERY_LOG_SIZE=2):
+            with self.assertLogs('rides.slow_queries', 'WARNING'):
+                self.client.get(reverse('ride-list'))
+                self.client.get(reverse('ride-detail', args=[Ride.objects.get().pk]))
+        entries = SlowQueryLog.objects.all()
+        self.assertEqual(entries.count(), 2)
+        self.assertTrue(all(entry.route == 'ride-detail' for entry in entries))
+        self.assertTrue(all(entry.plan is None for entry in entries))
+
+    def test_admin_lists_entries(self):
+        """Test that the slow query log is browsable in the admin"""
+        from .models import SlowQueryLog
+        SlowQueryLog.objects.create(
+            duration_ms=812.5, route='ride-list', method='GET', path='/api/rides/',
+            database='default', sql='SELECT 1'
+        )
+        self.client.force_login(self.django_user)
+        response = self.client.get(reverse('admin:rides_slowquerylog_changelist'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'ride-list')
+
+
+class RequestProfilingTest(APITestCase):
+    """Test on-demand request profiling"""
+
+    def setUp(self):
+        self.client = APIClient()
+        # Profiling checks the session user, before DRF authentication runs
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_login(self.django_user)
+
+        rider = User.objects.create(
+            role='rider',
+            first_name='Jane',
+            last_name='Rider',
+            email='rider@example.com',
+            phone_number='+1111111111'
+        )
+        Ride.objects.create(
+            status='pickup',
+            id_rider=rider,
+            id_driver=rider,
+            pickup_latitude=37.7749,
+            pickup_longitude=-122.4194,
+            dropoff_latitude=37.7849,
+            dropoff_longitude=-122.4094,
+            pickup_time=timezone.now()
+        )
+
+    def test_profile_report(self):
+        """Test that admins get a ranked profile and the SQL of a request"""
+        response = self.client.get(reverse('ride-list'), {'profile': 1, 'status': 'pickup'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.json()
+        self.assertEqual(report['status_code'], 200)
+        self.assertTrue(report['functions'])
+        cumulative = [function['cumulative_ms'] for function in report['functions']]
+        self.assertEqual(cumulative, sorted(cumulative, reverse=True))
+        self.assertTrue(any('FROM "ride"' in query['sql'] for query in report['sql']))
+        self.assertEqual(report['sql_count'], len(report['sql']))
+
+    def test_raw_profile(self):
+        """Test that ?profile=pstats returns a profile pstats can load"""
+        import marshal
+        response = self.client.get(reverse('ride-list'), {'profile': 'pstats'})
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertTrue(marshal.loads(response.content))
+
+    def test_non_admin_gets_normal_response(self):
+        """Test that non-admin users can't profile requests"""
+        from django.contrib.auth.models import User as DjangoUser
+        self.client.force_login(DjangoUser.objects.create_user(username='rider', password='x'))
+        response = self.client.get(reverse('ride-list'), {'profile': 1})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn('functions', response.json())
+
+    def test_invalid_sort(self):
+        """Test that an unknown sort key is rejected"""
+        response = self.client.get(reverse('ride-list'), {'profile': 1, 'profile_sort': 'name'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MemoryInstrumentationTest(APITestCase):
+    """Test tracemalloc based memory instrumentation"""
+
+    def setUp(self):
+        import tracemalloc
+        self.client = APIClient()
+        # Create Django superuser for API access
+        from django.contrib.auth.models import User as DjangoUser
+        self.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+        self.client.force_authenticate(user=self.django_user)
+        self.was_tracing = tracemalloc.is_tracing()
+
+    def tearDown(self):
+        import tracemalloc
+        from .memory import snapshots
+        snapshots.clear()
+        if not self.was_tracing:
+            tracemalloc.stop()
+
+    def test_peak_memory_metric(self):
+        """Test that the request peak is recorded while tracing"""
+        from prometheus_client import REGISTRY
+        from .memory import start_tracing
+        start_tracing()
+        labels = {'route': 'user-list'}
+        before = REGISTRY.get_sample_value('api_request_peak_memory_bytes_count', labels) or 0
+        self.client.get(reverse('user-list'))
+        after = REGISTRY.get_sample_value('api_request_peak_memory_bytes_count', labels)
+        self.assertEqual(after, before + 1)
+
+    def test_snapshot_and_diff(self):
+        """Test taking a baseline snapshot and diffing against it"""
+        url = reverse('memory')
+        response = self.client.post(url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['tracing'])
+        self.assertIn('top', response.data)
+
+        leak = [bytearray(1024) for _ in range(1000)]
+        response = self.client.get(url, {'limit': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['diff']), 5)
+        self.assertGreater(response.data['diff'][0]['size_diff_bytes'], 1000 * 1024)
+        del leak
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_invalid_group(self):
+        """Test that an unknown grouping is rejected"""
+        response = self.client.get(reverse('memory'), {'group': 'module'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_gunicorn_recycles_large_workers(self):
+        """Test that the post_request hook recycles workers over the RSS limit"""
+        from types import SimpleNamespace
+        from unittest import mock
+        from config import gunicorn_conf
+        worker = SimpleNamespace(alive=True, pid=1, log=mock.Mock())
+        request = SimpleNamespace(path='/api/rides/')
+
+        with mock.patch.object(gunicorn_conf, 'MAX_WORKER_RSS_MB', 100000):
+            gunicorn_conf.post_request(worker, request, {}, None)
+        self.assertTrue(worker.alive)
+
+        with mock.patch.object(gunicorn_conf, 'MAX_WORKER_RSS_MB', 1):
+            gunicorn_conf.post_request(worker, request, {}, None)
+        self.assertFalse(worker.alive)
+        worker.log.warning.assert_called_once()
+
+
+class BenchmarkHelpersTest(APITestCase):
+    """Test the helpers behind the bench_api command"""
+
+    def test_seed_dataset(self):
+        """Test that seeding generates the requested rows"""
+        from .benchmarks import seed_dataset
+        counts = seed_dataset(200, events_per_ride=3)
+        self.assertEqual(Ride.objects.count(), 200)
+        self.assertEqual(RideEvent.objects.count(), 600)
+        self.assertEqual(User.objects.count(), counts['users'])
+        self.assertEqual(Ride.objects.filter(id_rider__role='rider', id_driver__role='driver').count(), 200)
+        self.assertEqual(sorted(Ride.objects.values_list('id_ride', flat=True))[-1], 200)
+
+    def test_percentile(self):
+        """Test percentiles interpolate between ranks"""
+        from .benchmarks import percentile
+        values = [4, 1, 3, 2, 5]
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 100), 5)
+        self.assertEqual(percentile(values, 95), 4.8)
+        self.assertIsNone(percentile([], 50))
+
+    def test_measure_endpoints(self):
+        """Test that every benchmarked endpoint is measured"""
+        from .benchmarks import admin_client, endpoint_requests, measure, seed_dataset
+        counts = seed_dataset(50, events_per_ride=2)
+        client = admin_client()
+        for name, make_request in endpoint_requests(counts).items():
+            summary = measure(client, make_request, iterations=3, warmup=1)
+            self.assertEqual(summary['iterations'], 3, name)
+            self.assertEqual(summary['status_codes'], [200], name)
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'], name)
+            self.assertLessEqual(summary['queries'], 3, name)
+
+    def test_measure_runs_unthrottled_and_rejects_errors(self):
+        """Test that the rate limits don't apply to benchmarks, and that error responses fail them"""
+        from config import settings as production_settings
+        from .benchmarks import BenchmarkError, admin_client, endpoint_requests, measure, seed_dataset
+        counts = seed_dataset(20, events_per_ride=1)
+        client = admin_client()
+        with self.settings(REST_FRAMEWORK=production_settings.REST_FRAMEWORK):
+            # More requests than the gps rate (30/min) allows
+            summary = measure(client, endpoint_requests(counts)['distance_list'], iterations=35, warmup=0)
+            self.assertEqual(summary['status_codes'], [200])
+
+        with self.assertRaisesMessage(BenchmarkError, 'answered 404'):
+            measure(client, lambda client: client.get('/api/rides/0/'), iterations=1, warmup=0)
+
+
+class LoadTestHelpersTest(TestCase):
+    """Test the helpers behind the loadtest command"""
+
+    def test_parse_mix(self):
+        """Test that request mixes are parsed and validated"""
+        from .loadtest import DEFAULT_MIX, LoadTestError, parse_mix
+        self.assertEqual(parse_mix('list=3, ingest=1'), {'list': 3.0, 'ingest': 1.0})
+        self.assertEqual(set(parse_mix(DEFAULT_MIX)), {'list', 'filtered', 'gps', 'detail', 'ingest'})
+        for mix in ['lists=1', 'list=x', 'list=-1', 'list=0']:
+            with self.assertRaises(LoadTestError, msg=mix):
+                parse_mix(mix)
+
+    def test_summarize(self):
+        """Test throughput, error rate and percentiles of a run"""
+        from .loadtest import summarize
+        results = [(0.01, 200), (0.02, 200), (0.03, 201), (0.5, 500), (1.0, None)]
+        summary = summarize(results, elapsed=2.5)
+        self.assertEqual(summary['requests'], 5)
+        self.assertEqual(summary['throughput_rps'], 2.0)
+        self.assertEqual(summary['errors'], 2)
+        self.assertEqual(summary['error_rate'], 0.4)
+        self.assertEqual(summary['status_codes'], {'200': 2, '201': 1, '500': 1, 'connection_error': 1})
+        self.assertEqual(summary['p50_ms'], 30.0)
+        self.assertEqual(summary['max_ms'], 1000.0)
+
+    def test_build_request(self):
+        """Test that each request kind targets the ride endpoints"""
+        from .loadtest import LoadTest, REQUEST_KINDS
+        load_test = LoadTest('http://localhost:8000/', 'admin', 'secret', rps=1, duration=1,
+                             mix={'list': 1}, seed=0)
+        load_test.ride_ids = [7]
+        load_test.rider_emails = ['rider@example.com']
+        requests = {kind: load_test.build_request(kind) for kind in REQUEST_KINDS}
+        self.assertEqual(load_test.base_url, 'http://localhost:8000')
+        self.assertEqual(requests['detail'], ('GET', '/api/rides/7/', {}))
+        self.assertEqual(requests['filtered'][2]['params']['rider_email'], 'rider@example.com')
+        self.assertEqual(set(requests['gps'][2]['params']), {'latitude', 'longitude'})
+        method, path, kwargs = requests['ingest']
+        self.assertEqual((method, path, kwargs['json']['id_ride']), ('POST', '/api/ride-events/', 7))
+
+    def test_command_requires_httpx(self):
+        """Test that the command explains how to install httpx"""
+        from django.core.management import CommandError, call_command
+        from unittest import mock
+        with mock.patch('rides.management.commands.loadtest.httpx', None):
+            with self.assertRaisesMessage(CommandError, 'requirements/development.txt'):
+                call_command('loadtest', username='admin', password='secret')
+
+
+class PerformanceBudgetTest(APITestCase):
+    """
+    Test every API route against its query, row and size budget, on a
+    seeded mid-size dataset (see rides/budgets.py).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        from django.contrib.auth.models import User as DjangoUser
+        from .benchmarks import seed_dataset
+        seed_dataset(500, events_per_ride=4)
+        cls.ride = Ride.objects.get(pk=1)
+        cls.ride_event = cls.ride.ride_events.first()
+        # Some of the events are from today, and embedded in ride lists
+        RideEvent.objects.filter(id_ride__lte=20).update(created_at=timezone.now())
+        cls.django_user = DjangoUser.objects.create_user(
+            username='testadmin',
+            password='testpass123',
+            is_staff=True,
+            is_superuser=True
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        from .event_stream import hub
+        from .notifications import listener
+        listener.stop()
+        hub.reset()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        # Log in with a session, like the frontend
+        self.client.force_login(self.django_user)
+
+    def test_every_route_has_a_budget(self):
+        """Test that each route in rides/urls.py has a performance budget"""
+        from django.urls import URLResolver
+        from . import urls
+        from .budgets import BUDGETS
+
+        def route_names(patterns):
+            for pattern in patterns:
+                if isinstance(pattern, URLResolver):
+                    yield from route_names(pattern.url_patterns)
+                elif pattern.name:
+                    yield pattern.name
+
+        missing = set(route_names(urls.urlpatterns)) - set(BUDGETS)
+        self.assertFalse(missing, f'Routes without a performance budget: {sorted(missing)}')
+
+    def test_budget_failure_lists_repeated_queries(self):
+        """Test that going over budget reports the repeated statements"""
+        from .budgets import Budget, check, measure
+        with measure() as measurement:
+            for ride in Ride.objects.all()[:5]:
+                ride.id_rider.email
+        budget = Budget('n-plus-one', max_queries=2)
+        with self.assertRaises(AssertionError) as failure:
+            check(self, budget, measurement)
+        message = str(failure.exception)
+        self.assertIn('queries: 6 (budget 2)', message)
+        self.assertIn('5 x ', message)
+        self.assertIn('<-- repeated', message)
+
+    @performance_budget('api-root', max_queries=2, max_rows=2, max_bytes=1000)
+    def test_api_root(self):
+        return self.client.get(reverse('api-root'))
+
+    @performance_budget('user-list', max_queries=3, max_rows=20, max_bytes=3000)
+    def test_user_list(self):
+        return self.client.get(reverse('user-list'))
+
+    @performance_budget('user-lookup', max_queries=3, max_rows=20, max_bytes=3000)
+    def test_user_lookup(self):
+        return self.client.get(reverse('user-lookup'), {'role': 'rider', 'q': 'rider1'})
+
+    @performance_budget('user-detail', max_queries=3, max_rows=3, max_bytes=500)
+    def test_user_detail(self):
+        return self.client.get(reverse('user-detail', args=[1]))
+
+    @performance_budget('ride-list', max_queries=5, max_rows=60, max_bytes=12000)
+    def test_ride_list(self):
+        return self.client.get(reverse('ride-list'))
+
+    @performance_budget('ride-search', max_queries=4, max_rows=60, max_bytes=12000)
+    def test_ride_search(self):
+        return self.client.get(reverse('ride-search'), {'q': 'rider1'})
+
+    @performance_budget('ride-detail', max_queries=5, max_rows=15, max_bytes=2000)
+    def test_ride_detail(self):
+        return self.client.get(reverse('ride-detail', args=[self.ride.pk]))
+
+    @performance_budget('rideevent-list', max_queries=4, max_rows=15, max_bytes=1500)
+    def test_ride_event_list(self):
+        return self.client.get(reverse('rideevent-list'))
+
+    @performance_budget('rideevent-detail', max_queries=3, max_rows=3, max_bytes=500)
+    def test_ride_event_detail(self):
+        return self.client.get(reverse('rideevent-detail', args=[self.ride_event.pk]))
+
+    @performance_budget('rideevent-stream', max_queries=3, max_rows=102, max_bytes=20000)
+    def test_ride_event_stream(self):
+        return self.client.get(
+            reverse('rideevent-stream'), {'timeout': 1},
+            HTTP_LAST_EVENT_ID=str(self.ride_event.pk)
+        )
+
+    @performance_budget('changes', max_queries=4, max_rows=204, max_bytes=60000)
+    def test_change_feed(self):
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0):
+            return self.client.get(reverse('changes'))
+
+    @performance_budget('metrics', max_queries=2, max_rows=2, max_bytes=None)
+    def test_metrics(self):
+        return self.client.get(reverse('metrics'))
+
+    @performance_budget('memory', max_queries=2, max_rows=2, max_bytes=500)
+    def test_memory(self):
+        return self.client.get(reverse('memory'))
+
+    @performance_budget('auth-csrf', max_queries=0, max_rows=0, max_bytes=200)
+    def test_auth_csrf(self):
+        return APIClient().get(reverse('auth-csrf'))
+
+    @performance_budget('auth-login', max_queries=5, max_rows=1, max_bytes=500)
+    def test_auth_login(self):
+        return APIClient().post(
+            reverse('auth-login'), {'username': 'testadmin', 'password': 'testpass123'}, format='json'
+        )
+
+    @performance_budget('auth-logout', max_queries=4, max_rows=3, max_bytes=200)
+    def test_auth_logout(self):
+        return self.client.post(reverse('auth-logout'))
+
+    @performance_budget('auth-current-user', max_queries=2, max_rows=2, max_bytes=500)
+    def test_auth_current_user(self):
+        return self.client.get(reverse('auth-current-user'))
+
+    @performance_budget('auth-check', max_queries=2, max_rows=2, max_bytes=500)
+    def test_auth_check(self):
+        return self.client.get(reverse('auth-check'))
+
+    @performance_budget('async-ride-list', max_queries=5, max_rows=60, max_bytes=12000)
+    def test_async_ride_list(self):
+        return self.client.get(reverse('async-ride-list'))
+
+    @performance_budget('async-ride-detail', max_queries=5, max_rows=15, max_bytes=2000)
+    def test_async_ride_detail(self):
+        return self.client.get(reverse('async-ride-detail', args=[self.ride.pk]))
+
+    @performance_budget('async-rideevent-list', max_queries=4, max_rows=15, max_bytes=1500)
+    def test_async_ride_event_list(self):
+        return self.client.get(reverse('async-rideevent-list'))
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    Test routing reads to the read replica. A second connection to the
+    test database stands in for the replica.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from django.db import connections
+        super().setUpClass()
+        # Added after the test case set up its databases, so that queries
+        # to it are allowed
+        connections.settings['replica'] = dict(connections['default'].settings_dict)
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        super().tearDownClass()
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        rider = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='rider@example.com', phone_number='+1111111111'
+        )
+        driver = User.objects.create(
+            role='driver', first_name='John', last_name='Driver',
+            email='driver@example.com', phone_number='+2222222222'
+        )
+        self.ride = Ride.objects.create(
+            status='pickup', id_rider=rider, id_driver=driver,
+            pickup_latitude=37.7749, pickup_longitude=-122.4194,
+            dropoff_latitude=37.8049, dropoff_longitude=-122.4294,
+            pickup_time=timezone.now()
+        )
+        self.client = APIClient()
+        self.client.force_login(DjangoUser.objects.create_superuser('replica-admin', '', 'secret'))
+
+    def tearDown(self):
+        from .local_cache import bus, get_cache
+        from .notifications import listener
+        listener.stop()
+        bus.reset()
+        get_cache().clear()
+
+    def capture(self):
+        from contextlib import ExitStack
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        stack = ExitStack()
+        primary = stack.enter_context(CaptureQueriesContext(connections['default']))
+        replica = stack.enter_context(CaptureQueriesContext(connections['replica']))
+        return stack, primary, replica
+
+    def test_list_and_detail_read_from_replica(self):
+        """Test that ride, event and user reads go to the replica"""
+        urls = [
+            reverse('ride-list'),
+            reverse('ride-detail', args=[self.ride.pk]),
+            reverse('rideevent-list'),
+            reverse('user-list'),
+            reverse('async-ride-list'),
+        ]
+        for url in urls:
+            stack, primary, replica = self.capture()
+            with stack:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            self.assertEqual(len(primary), 0, url)
+            self.assertGreater(len(replica), 0, url)
+            self.assertNotIn('primary_pin', response.cookies, url)
+
+    def test_other_views_read_from_primary(self):
+        """Test that views without replica actions stay on the primary"""
+        stack, primary, replica = self.capture()
+        with stack:
+            response = self.client.get(reverse('auth-current-user'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(primary), 0)
+        self.assertEqual(len(replica), 0)
+
+    def test_write_pins_client_to_primary(self):
+        """Test that after a write the client reads from the primary for a while"""
+        response = self.client.post(
+            reverse('rideevent-list'),
+            {'id_ride': self.ride.pk, 'description': 'Driver arrived'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        cookie = response.cookies['primary_pin']
+        self.assertEqual(cookie['max-age'], 5)
+
+        stack, primary, replica = self.capture()
+        with stack:
+            response = self.client.get(reverse('rideevent-list'))
+        self.assertEqual(response.data['count'], 1)
+        self.assertGreater(len(primary), 0)
+        self.assertEqual(len(replica), 0)
+
+    def test_reads_after_write_use_primary(self):
+        """Test that a request that wrote reads from the primary afterwards"""
+        from .replicas import RoutingState, current_routing
+        token = current_routing.set(RoutingState(use_replica=True))
+        try:
+            ride = Ride.objects.get(pk=self.ride.pk)
+            self.assertEqual(ride._state.db, 'replica')
+            self.assertEqual(Ride.objects.all().db, 'replica')
+            ride.status = 'dropoff'
+            ride.save()
+            self.assertEqual(Ride.objects.all().db, 'default')
+            self.assertEqual(RideEvent.objects.filter(id_ride=ride).db, 'default')
+        finally:
+            current_routing.reset(token)
+
+    def test_change_feed_waits_for_replica(self):
+        """Test that the change feed holds rows back for the replica lag"""
+        url = reverse('changes')
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0, REPLICA_LAG_SECONDS=60):
+            self.assertEqual(self.client.get(url).data['rides'], [])
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0, REPLICA_LAG_SECONDS=0):
+            self.assertEqual(len(self.client.get(url).data['rides']), 1)
+
+
+class ConnectionPoolTest(TestCase):
+    """Test the per-worker connection pool backend"""
+
+    def make_pool(self, **options):
+        import psycopg2
+        from django.db import connection
+        from .backends.postgresql_pool.base import ConnectionPool
+        options = {
+            'max_size': 2, 'timeout': 1, 'max_idle': None,
+            'max_lifetime': None, 'health_check_interval': None, **options
+        }
+        pool = ConnectionPool('pool-test', **options)
+        self.addCleanup(pool.close_idle)
+        conn_params = connection.get_connection_params()
+        return pool, lambda: psycopg2.connect(**conn_params)
+
+    def test_connections_are_reused(self):
+        """Test that a returned connection is handed out again"""
+        pool, connect = self.make_pool()
+        first = pool.checkout(connect)
+        pool.checkin(first)
+        self.assertIs(pool.checkout(connect), first)
+        second = pool.checkout(connect)
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.stats()['open'], 2)
+        self.assertEqual(pool.stats()['in_use'], 2)
+        pool.checkin(first)
+        pool.checkin(second)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_checkout_waits_then_times_out(self):
+        """Test that a full pool makes checkouts wait, up to the timeout"""
+        import threading
+        from .backends.postgresql_pool.base import PoolTimeout
+        pool, connect = self.make_pool(max_size=1, timeout=0.1)
+        connection = pool.checkout(connect)
+        with self.assertRaises(PoolTimeout):
+            pool.checkout(connect)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+        pool.timeout = 5
+        threading.Timer(0.1, pool.checkin, [connection]).start()
+        self.assertIs(pool.checkout(connect), connection)
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def test_open_transaction_is_rolled_back(self):
+        """Test that connections come back outside of any transaction"""
+        import psycopg2
+        pool, connect = self.make_pool()
+        connection = pool.checkout(connect)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(connection.info.transaction_status, psycopg2.extensions.TRANSACTION_STATUS_INTRANS)
+        pool.checkin(connection)
+        self.assertEqual(connection.info.transaction_status, psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_broken_connections_are_replaced(self):
+        """Test that closed and terminated connections are not handed out"""
+        from django.db import connection as django_connection
+        pool, connect = self.make_pool(health_check_interval=0)
+        connection = pool.checkout(connect)
+        connection.autocommit = True
+        pool.checkin(connection)
+        with django_connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [connection.info.backend_pid])
+
+        replacement = pool.checkout(connect)
+        self.assertIsNot(replacement, connection)
+        self.assertFalse(replacement.closed)
+        self.assertEqual(pool.stats()['open'], 1)
+
+        replacement.close()
+        pool.checkin(replacement)
+        self.assertEqual(pool.stats()['open'], 0)
+
+    def test_abandoned_connections_are_reclaimed(self):
+        """Test that connections of threads that ended are taken back"""
+        import threading
+        pool, connect = self.make_pool(max_size=1)
+        checked_out = []
+        thread = threading.Thread(target=lambda: checked_out.append(pool.checkout(connect)))
+        thread.start()
+        thread.join()
+        self.assertIs(pool.checkout(connect), checked_out[0])
+
+    def test_requests_share_pooled_connection(self):
+        """Test that each request returns its connection to the pool"""
+        import threading
+        from django.core.signals import request_finished, request_started
+        from django.db import connections
+        from .backends.postgresql_pool.base import close_pools, get_pool
+
+        settings_dict = dict(connections['default'].settings_dict)
+        settings_dict.update({
+            'ENGINE': 'rides.backends.postgresql_pool',
+            'CONN_MAX_AGE': 0,
+            'POOL': {'MAX_SIZE': 1},
+        })
+        connections.settings['pooled'] = settings_dict
+        self.addCleanup(connections.settings.pop, 'pooled')
+        self.addCleanup(close_pools, settings_dict['NAME'])
+
+        backend_pids = []
+
+        def handle_request():
+            request_started.send(sender=None)
+            with connections['pooled'].cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()')
+                backend_pids.append(cursor.fetchone()[0])
+            request_finished.send(sender=None)
+
+        threads = [threading.Thread(target=handle_request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(backend_pids), 4)
+        self.assertEqual(len(set(backend_pids)), 1)
+        stats = get_pool('pooled', settings_dict).stats()
+        self.assertEqual((stats['created'], stats['in_use'], stats['idle']), (1, 0, 1))
+
+
+@override_settings(RIDE_EVENT_SHARDS=['events_0', 'events_1'])
+class RideEventShardingTest(TransactionTestCase):
+    """
+    Test storing ride events across two shards, each a test database of
+    its own.
+    """
+    shards = ['events_0', 'events_1']
+
+    @classmethod
+    def setUpClass(cls):
+        from django.db import connections
+        super().setUpClass()
+        # Added after the test case set up its databases, so that queries
+        # to them are allowed
+        for alias in cls.shards:
+            settings_dict = dict(connections['default'].settings_dict)
+            settings_dict['TEST'] = {**settings_dict['TEST'], 'NAME': f"{settings_dict['NAME']}_{alias}"}
+            connections.settings[alias] = settings_dict
+            connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        for alias in cls.shards:
+            connections[alias].creation.destroy_test_db(connections[alias].settings_dict['NAME'], verbosity=0)
+            del connections[alias]
+            del connections.settings[alias]
+        super().tearDownClass()
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        from .sharding import setup_sequences, shard_for_ride
+        setup_sequences()
+        rider = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='rider@example.com', phone_number='+1111111111'
+        )
+        driver = User.objects.create(
+            role='driver', first_name='John', last_name='Driver',
+            email='driver@example.com', phone_number='+2222222222'
+        )
+        # At least 6 rides, and some on every shard (the ids, and so the
+        # shards, depend on the rides other tests created)
+        self.rides = []
+        while len(self.rides) < 6 or len({shard_for_ride(ride.pk) for ride in self.rides}) < len(self.shards):
+            self.rides.append(Ride.objects.create(
+                status='pickup', id_rider=rider, id_driver=driver,
+                pickup_latitude=37.7749, pickup_longitude=-122.4194,
+                dropoff_latitude=37.8049, dropoff_longitude=-122.4294,
+                pickup_time=timezone.now()
+            ))
+        self.client = APIClient()
+        self.client.force_login(DjangoUser.objects.create_superuser('shard-admin', '', 'secret'))
+
+    def tearDown(self):
+        from django.db import connections
+        from .local_cache import bus, get_cache
+        from .notifications import listener
+        for alias in self.shards:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('TRUNCATE ride_event')
+        listener.stop()
+        bus.reset()
+        get_cache().clear()
+
+    def create_events(self, per_ride=2):
+        for ride in self.rides:
+            for n in range(per_ride):
+                response = self.client.post(
+                    reverse('rideevent-list'),
+                    {'id_ride': ride.pk, 'description': f'Event {n}'},
+                    format='json'
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def stored_events(self, alias):
+        return list(RideEvent.objects.using(alias).values_list('pk', 'id_ride_id'))
+
+    def capture(self):
+        from contextlib import ExitStack
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        stack = ExitStack()
+        queries = {
+            alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+            for alias in ['default'] + self.shards
+        }
+        return stack, queries
+
+    def test_stream_hears_of_sharded_events_once_committed(self):
+        """Test that events stored on a shard are streamed after the shard commits"""
+        import queue
+        from django.db import transaction
+        from .event_stream import hub
+        from .sharding import shard_for_ride
+        self.addCleanup(hub.reset)
+        ride = self.rides[0]
+        shard = shard_for_ride(ride.pk)
+        subscription = hub.subscribe(id_ride=ride.pk)
+
+        with transaction.atomic(using=shard):
+            event = RideEvent.objects.using(shard).create(id_ride=ride, description='Driver assigned')
+            with self.assertRaises(queue.Empty):
+                subscription.queue.get(timeout=0.5)
+        message = subscription.queue.get(timeout=5)
+        self.assertEqual(message['event']['id_ride_event'], event.pk)
+
+    def test_events_are_stored_on_the_shard_of_their_ride(self):
+        """Test that events go to their ride's shard, with ids telling the shard apart"""
+        from .sharding import shard_for_event, shard_for_ride
+        self.create_events()
+
+        self.assertEqual(RideEvent.objects.using('default').count(), 0)
+        for index, alias in enumerate(self.shards):
+            events = self.stored_events(alias)
+            # Both shards hold some of the rides
+            self.assertGreater(len(events), 0)
+            for pk, id_ride in events:
+                self.assertEqual(shard_for_ride(id_ride), alias)
+                self.assertEqual(shard_for_event(pk), alias)
+                self.assertEqual((pk - 1) % 2, index)
+
+    def test_sequences_continue_after_highest_id(self):
+        """Test that setting up the sequences again keeps ids unique"""
+        from .sharding import setup_sequences
+        self.create_events(per_ride=1)
+        highest = max(pk for alias in self.shards for pk, _ in self.stored_events(alias))
+
+        next_ids = setup_sequences()
+        self.assertEqual(sorted(next_ids.values()), [highest + 1, highest + 2])
+        self.assertEqual((next_ids['events_0'] - 1) % 2, 0)
+        self.assertEqual((next_ids['events_1'] - 1) % 2, 1)
+
+    def test_list_gathers_events_from_every_shard(self):
+        """Test that the event list merges the shards in order, page by page"""
+        self.create_events()
+        url = reverse('rideevent-list')
+
+        seen = []
+        for page in (1, 2, 3):
+            stack, queries = self.capture()
+            with stack:
+                response = self.client.get(url, {'page': page, 'page_size': 5})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], len(self.rides) * 2)
+            for alias in self.shards:
+                self.assertGreater(len(queries[alias]), 0)
+            seen.extend(response.data['results'])
+
+        self.assertEqual(len({event['id_ride_event'] for event in seen}), len(self.rides) * 2)
+        created = [event['created_at'] for event in seen]
+        self.assertEqual(created, sorted(created, reverse=True))
+
+        response = self.client.get(url, {'ordering': 'created_at', 'page_size': 20})
+        created = [event['created_at'] for event in response.data['results']]
+        self.assertEqual(created, sorted(created))
+
+    def test_list_filtered_by_ride_reads_one_shard(self):
+        """Test that filtering by ride only queries that ride's shard"""
+        from .sharding import shard_for_ride
+        self.create_events()
+        ride = self.rides[0]
+        other_shard = next(alias for alias in self.shards if alias != shard_for_ride(ride.pk))
+
+        stack, queries = self.capture()
+        with stack:
+            response = self.client.get(reverse('rideevent-list'), {'id_ride': ride.pk})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(queries[other_shard]), 0)
+
+        response = self.client.get(reverse('async-rideevent-list'), {'id_ride': ride.pk})
+        self.assertEqual(response.json()['count'], 2)
+        response = self.client.get(reverse('async-rideevent-list'))
+        self.assertEqual(response.json()['count'], len(self.rides) * 2)
+
+    def test_event_detail_update_and_delete(self):
+        """Test that an event is found on its shard by id"""
+        self.create_events(per_ride=1)
+        for alias in self.shards:
+            pk, id_ride = self.stored_events(alias)[0]
+            url = reverse('rideevent-detail', args=[pk])
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['id_ride'], id_ride)
+
+            response = self.client.patch(url, {'description': 'Updated'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(RideEvent.objects.using(alias).get(pk=pk).description, 'Updated')
+
+            response = self.client.delete(url)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertFalse(RideEvent.objects.using(alias).filter(pk=pk).exists())
+
+        for pk in (10 ** 6, 'event', '²'):
+            response = self.client.get(reverse('rideevent-detail', args=[pk]))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_event_stays_on_its_shard(self):
+        """Test that an event can move to another ride of its shard only"""
+        from collections import defaultdict
+        from .sharding import shard_for_ride
+        self.create_events(per_ride=1)
+        rides = defaultdict(list)
+        for ride in self.rides:
+            rides[shard_for_ride(ride.pk)].append(ride.pk)
+        # With 6 rides or more, a shard holds at least 3
+        shard, other_shard = sorted(self.shards, key=lambda alias: -len(rides[alias]))
+        id_ride, same_shard = rides[shard][:2]
+        pk = RideEvent.objects.using(shard).get(id_ride=id_ride).pk
+        url = reverse('rideevent-detail', args=[pk])
+
+        response = self.client.patch(url, {'id_ride': rides[other_shard][0]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('id_ride', response.data)
+        self.assertNotIn(pk, [event_pk for event_pk, _ in self.stored_events(other_shard)])
+
+        response = self.client.patch(url, {'id_ride': same_shard}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(RideEvent.objects.using(shard).get(pk=pk).id_ride_id, same_shard)
+
+    def test_ride_list_prefetches_todays_events_per_shard(self):
+        """Test that the ride list reads today's events with one query per shard"""
+        self.create_events()
+        for url in (reverse('ride-list'), reverse('async-ride-list')):
+            stack, queries = self.capture()
+            with stack:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            for ride in response.json()['results']:
+                self.assertEqual(len(ride['todays_ride_events']), 2)
+            for alias in self.shards:
+                self.assertEqual(len(queries[alias]), 1, url)
+
+        response = self.client.get(reverse('ride-detail', args=[self.rides[0].pk]))
+        self.assertEqual(len(response.data['ride_events']), 2)
+        self.assertEqual(len(response.data['todays_ride_events']), 2)
+
+    def test_deleting_ride_deletes_sharded_events(self):
+        """Test that a ride's events are deleted from its shard with it"""
+        from .sharding import shard_for_ride
+        self.create_events()
+        ride = self.rides[0]
+        alias = shard_for_ride(ride.pk)
+
+        response = self.client.delete(reverse('ride-detail', args=[ride.pk]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(RideEvent.objects.using(alias).filter(id_ride=ride.pk).exists())
+        self.assertEqual(sum(len(self.stored_events(alias)) for alias in self.shards), 10)
+
+    def test_change_feed_reads_every_shard(self):
+        """Test that the change feed pages through the events of every shard"""
+        self.create_events()
+        url = reverse('changes')
+        events = []
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0):
+            response = self.client.get(url, {'limit': 5})
+            events.extend(response.data['ride_events'])
+            while response.data['has_more']:
+                response = self.client.get(url, {'limit': 5, 'since': response.data['next']})
+                events.extend(response.data['ride_events'])
+        self.assertEqual(len({event['id_ride_event'] for event in events}), len(self.rides) * 2)
+
+
+class ColdStartTest(TestCase):
+    """Test warming up and measuring a cold start"""
+
+    def test_cold_start_within_target(self):
+        """Test that a fresh interpreter warms up fully, within the target and without connecting"""
+        import os
+        from django.conf import settings
+        from .warmup import COLD_START_TARGET_SECONDS, measure_startup
+        # Slow or busy CI machines can allow for more with COLD_START_MARGIN
+        margin = float(os.environ.get('COLD_START_MARGIN', '1'))
+        startup = measure_startup(settings.SETTINGS_MODULE)
+        phases = startup['phases']
+        self.assertLessEqual(
+            startup['total'], COLD_START_TARGET_SECONDS * margin,
+            f"Cold start took {startup['total']:.2f}s: {phases} "
+            f'(see python manage.py startup_audit)'
+        )
+        self.assertEqual(
+            set(phases['warm_up_steps']),
+            {'urls', 'middleware', 'api_settings', 'models', 'serializers', 'translations'}
+        )
+        self.assertEqual(phases['warm_up_connections'], [])
+        self.assertTrue(phases['urls_populated'])
+        self.assertNotIn('connect', phases)
+
+    def test_warm_up_does_not_query(self):
+        """Test that warming up (done before forking workers) leaves the database alone"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import get_resolver
+        from .warmup import warm_up
+        with CaptureQueriesContext(connection) as queries:
+            warm_up()
+        self.assertEqual(len(queries), 0)
+        self.assertTrue(get_resolver()._populated)
+
+    def test_parse_import_times(self):
+        """Test parsing the output of python -X importtime"""
+        from .warmup import parse_import_times
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |     django.utils.regex_helper\n'
+            'import time:      2500 |       2620 |   django.urls\n'
+            'import time:       300 |       2920 | rides.views\n'
+        )
+        self.assertEqual(parse_import_times(output), [
+            {'module': 'django.utils.regex_helper', 'self_ms': 0.12, 'cumulative_ms': 0.12, 'depth': 2},
+            {'module': 'django.urls', 'self_ms': 2.5, 'cumulative_ms': 2.62, 'depth': 1},
+            {'module': 'rides.views', 'self_ms': 0.3, 'cumulative_ms': 2.92, 'depth': 0},
+        ])
+
+
+class ThrottlingTest(APITestCase):
+    """Test the token bucket throttle"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.contrib.auth.models import User as DjangoUser
+        from .throttling import buckets
+        overrides = override_settings(REST_FRAMEWORK={
+            **settings.REST_FRAMEWORK,
+            'DEFAULT_THROTTLE_RATES': {
+                'api': '100/min', 'gps': '2/min', 'export': '1/min', 'changes': '5/min', 'report': '1/min',
+            },
+        })
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        buckets.reset()
+        self.addCleanup(buckets.reset)
+        self.admin = DjangoUser.objects.create_superuser('throttle-admin', '', 'secret')
+        self.client.force_login(self.admin)
+        self.gps = {'latitude': '37.77', 'longitude': '-122.42'}
+
+    def test_bucket_refills_at_rate(self):
+        """Test that tokens come back at the rate, up to the capacity"""
+        from .throttling import BucketStore, parse_rate
+        self.assertEqual(parse_rate('30/min'), (30, 0.5))
+        self.assertIsNone(parse_rate(None))
+
+        store = BucketStore()
+        self.assertEqual(store.take('key', 2, 1, now=0), 0)
+        self.assertEqual(store.take('key', 2, 1, now=0), 0)
+        self.assertEqual(store.take('key', 2, 1, now=0), 1)
+        self.assertAlmostEqual(store.take('key', 2, 1, now=0.25), 0.75)
+        self.assertEqual(store.take('key', 2, 1, now=1), 0)
+        # Refills stop at the capacity
+        self.assertEqual(store.take('key', 2, 1, now=100), 0)
+        self.assertEqual(store.take('key', 2, 1, now=100), 0)
+        self.assertEqual(store.take('key', 2, 1, now=100), 1)
+
+    def test_bucket_store_is_bounded(self):
+        """Test that the least recently used buckets are dropped"""
+        from .throttling import BucketStore
+        store = BucketStore(max_buckets=2)
+        for key in ('a', 'b', 'a', 'c'):
+            store.take(key, 1, 1, now=0)
+        self.assertEqual(list(store.buckets), ['a', 'c'])
+
+    def test_gps_list_is_throttled_with_retry_after(self):
+        """Test that distance sorted lists get the strict rate and a Retry-After"""
+        url = reverse('ride-list')
+        for _ in range(2):
+            self.assertEqual(self.client.get(url, self.gps).status_code, status.HTTP_200_OK)
+        response = self.client.get(url, self.gps)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+
+        # Other reads have their own, generous bucket
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        # Buckets are per user
+        from django.contrib.auth.models import User as DjangoUser
+        self.client.force_login(DjangoUser.objects.create_superuser('other-admin', '', 'secret'))
+        self.assertEqual(self.client.get(url, self.gps).status_code, status.HTTP_200_OK)
+
+    def test_async_gps_list_is_throttled(self):
+        """Test that the async ride list shares the gps bucket"""
+        self.assertEqual(self.client.get(reverse('ride-list'), self.gps).status_code, status.HTTP_200_OK)
+        url = reverse('async-ride-list')
+        self.assertEqual(self.client.get(url, self.gps).status_code, status.HTTP_200_OK)
+        response = self.client.get(url, self.gps)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertIn('detail', response.json())
+
+    def test_exports_and_reports_are_strict(self):
+        """Test the export scope of large list pages and the report scope"""
+        url = reverse('ride-list')
+        self.assertEqual(self.client.get(url, {'page_size': 100}).status_code, status.HTTP_200_OK)
+        response = self.client.get(url, {'page_size': 100})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '60')
+        # Small pages aren't exports
+        self.assertEqual(self.client.get(url, {'page_size': 10}).status_code, status.HTTP_200_OK)
+
+        # The change feed has its own bucket, for clients catching up
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=0):
+            for _ in range(5):
+                self.assertEqual(self.client.get(reverse('changes')).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(reverse('changes')).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        self.assertEqual(self.client.get(reverse('memory')).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(reverse('memory')).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_unpaginated_lists_are_not_exports(self):
+        """Test that the user list, streamed without pagination, has the api rate"""
+        from config import settings as production_settings
+        rates = production_settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']
+        url = reverse('user-list')
+        with self.settings(REST_FRAMEWORK={**production_settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates}):
+            for _ in range(15):
+                self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_anonymous_clients_are_throttled_by_address(self):
+        """Test that clients that aren't logged in are throttled by address"""
+        from .throttling import client_ident
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        request = RequestFactory().get('/', REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(client_ident(request, AnonymousUser()), 'address:203.0.113.7')
+        self.assertEqual(client_ident(request, self.admin), f'user:{self.admin.pk}')
+
+
+class StatementTimeoutTest(APITestCase):
+    """Test statement timeouts and degraded responses"""
+
+    # Sleeps for longer than the tests' timeout, in a WHERE clause
+    slow_condition = '(SELECT 1 FROM pg_sleep(0.5)) = 1'
+
+    def setUp(self):
+        from unittest import mock
+        from django.contrib.auth.models import User as DjangoUser
+        from .views import RideViewSet
+        overrides = override_settings(API_STATEMENT_TIMEOUT_MS=10000)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(RideViewSet, 'statement_timeout', 50)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.admin = DjangoUser.objects.create_superuser('timeout-admin', '', 'secret')
+        self.client.force_login(self.admin)
+        rider = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='rider@example.com', phone_number='+1111111111'
+        )
+        driver = User.objects.create(
+            role='driver', first_name='Bob', last_name='Driver',
+            email='driver@example.com', phone_number='+2222222222'
+        )
+        for hours in range(3):
+            ride = Ride.objects.create(
+                status='en-route', id_rider=rider, id_driver=driver,
+                pickup_latitude=Decimal('37.7749'), pickup_longitude=Decimal('-122.4194'),
+                dropoff_latitude=Decimal('37.8049'), dropoff_longitude=Decimal('-122.4494'),
+                pickup_time=timezone.now() - timedelta(hours=hours),
+            )
+            RideEvent.objects.create(id_ride=ride, description='Status changed to pickup')
+
+    def test_timeout_is_set_per_view_for_reads(self):
+        """Test that GETs run with the view's timeout, and writes without one"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('ride-list'))
+            self.client.get(reverse('user-list'))
+        timeouts = [q['sql'] for q in queries.captured_queries if 'statement_timeout' in q['sql']]
+        self.assertEqual(timeouts, ['SET LOCAL statement_timeout = 50', 'SET LOCAL statement_timeout = 10000'])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('user-list'), {
+                'role': 'rider', 'first_name': 'New', 'last_name': 'Rider',
+                'email': 'new@example.com', 'phone_number': '+3333333333',
+            })
+        self.assertFalse([q for q in queries.captured_queries if 'statement_timeout' in q['sql']])
+
+        with self.settings(API_STATEMENT_TIMEOUT_MS=0):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('ride-list'))
+        self.assertFalse([q for q in queries.captured_queries if 'statement_timeout' in q['sql']])
+
+    def test_count_timeout_degrades(self):
+        """Test that a list whose count times out is returned without it"""
+        from unittest import mock
+        from django.core.paginator import Paginator
+        from django.db import connection
+
+        def slow_count(paginator):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(0.5)')
+            return 3
+
+        with mock.patch.object(Paginator, 'count', property(slow_count)):
+            response = self.client.get(reverse('ride-list'), {'page_size': 2})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['X-Degraded'], 'count')
+            data = response.json()
+            self.assertIsNone(data['count'])
+            self.assertEqual(len(data['results']), 2)
+            self.assertIn('page=2', data['next'])
+            self.assertIsNone(data['previous'])
+
+            data = self.client.get(reverse('ride-list'), {'page_size': 2, 'page': 2}).json()
+            self.assertEqual(len(data['results']), 1)
+            self.assertIsNone(data['next'])
+            self.assertIsNotNone(data['previous'])
+            response = self.client.get(reverse('ride-list'), {'page_size': 2, 'page': 3})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # The transaction is still usable after the timeout
+        self.assertEqual(Ride.objects.count(), 3)
+
+    def test_event_prefetch_timeout_degrades(self):
+        """Test that rides are listed without today's events when those time out"""
+        from unittest import mock
+        from django.db.models import Prefetch
+
+        def slow_prefetch():
+            return Prefetch(
+                'ride_events',
+                queryset=RideEvent.objects.extra(where=[self.slow_condition]),
+                to_attr='todays_ride_events_prefetch',
+            )
+
+        with mock.patch('rides.views.todays_events_prefetch', slow_prefetch):
+            response = self.client.get(reverse('ride-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Degraded'], 'todays_ride_events')
+        data = response.json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([ride['todays_ride_events'] for ride in data['results']], [None] * 3)
+
+        response = self.client.get(reverse('ride-list'))
+        self.assertNotIn('X-Degraded', response)
+        self.assertEqual(len(response.json()['results'][0]['todays_ride_events']), 1)
+
+    def test_shared_list_keeps_degraded_parts(self):
+        """Test that requests sharing a degraded list are told what's missing"""
+        from unittest import mock
+        from django.core.cache import caches
+        from django.db.models import Prefetch
+        self.addCleanup(caches['default'].clear)
+
+        def slow_prefetch():
+            return Prefetch(
+                'ride_events',
+                queryset=RideEvent.objects.extra(where=[self.slow_condition]),
+                to_attr='todays_ride_events_prefetch',
+            )
+
+        with self.settings(SINGLE_FLIGHT_CACHE_ALIAS='default'):
+            with mock.patch('rides.views.todays_events_prefetch', slow_prefetch):
+                first = self.client.get(reverse('ride-list'))
+            # Served the first request's result from the shared cache: the
+            # queries are the timeout's, the session's and the user's
+            with self.assertNumQueries(5):
+                second = self.client.get(reverse('ride-list'))
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['X-Degraded'], 'todays_ride_events')
+
+    def test_required_query_timeout_is_503(self):
+        """Test that a timeout the response can't do without gives a 503"""
+        from unittest import mock
+        from .views import ride_queryset
+
+        with mock.patch('rides.views.ride_queryset', lambda: ride_queryset().extra(where=[self.slow_condition])):
+            response = self.client.get(reverse('ride-list'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('took too long', response.json()['detail'])
+        # The request's transaction was rolled back, not left aborted
+        self.assertEqual(Ride.objects.count(), 3)
+
+
+class EstimatedCountTest(APITestCase):
+    """Test estimated counts of large lists"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        from django.db import connection
+        overrides = override_settings(API_ESTIMATED_COUNT_THRESHOLD=10)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.admin = DjangoUser.objects.create_superuser('estimate-admin', '', 'secret')
+        self.client.force_login(self.admin)
+        rider = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='rider@example.com', phone_number='+1111111111'
+        )
+        driver = User.objects.create(
+            role='driver', first_name='Bob', last_name='Driver',
+            email='driver@example.com', phone_number='+2222222222'
+        )
+        Ride.objects.bulk_create(
+            Ride(
+                status='dropoff' if i % 4 else 'pickup', id_rider=rider, id_driver=driver,
+                pickup_latitude=Decimal('37.7749'), pickup_longitude=Decimal('-122.4194'),
+                dropoff_latitude=Decimal('37.8049'), dropoff_longitude=Decimal('-122.4494'),
+                pickup_time=timezone.now() - timedelta(hours=i),
+            )
+            for i in range(24)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Ride._meta.db_table}')
+
+    def test_estimate_above_threshold(self):
+        """Test that an unfiltered list gets the table statistics as its count"""
+        url = reverse('ride-list')
+        data = self.client.get(url, {'page_size': 10}).json()
+        self.assertEqual(data['count'], 24)
+        self.assertTrue(data['count_approximate'])
+        self.assertEqual(len(data['results']), 10)
+        self.assertIn('page=2', data['next'])
+
+        # The last page is found from the rows, not from the count
+        data = self.client.get(url, {'page_size': 10, 'page': 3}).json()
+        self.assertEqual(len(data['results']), 4)
+        self.assertIsNone(data['next'])
+        response = self.client.get(url, {'page_size': 10, 'page': 4})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_filtered_lists_use_the_plan_estimate(self):
+        """Test that filtered lists are estimated by the planner, or counted when small"""
+        from .pagination import estimate_count
+        estimate = estimate_count(Ride.objects.filter(status='dropoff'))
+        self.assertGreater(estimate, 0)
+
+        with self.settings(API_ESTIMATED_COUNT_THRESHOLD=1):
+            data = self.client.get(reverse('ride-list'), {'status': 'dropoff'}).json()
+        self.assertEqual(data['count'], estimate)
+        self.assertTrue(data['count_approximate'])
+
+        with self.settings(API_ESTIMATED_COUNT_THRESHOLD=1000):
+            data = self.client.get(reverse('ride-list'), {'status': 'dropoff'}).json()
+        self.assertEqual(data['count'], 18)
+        self.assertFalse(data['count_approximate'])
+
+    def test_event_list_and_async_list(self):
+        """Test the ride event list and the async ride list"""
+        data = self.client.get(reverse('rideevent-list')).json()
+        self.assertEqual(data['count'], 0)
+        self.assertFalse(data['count_approximate'])
+
+        data = self.client.get(reverse('async-ride-list'), {'page_size': 10, 'page': 3}).json()
+        self.assertEqual(data['count'], 24)
+        self.assertTrue(data['count_approximate'])
+        self.assertEqual(len(data['results']), 4)
+        self.assertIsNone(data['next'])
+        self.assertIn('page=2', data['previous'])
+
+
+class LargeTableAdminTest(TestCase):
+    """Test the ride and ride event admins built for large tables"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        self.client.force_login(DjangoUser.objects.create_superuser('large-admin', '', 'secret'))
+        self.rider = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='jane@example.com', phone_number='+1111111111'
+        )
+        self.driver = User.objects.create(
+            role='driver', first_name='Bob', last_name='Driver',
+            email='bob@example.com', phone_number='+2222222222'
+        )
+        self.rides = [
+            Ride.objects.create(
+                status='pickup', id_rider=self.rider, id_driver=self.driver,
+                pickup_latitude=Decimal('37.7749'), pickup_longitude=Decimal('-122.4194'),
+                dropoff_latitude=Decimal('37.8049'), dropoff_longitude=Decimal('-122.4494'),
+                pickup_time=timezone.now() - timedelta(days=days),
+            )
+            for days in (0, 3, 10)
+        ]
+        for ride in self.rides:
+            RideEvent.objects.create(id_ride=ride, description='Status changed to pickup')
+            RideEvent.objects.create(id_ride=ride, description='Driver arrived')
+
+    def changelist(self, model, **params):
+        response = self.client.get(reverse(f'admin:rides_{model}_changelist'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_search_by_id_or_prefix(self):
+        """Test that searches match ids exactly and text by prefix"""
+        ride = self.rides[0]
+        response = self.changelist('ride', q=str(ride.pk))
+        self.assertEqual(list(response.context['cl'].result_list), [ride])
+        response = self.changelist('ride', q='jane@')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        # Not a prefix
+        response = self.changelist('ride', q='example.com')
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+        # Event ids and ride ids
+        response = self.changelist('rideevent', q=str(ride.pk))
+        self.assertEqual({event.id_ride_id for event in response.context['cl'].result_list}, {ride.pk})
+        response = self.changelist('rideevent', q='Driver')
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_date_range_filter(self):
+        """Test the inclusive from/to date filter that replaces date_hierarchy"""
+        today = timezone.localdate()
+        response = self.changelist(
+            'ride', pickup_time__from=str(today - timedelta(days=5)), pickup_time__to=str(today)
+        )
+        self.assertEqual(set(response.context['cl'].result_list), set(self.rides[:2]))
+        self.assertContains(response, f'value="{today}"')
+        self.assertContains(response, 'name="pickup_time__from"')
+
+        response = self.changelist('ride', pickup_time__to=str(today - timedelta(days=7)))
+        self.assertEqual(list(response.context['cl'].result_list), [self.rides[2]])
+
+        response = self.client.get(reverse('admin:rides_ride_changelist'), {'pickup_time__from': 'yesterday'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_changelist_queries(self):
+        """Test estimated counts, and that the foreign keys are joined"""
+        from django.db import connection
+        with self.settings(API_ESTIMATED_COUNT_THRESHOLD=1):
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {RideEvent._meta.db_table}')
+            response = self.changelist('rideevent')
+            self.assertTrue(response.context['cl'].paginator.approximate)
+            self.assertContains(response, 'About 6 ride events')
+
+        with self.assertNumQueries(4):
+            # Session, user, count, and the page joined to its riders and drivers
+            response = self.changelist('ride')
+        self.assertFalse(response.context['cl'].paginator.approximate)
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+
+class RideSearchTest(APITestCase):
+    """Test full-text search of rides by rider and driver"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        self.client.force_login(DjangoUser.objects.create_superuser('search-admin', '', 'secret'))
+        self.jane = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='jane.rider@example.com', phone_number='+1 555 010 1111'
+        )
+        self.bob = User.objects.create(
+            role='driver', first_name='Bob', last_name='Driver',
+            email='bob@janestreet.com', phone_number='+1 555 020 2222'
+        )
+        self.mike = User.objects.create(
+            role='driver', first_name='Mike', last_name='Driver',
+            email='mike@example.com', phone_number='+1 555 030 3333'
+        )
+
+    def create_ride(self, rider, driver):
+        return Ride.objects.create(
+            status='pickup', id_rider=rider, id_driver=driver,
+            pickup_latitude=Decimal('37.7749'), pickup_longitude=Decimal('-122.4194'),
+            dropoff_latitude=Decimal('37.8049'), dropoff_longitude=Decimal('-122.4494'),
+            pickup_time=timezone.now(),
+        )
+
+    def search(self, q, **params):
+        response = self.client.get(reverse('ride-search'), {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def result_ids(self, q):
+        return [ride['id_ride'] for ride in self.search(q)['results']]
+
+    def test_documents_are_maintained(self):
+        """Test that documents follow rides and users, including bulk writes"""
+        ride = self.create_ride(self.jane, self.bob)
+        bulk_ride, = Ride.objects.bulk_create([Ride(
+            status='dropoff', id_rider=self.jane, id_driver=self.mike,
+            pickup_latitude=Decimal('37.7749'), pickup_longitude=Decimal('-122.4194'),
+            dropoff_latitude=Decimal('37.8049'), dropoff_longitude=Decimal('-122.4494'),
+            pickup_time=timezone.now(),
+        )])
+        self.assertEqual(self.result_ids('jane rider'), [bulk_ride.pk, ride.pk])
+        self.assertEqual(self.result_ids('mike'), [bulk_ride.pk])
+        self.assertEqual(self.result_ids('555 010'), [bulk_ride.pk, ride.pk])
+
+        # The rider is renamed
+        User.objects.filter(pk=self.jane.pk).update(first_name='Janet')
+        self.assertEqual(self.result_ids('janet'), [bulk_ride.pk, ride.pk])
+
+        # The driver is reassigned
+        ride.id_driver = self.mike
+        ride.save()
+        self.assertEqual(self.result_ids('bob'), [])
+        self.assertEqual(self.result_ids('mike driver'), [bulk_ride.pk, ride.pk])
+
+        # The document isn't loaded with rides
+        self.assertIn('search_document', Ride.objects.get(pk=ride.pk).get_deferred_fields())
+
+    def test_ranking(self):
+        """Test that names rank above emails"""
+        by_email = self.create_ride(self.mike, self.bob)
+        by_name = self.create_ride(self.jane, self.mike)
+        self.assertEqual(self.result_ids('jane'), [by_name.pk, by_email.pk])
+        self.assertEqual(self.result_ids('janestreet'), [by_email.pk])
+        self.assertEqual(self.result_ids('jane.rider@ex'), [by_name.pk])
+
+    def test_cursor_pages(self):
+        """Test that pages follow each other without gaps or duplicates"""
+        rides = [self.create_ride(self.jane, driver) for driver in (self.bob, self.mike) * 3]
+        ids = []
+        data = self.search('jane', page_size=4)
+        while True:
+            self.assertLessEqual(len(data['results']), 4)
+            ids.extend(ride['id_ride'] for ride in data['results'])
+            if data['next'] is None:
+                break
+            response = self.client.get(data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.json()
+        self.assertEqual(sorted(ids), sorted(ride.pk for ride in rides))
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_invalid_search(self):
+        """Test that a search needs words, and a valid cursor"""
+        url = reverse('ride-search')
+        for params in ({}, {'q': ' @. '}, {'q': 'jane', 'cursor': 'not-a-cursor'}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UserLookupTest(APITestCase):
+    """Test the typeahead user lookup"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User as DjangoUser
+        self.client.force_login(DjangoUser.objects.create_superuser('lookup-admin', '', 'secret'))
+        self.jane = User.objects.create(
+            role='rider', first_name='Jane', last_name='Rider',
+            email='jane.rider@example.com', phone_number='+1111111111'
+        )
+        self.janet = User.objects.create(
+            role='driver', first_name='Janet', last_name='Driver',
+            email='janet@example.com', phone_number='+2222222222'
+        )
+        self.bob = User.objects.create(
+            role='driver', first_name='Bob', last_name='Jansen',
+            email='bob@example.com', phone_number='+3333333333'
+        )
+
+    def lookup(self, role, q, **headers):
+        return self.client.get(reverse('user-lookup'), {'role': role, 'q': q}, **headers)
+
+    def result_ids(self, role, q):
+        response = self.lookup(role, q)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [user['id_user'] for user in response.json()]
+
+    def test_prefix_matches(self):
+        """Test matching the start of emails and names, by role"""
+        self.assertEqual(self.result_ids('driver', 'jan'), [self.bob.pk, self.janet.pk])
+        self.assertEqual(self.result_ids('rider', 'JAN'), [self.jane.pk])
+        self.assertEqual(self.result_ids('driver', 'janet@ex'), [self.janet.pk])
+        self.assertEqual(self.result_ids('driver', 'bob jan'), [self.bob.pk])
+        self.assertEqual(self.result_ids('driver', 'example'), [])
+
+    def test_limit(self):
+        """Test that lookups return at most API_USER_LOOKUP_LIMIT users"""
+        with self.settings(API_USER_LOOKUP_LIMIT=1):
+            self.assertEqual(self.result_ids('driver', 'jan'), [self.bob.pk])
+
+    def test_etag(self):
+        """Test that unchanged results are revalidated with a 304"""
+        response = self.lookup('driver', 'jan')
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('max-age=60', response['Cache-Control'])
+
+        response = self.lookup('driver', 'jan', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        User.objects.filter(pk=self.bob.pk).update(email='bobby@example.com')
+        response = self.lookup('driver', 'jan', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_invalid_lookup(self):
+        """Test that lookups need a valid role and some text"""
+        for role, q in (('', 'jan'), ('pilot', 'jan'), ('driver', ' ')):
+            self.assertEqual(self.lookup(role, q).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_is_indexed(self):
+        """Test that each condition of a lookup uses an index"""
+        from django.db import connection
+        from .search import lookup_users
+        User.objects.bulk_create(
+            User(role='driver', first_name=f'Driver{n}', last_name=f'User{n}',
+                 email=f'driver{n}@example.com', phone_number='+4444444444')
+            for n in range(2000)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE "user"')
+        for q in ('jan', 'bob jan'):
+            plan = lookup_users(User.objects.filter(role='driver'), q).explain()
+            for index in ('user_role_email_lookup_idx', 'user_role_first_lookup_idx', 'user_role_last_lookup_idx'):
+                self.assertIn(index, plan)
+
+
+class SharedSingleFlightTest(TransactionTestCase):
+    """Test sharing results across workers through a DatabaseCache"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.management import call_command
+        overrides = override_settings(
+            CACHES={**settings.CACHES, 'shared': {
+                'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                'LOCATION': 'single_flight_cache',
+            }},
+            SINGLE_FLIGHT_CACHE_ALIAS='shared',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        call_command('createcachetable', 'single_flight_cache', verbosity=0)
+
+    def tearDown(self):
+        from django.core.cache import caches
+        caches['shared'].clear()
+
+    def test_waiting_workers_read_the_result_once_committed(self):
+        """Test that a worker waits for the result of one still in its transaction"""
+        import threading
+        import time
+        from django.db import connection, transaction
+        from .coalescing import SingleFlight
+        computing = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            computing.set()
+            time.sleep(0.2)
+            return {'rides': [1, 2, 3]}
+
+        def leader():
+            try:
+                # The request's transaction (see rides/timeouts.py)
+                with transaction.atomic():
+                    results.append(SingleFlight('test').do('key', compute))
+                    # The rest of the request, before it commits
+                    time.sleep(0.3)
+            finally:
+                connection.close()
+
+        def follower():
+            try:
+                results.append(SingleFlight('test').do('key', compute))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=leader), threading.Thread(target=follower)]
+        threads[0].start()
+        computing.wait(5)
+        threads[1].start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'rides': [1, 2, 3]}] * 2)
+
+    def test_cache_is_read_and_written_on_the_primary(self):
+        """Test that shared cache entries don't go through the replica"""
+        from unittest import mock
+        from django.core.cache import caches
+        from .replicas import ReplicaRouter, RoutingState, current_routing
+        token = current_routing.set(RoutingState(use_replica=True))
+        self.addCleanup(current_routing.reset, token)
+        cache_model = caches['shared'].cache_model_class
+        router = ReplicaRouter()
+
+        with mock.patch('rides.replicas.replica_configured', return_value=True):
+            self.assertEqual(router.db_for_read(Ride), 'replica')
+            self.assertEqual(router.db_for_read(cache_model), 'default')
+            self.assertEqual(router.db_for_write(cache_model), 'default')
+            # Storing a result isn't a write that keeps the client on the primary
+            self.assertFalse(current_routing.get().wrote)
@@ -0,0 +1,144 @@
+"""
+Per-client request throttling with token buckets.
+
+Each client (the user, or the client address when not logged in) gets a
+bucket of tokens per throttle scope. A request takes a token; tokens come
+back at the scope's rate, up to the rate's number of requests. A client
+can therefore send a burst of that many requests at once, then keeps
+going at the rate. A request finding the bucket empty gets a 429 with a
+Retry-After header telling when the next token arrives.
+
+The rates are the DRF `DEFAULT_THROTTLE_RATES`, per scope:
+
+    'api'     everything not in another scope
+    'gps'     ride lists sorted by distance to a GPS position
+    'export'  large list pages (streamed)
+    'changes' the change feed, read page after page by clients catching up
+    'report'  the metrics and memory reports
+
+Views pick their scope with `throttle_scope`, or `get_throttle_scope()`
+when it depends on the request. A rate of None turns throttling off for
+the scope.
+
+The buckets are kept in each worker process, so no cache server is
+needed, but a client whose requests are spread over several workers or
+machines can get up to that many times the rate.
+"""
+from collections import OrderedDict
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+import threading
+import time
+
+from . import metrics
+
+DEFAULT_SCOPE = 'api'
+
+# Seconds in the periods of a DRF rate ('30/min')
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    (capacity, tokens per second) for a DRF style rate like '30/min', or
+    None for no rate.
+    """
+    if rate is None:
+        return None
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period[0]]
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class BucketStore:
+    """
+    Token buckets of this process, keyed by scope and client.
+
+    Holds at most `max_buckets`; the least recently used go first. A
+    dropped bucket comes back full, which only lets its client through
+    earlier.
+    """
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, now=None):
+        """
+        Take a token from the bucket of `key`. Returns 0 if there was one,
+        otherwise the seconds until there is.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(capacity, now)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * refill_rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / refill_rate
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+buckets = BucketStore()
+
+
+def client_ident(request, user):
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    # The client address, honouring X-Forwarded-For as DRF does
+    return f'address:{BaseThrottle().get_ident(request)}'
+
+
+def throttle_wait(request, user, scope):
+    """
+    Take a token for a request in `scope`. Returns None if it may go
+    ahead, otherwise the seconds until it may.
+    """
+    rate = parse_rate(api_settings.DEFAULT_THROTTLE_RATES.get(scope))
+    if rate is None:
+        return None
+    capacity, refill_rate = rate
+    wait = buckets.take(f'{scope}:{client_ident(request, user)}', capacity, refill_rate)
+    if not wait:
+        return None
+    metrics.throttled_requests.labels(scope).inc()
+    return wait
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle a DRF view by the scope it picks (see the module docstring).
+    """
+
+    def allow_request(self, request, view):
+        get_scope = getattr(view, 'get_throttle_scope', None)
+        if get_scope is not None:
+            scope = get_scope(request)
+        else:
+            scope = getattr(view, 'throttle_scope', DEFAULT_SCOPE)
+        self.wait_seconds = throttle_wait(request, request.user, scope)
+        return self.wait_seconds is None
+
+    def wait(self):
+        # DRF sends it as Retry-After, rounded up to whole seconds
+        return self.wait_seconds
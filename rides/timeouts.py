@@ -0,0 +1,99 @@
+"""
+Statement timeouts per view, and degraded responses when they expire.
+
+A slow query holds a worker thread and a database connection for as long
+as it runs. The GET requests of the API views (see StatementTimeoutMixin
+in rides/mixins.py) therefore run in a transaction that starts with
+
+    SET LOCAL statement_timeout = <milliseconds>
+
+so PostgreSQL cancels any of their queries that runs past the view's
+budget: its `statement_timeout` attribute, or API_STATEMENT_TIMEOUT_MS.
+SET LOCAL ends with the transaction, so the timeout never stays behind
+on a connection another request reuses (pooled connections aren't reset
+between requests, see rides/backends/postgresql_pool).
+
+Parts of a response the client can do without are computed with
+optional_query(), in a savepoint. When one of them times out, the
+savepoint is rolled back and the response goes out without that part
+(e.g. `"count": null` in a list), with an X-Degraded header naming what
+is missing. A query the response can't do without gives a 503.
+
+Writes keep the database's own statement_timeout, as do the rows of
+streamed responses (read after the view returns), the ride event shards
+and the async views.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import OperationalError, connections, transaction
+from psycopg2 import errors
+from rest_framework.exceptions import APIException
+
+from . import metrics
+
+
+class TimeoutState:
+    """
+    The statement timeout transaction of the current request.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        # Parts left out of the response, in the order they timed out
+        self.degraded = []
+
+
+current_timeout = ContextVar('current_timeout', default=None)
+
+
+class StatementTimeout(APIException):
+    status_code = 503
+    default_detail = 'The request took too long. Try again later, or narrow it down with filters.'
+    default_code = 'statement_timeout'
+
+
+def is_statement_timeout(exc):
+    """
+    Whether a database error is PostgreSQL canceling a query that ran
+    past statement_timeout.
+    """
+    return isinstance(exc, OperationalError) and isinstance(exc.__cause__, errors.QueryCanceled)
+
+
+@contextmanager
+def statement_timeout(milliseconds, using):
+    """
+    Run the block in a transaction on database `using` in which queries
+    time out after `milliseconds`. Yields the TimeoutState.
+    """
+    state = TimeoutState(using)
+    token = current_timeout.set(state)
+    try:
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [int(milliseconds)])
+            yield state
+    finally:
+        current_timeout.reset(token)
+
+
+def optional_query(part, func, default=None):
+    """
+    Return func(), or `default` if one of its queries times out.
+
+    Inside a statement_timeout() block, func() runs in a savepoint, so
+    the request's transaction survives the timeout, and `part` is
+    recorded as missing from the response. Elsewhere func() just runs.
+    """
+    state = current_timeout.get()
+    if state is None:
+        return func()
+    try:
+        with transaction.atomic(using=state.using):
+            return func()
+    except OperationalError as e:
+        if not is_statement_timeout(e):
+            raise
+    metrics.statement_timeouts.labels(part).inc()
+    state.degraded.append(part)
+    return default
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, RideViewSet, RideEventViewSet
+from .views import UserViewSet, RideViewSet, RideEventViewSet, ChangeFeedView, MetricsView, MemoryView
+from . import async_views
 from .auth_views import login_view, logout_view, current_user_view, check_auth_view, csrf_view
 
 router = DefaultRouter()
@@ -10,10 +11,17 @@ router.register(r'ride-events', RideEventViewSet, basename='rideevent')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('changes/', ChangeFeedView.as_view(), name='changes'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path('memory/', MemoryView.as_view(), name='memory'),
     # Authentication endpoints
     path('auth/csrf/', csrf_view, name='auth-csrf'),
     path('auth/login/', login_view, name='auth-login'),
     path('auth/logout/', logout_view, name='auth-logout'),
     path('auth/user/', current_user_view, name='auth-current-user'),
     path('auth/check/', check_auth_view, name='auth-check'),
+    # Async (ASGI) versions of the read-only ride endpoints
+    path('async/rides/', async_views.ride_list, name='async-ride-list'),
+    path('async/rides/<int:pk>/', async_views.ride_detail, name='async-ride-detail'),
+    path('async/ride-events/', async_views.ride_event_list, name='async-rideevent-list'),
 ]
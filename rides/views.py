@@ -1,32 +1,159 @@
 from rest_framework import viewsets, filters
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Prefetch, Q
+from django.conf import settings
+from django.db.models import F, Prefetch, Q, prefetch_related_objects
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db.models.functions import ACos, Cos, Radians, Sin
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
 from datetime import timedelta
+import hashlib
+import json
 
 from .models import User, Ride, RideEvent
-from .serializers import UserSerializer, RideSerializer, RideListSerializer, RideEventSerializer
-from .permissions import IsAdminUser
+from .serializers import (
+    UserSerializer, RideSerializer, RideListSerializer, RideEventSerializer,
+    RideChangeSerializer, RideEventChangeSerializer,
+)
+from .permissions import HasMetricsToken, IsAdminUser
 from .filters import RideFilter
+from .changes import InvalidCursor, decode_cursor, encode_cursor, get_changes
+from .event_stream import RideEventStream, hub
+from .renderers import EventStreamRenderer, StreamingJSONRenderer
+from .mixins import InstrumentedViewMixin, StatementTimeoutMixin, StreamingListMixin
+from .pagination import EstimatedCountPagination
+from .coalescing import SingleFlight, request_key
+from .metrics import render_metrics
+from .sharding import events_queryset, prefetch_todays_events, shard_for_event, sharding_enabled
+from .search import decode_search_cursor, encode_search_cursor, lookup_users, search_query, search_rides
+from .timeouts import current_timeout, optional_query
+from . import memory
 
 
-class UserViewSet(viewsets.ModelViewSet):
+def todays_events_prefetch():
+    """
+    Prefetch for a ride's events from the last 24 hours.
+
+    The events are stored on `todays_ride_events_prefetch`, which the ride
+    serializers use instead of querying each ride's events.
+    """
+    # Calculate 24 hours ago for today's events filter
+    cutoff_time = timezone.now() - timedelta(hours=24)
+
+    return Prefetch(
+        'ride_events',
+        queryset=RideEvent.objects.filter(created_at__gte=cutoff_time).order_by('-created_at'),
+        to_attr='todays_ride_events_prefetch'
+    )
+
+
+def ride_queryset():
+    """
+    Rides with rider, driver and today's events, loaded in 2 queries.
+
+    With sharded ride events, the events can't be prefetched through the
+    queryset (its prefetch reads a single database): the rides are loaded
+    on their own and prefetch_todays_events() adds them.
+    """
+    queryset = Ride.objects.select_related(
+        'id_rider',   # ForeignKey to User (rider)
+        'id_driver'   # ForeignKey to User (driver)
+    )
+    if sharding_enabled():
+        return queryset
+    return queryset.prefetch_related(
+        todays_events_prefetch()  # Only today's events
+    )
+
+
+def get_distance_origin(query_params):
+    """
+    Return the (latitude, longitude) to sort rides by distance from, if any.
+
+    Invalid coordinates are ignored, as if none had been given.
+    """
+    lat = query_params.get('latitude')
+    lon = query_params.get('longitude')
+
+    if lat and lon:
+        try:
+            return float(lat), float(lon)
+        except (ValueError, TypeError):
+            pass
+    return None
+
+
+def order_by_distance(queryset, lat, lon):
+    """
+    Annotate rides with their pickup distance in km and sort by it.
+    """
+    # Haversine formula for distance calculation
+    # This is database-level calculation for efficiency
+    return queryset.annotate(
+        distance=ACos(
+            Cos(Radians(lat)) *
+            Cos(Radians(F('pickup_latitude'))) *
+            Cos(Radians(F('pickup_longitude')) - Radians(lon)) +
+            Sin(Radians(lat)) *
+            Sin(Radians(F('pickup_latitude')))
+        ) * 6371  # Earth's radius in km
+    ).order_by('distance')
+
+
+class UserViewSet(InstrumentedViewMixin, StatementTimeoutMixin, StreamingListMixin, viewsets.ModelViewSet):
     """
     ViewSet for User model.
     Only accessible by admin users.
-    Returns all users without pagination for dropdown lists.
+    Returns all users without pagination.
+    The list is streamed, so it is never held in memory all at once.
+    Rider and driver pickers use the `lookup` action instead.
     """
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
+    replica_actions = ('list', 'retrieve', 'lookup')
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['email', 'first_name', 'last_name']
     ordering_fields = ['id_user', 'email', 'role']
     pagination_class = None  # Disable pagination to return all users
 
+    @action(detail=False)
+    def lookup(self, request):
+        """
+        Typeahead lookup: the first API_USER_LOOKUP_LIMIT users of `role`
+        whose email, or first and last names, start with `q` (see
+        rides/search.py).
+
+        GET /api/users/lookup/?role=driver&q=<text>
 
-class RideViewSet(viewsets.ModelViewSet):
+        Responses carry an ETag, and browsers may reuse them for
+        API_USER_LOOKUP_MAX_AGE seconds before revalidating it.
+        """
+        role = request.query_params.get('role', '')
+        if role not in dict(User.ROLE_CHOICES):
+            raise ValidationError({'role': [f'"{role}" is not a valid choice.']})
+        text = request.query_params.get('q', '')
+        if not text.strip():
+            raise ValidationError({'q': ['Enter the start of a name or email.']})
+
+        users = lookup_users(User.objects.filter(role=role), text)[:settings.API_USER_LOOKUP_LIMIT]
+        data = self.get_serializer(users, many=True).data
+        digest = hashlib.md5(json.dumps(data, sort_keys=True).encode(), usedforsecurity=False)
+        response = Response(data)
+        response['ETag'] = quote_etag(digest.hexdigest())
+        patch_cache_control(response, private=True, max_age=settings.API_USER_LOOKUP_MAX_AGE)
+        # 304 Not Modified when the client already has these results
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+class RideViewSet(InstrumentedViewMixin, StatementTimeoutMixin, StreamingListMixin, viewsets.ModelViewSet):
     """
     ViewSet for Ride model with optimized queries.
 
@@ -38,15 +165,72 @@ class RideViewSet(viewsets.ModelViewSet):
     Features:
     - Filtering by status and rider email
     - Sorting by pickup_time and distance to pickup location
-    - Pagination
+    - Pagination, streamed for large page sizes, with estimated counts
+      for large lists
+    - Identical concurrent list requests share one computation
+    - Full-text search by rider and driver, with cursor pagination
+    - List and detail reads go to the read replica, when there is one
+    - Today's events are read from each ride event shard, when sharded
+    - Reads time out after 5 seconds; lists degrade rather than fail when
+      the count or today's events time out
     - Admin-only access
     """
     serializer_class = RideListSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
+    replica_actions = ('list', 'retrieve', 'search')
+    statement_timeout = 5000
+    pagination_class = EstimatedCountPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_class = RideFilter
     ordering_fields = ['pickup_time']
-    ordering = ['-pickup_time']
+
+    @property
+    def ordering(self):
+        """
+        Default ordering, unless the rides are being sorted by distance.
+
+        OrderingFilter applies the default ordering after get_queryset(),
+        which would otherwise replace the distance ordering.
+        """
+        if get_distance_origin(self.request.query_params) is not None:
+            return None
+        return ['-pickup_time']
+
+    # Shared by all RideViewSet instances in this process
+    list_flight = SingleFlight('ride-list')
+
+    def list(self, request, *args, **kwargs):
+        """
+        List rides, sharing the result between identical concurrent requests.
+
+        Dashboards tend to send the same (often distance sorted) request
+        many times at once. The first one runs the queries and the others
+        wait for its data, and for the parts it left out when they timed out
+        (see rides/timeouts.py). Streamed responses are never shared, as
+        they are not held in memory.
+        """
+        if not settings.RIDE_LIST_SINGLE_FLIGHT or self.should_stream(request):
+            return super().list(request, *args, **kwargs)
+
+        def compute():
+            state = current_timeout.get()
+            degraded_before = len(state.degraded) if state is not None else 0
+            data = super(RideViewSet, self).list(request, *args, **kwargs).data
+            return data, state.degraded[degraded_before:] if state is not None else []
+
+        data, degraded = self.list_flight.do(request_key(request), compute)
+        state = current_timeout.get()
+        if state is not None:
+            state.degraded.extend(degraded)
+        return Response(data)
+
+    def get_throttle_scope(self, request):
+        """
+        Distance sorted lists are throttled more strictly than other reads.
+        """
+        if self.action == 'list' and get_distance_origin(request.query_params) is not None:
+            return 'gps'
+        return super().get_throttle_scope(request)
 
     def get_queryset(self):
         """
@@ -57,50 +241,12 @@ class RideViewSet(viewsets.ModelViewSet):
         2. Prefetch query for today's ride events
         (3rd query is for pagination count)
         """
-        # Calculate 24 hours ago for today's events filter
-        cutoff_time = timezone.now() - timedelta(hours=24)
-
-        # Create a custom prefetch for today's ride events only
-        todays_events_prefetch = Prefetch(
-            'ride_events',
-            queryset=RideEvent.objects.filter(created_at__gte=cutoff_time).order_by('-created_at'),
-            to_attr='todays_ride_events_prefetch'
-        )
-
-        # Build the optimized queryset
-        queryset = Ride.objects.select_related(
-            'id_rider',   # ForeignKey to User (rider)
-            'id_driver'   # ForeignKey to User (driver)
-        ).prefetch_related(
-            todays_events_prefetch  # Only today's events
-        )
+        queryset = ride_queryset()
 
         # Handle GPS-based distance sorting if provided
-        lat = self.request.query_params.get('latitude')
-        lon = self.request.query_params.get('longitude')
-
-        if lat and lon:
-            try:
-                lat = float(lat)
-                lon = float(lon)
-                # Add distance annotation and ordering
-                # Using Haversine formula approximation
-                from django.db.models import F, FloatField
-                from django.db.models.functions import ACos, Cos, Radians, Sin
-
-                # Haversine formula for distance calculation
-                # This is database-level calculation for efficiency
-                queryset = queryset.annotate(
-                    distance=ACos(
-                        Cos(Radians(lat)) *
-                        Cos(Radians(F('pickup_latitude'))) *
-                        Cos(Radians(F('pickup_longitude')) - Radians(lon)) +
-                        Sin(Radians(lat)) *
-                        Sin(Radians(F('pickup_latitude')))
-                    ) * 6371  # Earth's radius in km
-                ).order_by('distance')
-            except (ValueError, TypeError):
-                pass  # Invalid coordinates, ignore distance sorting
+        origin = get_distance_origin(self.request.query_params)
+        if origin is not None:
+            queryset = order_by_distance(queryset, *origin)
 
         return queryset
 
@@ -108,12 +254,86 @@ class RideViewSet(viewsets.ModelViewSet):
         """
         Use different serializers for list and detail views.
         """
-        if self.action == 'list':
+        if self.action in ('list', 'search'):
             return RideListSerializer
         return RideSerializer
 
+    def paginate_queryset(self, queryset):
+        """
+        The page of rides, with today's events fetched separately from the
+        rides: they are optional (see rides/timeouts.py), and listed as
+        null when their query times out.
+
+        Streamed pages keep the prefetch in the queryset, as their rows are
+        read after the view returns.
+        """
+        if self.should_stream(self.request) and not sharding_enabled():
+            return super().paginate_queryset(queryset)
+
+        page = super().paginate_queryset(queryset.prefetch_related(None))
+        if page is None:
+            return None
+        return self.add_todays_events(list(page))
+
+    def add_todays_events(self, rides):
+        """
+        Prefetch today's events of `rides`, or set them to None if that
+        times out.
+        """
+        def prefetch():
+            if sharding_enabled():
+                return prefetch_todays_events(rides)
+            prefetch_related_objects(rides, todays_events_prefetch())
+            return rides
+
+        if optional_query('todays_ride_events', prefetch) is None:
+            for ride in rides:
+                ride.todays_ride_events_prefetch = None
+        return rides
+
+    def get_object(self):
+        ride = super().get_object()
+        if sharding_enabled():
+            prefetch_todays_events([ride])
+        return ride
+
+    @action(detail=False)
+    def search(self, request):
+        """
+        Rides whose rider or driver matches `q` by name, email or phone
+        number, best matches first (see rides/search.py).
+
+        GET /api/rides/search/?q=<words>&page_size=<n>
+
+        Follow `next` for the following page.
+        """
+        query = search_query(request.query_params.get('q', ''))
+        if query is None:
+            raise ValidationError({'q': ['Enter a name, email or phone number.']})
+        cursor = request.query_params.get('cursor')
+        try:
+            after = decode_search_cursor(cursor) if cursor else None
+        except InvalidCursor:
+            raise ValidationError({'cursor': ['Invalid cursor.']})
+        page_size = self.paginator.get_page_size(request)
 
-class RideEventViewSet(viewsets.ModelViewSet):
+        # One more row tells whether there is a next page
+        rides = list(search_rides(ride_queryset().prefetch_related(None), query, after)[:page_size + 1])
+        next_link = None
+        if len(rides) > page_size:
+            rides = rides[:page_size]
+            next_link = replace_query_param(
+                request.build_absolute_uri(), 'cursor', encode_search_cursor(rides[-1])
+            )
+
+        self.add_todays_events(rides)
+        return Response({
+            'next': next_link,
+            'results': self.get_serializer(rides, many=True).data,
+        })
+
+
+class RideEventViewSet(InstrumentedViewMixin, StatementTimeoutMixin, StreamingListMixin, viewsets.ModelViewSet):
     """
     ViewSet for RideEvent model.
     Only accessible by admin users.
@@ -121,7 +341,251 @@ class RideEventViewSet(viewsets.ModelViewSet):
     queryset = RideEvent.objects.select_related('id_ride').all()
     serializer_class = RideEventSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
+    # Not the event stream: it is woken up by events just committed on the primary
+    replica_actions = ('list', 'retrieve')
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['id_ride', 'description']
     ordering_fields = ['created_at']
     ordering = ['-created_at']
+    statement_timeout = 5000
+    pagination_class = EstimatedCountPagination
+
+    # Most events replayed to a stream that reconnects with Last-Event-ID
+    stream_backlog_limit = 100
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if sharding_enabled():
+            # A shard has no rides to join to (the serializer only needs the id)
+            queryset = queryset.select_related(None)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        """
+        With sharded ride events, read an event from the shard its id
+        belongs to, and lists from the shard of the `id_ride` filter or,
+        without one, from every shard (see rides/sharding.py).
+        """
+        queryset = super().filter_queryset(queryset)
+        if not sharding_enabled():
+            return queryset
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if lookup is not None:
+            # Not str.isdigit(): it accepts digits such as '²' that int() rejects
+            try:
+                return queryset.using(shard_for_event(int(lookup)))
+            except ValueError:
+                raise Http404
+        id_ride = self.request.query_params.get('id_ride')
+        # The filterset has already rejected ids that aren't integers
+        return events_queryset(queryset, int(id_ride) if id_ride else None)
+
+    @action(detail=False, renderer_classes=[EventStreamRenderer, StreamingJSONRenderer])
+    def stream(self, request):
+        """
+        Server-Sent Events stream of newly created ride events.
+
+        GET /api/ride-events/stream/?id_ride=<id>&status=<ride status>
+
+        Both filters are optional. The stream closes after
+        RIDE_EVENT_STREAM_MAX_SECONDS (or `?timeout=` seconds, if shorter);
+        clients reconnecting with a Last-Event-ID header first get the
+        matching events they missed. A process holds at most
+        RIDE_EVENT_STREAM_MAX_CONNECTIONS streams open; past that, new
+        streams get a 503 with Retry-After.
+        """
+        params = request.query_params
+        errors = {}
+        id_ride = status_filter = None
+        duration = settings.RIDE_EVENT_STREAM_MAX_SECONDS
+
+        if params.get('id_ride'):
+            try:
+                id_ride = int(params['id_ride'])
+            except ValueError:
+                errors['id_ride'] = ['A valid integer is required.']
+        if params.get('status'):
+            status_filter = params['status']
+            if status_filter not in dict(Ride.STATUS_CHOICES):
+                errors['status'] = [f'"{status_filter}" is not a valid choice.']
+        if params.get('timeout'):
+            try:
+                duration = min(max(int(params['timeout']), 1), duration)
+            except ValueError:
+                errors['timeout'] = ['A valid integer is required.']
+        if errors:
+            raise ValidationError(errors)
+
+        # Subscribe before reading the backlog, so nothing falls in between
+        subscription = hub.subscribe(id_ride=id_ride, status=status_filter)
+        try:
+            backlog = self.get_stream_backlog(request, id_ride, status_filter)
+        except BaseException:
+            hub.unsubscribe(subscription)
+            raise
+
+        response = StreamingHttpResponse(
+            RideEventStream(subscription, backlog, duration=duration),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Stop proxies from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get_stream_backlog(self, request, id_ride, status_filter):
+        """
+        Events created after the client's Last-Event-ID, if it sent one.
+        """
+        try:
+            last_event_id = int(request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            return []
+
+        if sharding_enabled():
+            return self.get_sharded_stream_backlog(last_event_id, id_ride, status_filter)
+
+        queryset = RideEvent.objects.select_related('id_ride').filter(pk__gt=last_event_id)
+        if id_ride is not None:
+            queryset = queryset.filter(id_ride=id_ride)
+        if status_filter is not None:
+            queryset = queryset.filter(id_ride__status=status_filter)
+
+        return [
+            {'status': event.id_ride.status, 'event': RideEventSerializer(event).data}
+            for event in queryset.order_by('pk')[:self.stream_backlog_limit]
+        ]
+
+    def get_sharded_stream_backlog(self, last_event_id, id_ride, status_filter):
+        """
+        The backlog from sharded events, with the ride statuses read from
+        the primary: the status filter applies after the limit.
+        """
+        queryset = RideEvent.objects.filter(pk__gt=last_event_id).order_by('pk')
+        if id_ride is not None:
+            queryset = queryset.filter(id_ride=id_ride)
+        events = events_queryset(queryset, id_ride)[:self.stream_backlog_limit]
+        statuses = dict(
+            Ride.objects.filter(pk__in={event.id_ride_id for event in events})
+            .values_list('pk', 'status')
+        )
+        return [
+            {'status': statuses[event.id_ride_id], 'event': RideEventSerializer(event).data}
+            for event in events
+            if event.id_ride_id in statuses and status_filter in (None, statuses[event.id_ride_id])
+        ]
+
+
+class ChangeFeedView(InstrumentedViewMixin, StatementTimeoutMixin, APIView):
+    """
+    Rides and ride events created or modified since a cursor.
+
+    GET /api/changes/?since=<cursor>&limit=<n>
+
+    Without `since`, the feed starts from the beginning. Each response
+    holds up to `limit` rows per table, oldest change first, plus the
+    cursor to pass as `since` on the next call. `has_more` tells whether
+    more changes are already waiting.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    replica_actions = ('get',)
+    default_limit = 100
+    throttle_scope = 'changes'
+
+    def get(self, request):
+        since = request.query_params.get('since')
+        try:
+            positions = decode_cursor(since) if since else {}
+        except InvalidCursor:
+            raise ValidationError({'since': ['Invalid cursor.']})
+
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            raise ValidationError({'limit': ['A valid integer is required.']})
+        limit = max(1, min(limit, settings.API_MAX_PAGE_SIZE))
+
+        changes, positions, has_more = get_changes(positions, limit)
+        return Response({
+            'rides': RideChangeSerializer(changes['rides'], many=True).data,
+            'ride_events': RideEventChangeSerializer(changes['ride_events'], many=True).data,
+            'next': encode_cursor(positions) if positions else None,
+            'has_more': has_more,
+        })
+
+
+class MetricsView(InstrumentedViewMixin, APIView):
+    """
+    Prometheus metrics for all workers of this machine, in text format.
+
+    GET /api/metrics
+
+    Open to admins, and to scrapers sending the METRICS_TOKEN as a bearer
+    token.
+    """
+    permission_classes = [HasMetricsToken | (IsAuthenticated & IsAdminUser)]
+    throttle_scope = 'report'
+
+    def get(self, request):
+        body, content_type = render_metrics()
+        return HttpResponse(body, content_type=content_type)
+
+
+class MemoryView(InstrumentedViewMixin, APIView):
+    """
+    Heap snapshots of the worker that serves the request (tracemalloc).
+
+    GET     memory in use and the top allocation sites; once a baseline
+            was taken, what changed since the baseline instead
+    POST    start tracing if needed and take a new baseline snapshot
+    DELETE  drop the baseline, and stop tracing unless
+            MEMORY_TRACING_ENABLED keeps it on
+
+    `?limit=` sets how many sites are listed, `?group=` groups them by
+    `lineno` (default), `filename` or `traceback`.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_scope = 'report'
+    default_limit = 25
+    max_limit = 100
+    groups = ['lineno', 'filename', 'traceback']
+
+    def get_options(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            raise ValidationError({'limit': ['A valid integer is required.']})
+        group = request.query_params.get('group', 'lineno')
+        if group not in self.groups:
+            raise ValidationError({'group': [f'"{group}" is not a valid choice.']})
+        return max(1, min(limit, self.max_limit)), group
+
+    def get(self, request):
+        limit, group = self.get_options(request)
+        data = memory.traced_memory()
+        if not data['tracing']:
+            return Response(data)
+
+        snapshot = memory.take_snapshot()
+        baseline = memory.snapshots.baseline
+        if baseline is None:
+            data['top'] = memory.top_allocations(snapshot, limit, group)
+        else:
+            data['baseline_taken_at'] = memory.snapshots.taken_at
+            data['diff'] = memory.allocation_diff(snapshot, baseline, limit, group)
+        return Response(data)
+
+    def post(self, request):
+        limit, group = self.get_options(request)
+        memory.start_tracing()
+        snapshot = memory.snapshots.take_baseline(timezone.now())
+        data = memory.traced_memory()
+        data['baseline_taken_at'] = memory.snapshots.taken_at
+        data['top'] = memory.top_allocations(snapshot, limit, group)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        memory.snapshots.clear()
+        if not settings.MEMORY_TRACING_ENABLED:
+            memory.stop_tracing()
+        return Response(status=status.HTTP_204_NO_CONTENT)
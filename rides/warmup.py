@@ -0,0 +1,224 @@
+"""
+Warming up a process before it serves requests, and measuring startup.
+
+Fly machines stop when idle (`auto_stop_machines` in fly.toml), so the
+first request after a while waits for the server to start. Besides
+importing everything, Django and DRF leave work for the first requests:
+populating the URL resolver, importing the classes named in the DRF
+and middleware settings, building model metadata and serializer fields,
+loading translations and connecting to the database. gunicorn does it up front
+instead (see config/gunicorn_conf.py):
+
+- With --preload, warm_up() runs once in the arbiter, before it forks
+  the workers, so they start with all of it done.
+- Each worker then opens its database connections with
+  warm_up_connections() before accepting requests. They can't be opened
+  before the fork, as the workers would share the sockets.
+
+`python manage.py startup_audit` measures a cold start in a fresh
+interpreter and reports where the import time goes.
+"""
+from contextlib import contextmanager
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils.module_loading import import_string
+from importlib import import_module
+import inspect
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fresh interpreter may take to be ready to serve, from start
+# to warmed up (before connecting to the database). Checked by the test
+# suite (times COLD_START_MARGIN from the environment, for slow machines);
+# `startup_audit` shows where the time goes when it fails.
+COLD_START_TARGET_SECONDS = 2.0
+
+# The DRF settings naming classes that are imported on first use
+API_CLASS_SETTINGS = [
+    'DEFAULT_RENDERER_CLASSES',
+    'DEFAULT_PARSER_CLASSES',
+    'DEFAULT_AUTHENTICATION_CLASSES',
+    'DEFAULT_PERMISSION_CLASSES',
+    'DEFAULT_THROTTLE_CLASSES',
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS',
+    'DEFAULT_METADATA_CLASS',
+    'DEFAULT_VERSIONING_CLASS',
+    'DEFAULT_PAGINATION_CLASS',
+    'DEFAULT_FILTER_BACKENDS',
+    'EXCEPTION_HANDLER',
+]
+
+
+@contextmanager
+def timed(timings, step):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = time.perf_counter() - start
+
+
+def warm_up():
+    """
+    Do the work the first requests would otherwise do, without touching
+    the database. Returns {step: seconds}.
+    """
+    from django.urls import get_resolver
+    from django.utils import translation
+    from rest_framework.serializers import BaseSerializer
+    from rest_framework.settings import api_settings
+    from . import serializers
+
+    timings = {}
+    with timed(timings, 'urls'):
+        # Imports every view, then compiles the pattern regexes
+        resolver = get_resolver()
+        resolver.reverse_dict
+        compile_patterns(resolver)
+    with timed(timings, 'middleware'):
+        # Imported by the session and message middleware on first use
+        import_module(settings.SESSION_ENGINE)
+        import_string(settings.SESSION_SERIALIZER)
+        import_string(settings.MESSAGE_STORAGE)
+    with timed(timings, 'api_settings'):
+        for name in API_CLASS_SETTINGS:
+            getattr(api_settings, name)
+    with timed(timings, 'models'):
+        for model in apps.get_models():
+            model._meta.get_fields()
+    with timed(timings, 'serializers'):
+        for _, serializer_class in inspect.getmembers(serializers, inspect.isclass):
+            if issubclass(serializer_class, BaseSerializer) and serializer_class.__module__ == serializers.__name__:
+                serializer_class().fields
+    with timed(timings, 'translations'):
+        translation.gettext('This field is required.')
+
+    logger.info(
+        'Warmed up in %.0f ms (%s)', sum(timings.values()) * 1000,
+        ', '.join(f'{step} {seconds * 1000:.0f} ms' for step, seconds in timings.items())
+    )
+    return timings
+
+
+def compile_patterns(resolver):
+    for pattern in resolver.url_patterns:
+        pattern.pattern.regex
+        if hasattr(pattern, 'url_patterns'):
+            compile_patterns(pattern)
+
+
+def warm_up_connections():
+    """
+    Connect to every database, so the first request doesn't wait for it.
+
+    Pooled connections (see rides/backends/postgresql_pool) go back to the
+    pool for the requests to use. Others are closed again, as they belong
+    to the calling thread, but the first connection of a process still
+    does the most work (e.g. importing and registering psycopg2 types).
+    A database that can't be reached is logged and left for the requests
+    to report. Returns {alias: seconds}.
+    """
+    timings = {}
+    for alias in connections:
+        connection = connections[alias]
+        try:
+            with timed(timings, alias):
+                connection.ensure_connection()
+        except DatabaseError as e:
+            logger.warning("Couldn't connect to '%s' while warming up: %s", alias, e)
+        finally:
+            connection.close()
+    return timings
+
+
+# Run by measure_startup() in a fresh interpreter; prints the time each
+# phase took as JSON, and what warming up left done (the databases it
+# connected to, whether the URL resolver is populated)
+STARTUP_SCRIPT = '''
+import json, sys, time
+from django.db import connections
+phases = {}
+start = time.perf_counter()
+import django
+django.setup()
+phases['setup'] = time.perf_counter() - start
+mark = time.perf_counter()
+import config.wsgi
+phases['application'] = time.perf_counter() - mark
+mark = time.perf_counter()
+from rides.warmup import warm_up, warm_up_connections
+steps = warm_up()
+phases['warm_up'] = time.perf_counter() - mark
+phases['warm_up_steps'] = steps
+phases['warm_up_connections'] = [alias for alias in connections if connections[alias].connection is not None]
+from django.urls import get_resolver
+phases['urls_populated'] = get_resolver()._populated
+if '--connect' in sys.argv:
+    mark = time.perf_counter()
+    warm_up_connections()
+    phases['connect'] = time.perf_counter() - mark
+print(json.dumps(phases))
+'''
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def parse_import_times(output):
+    """
+    Parse the stderr of `python -X importtime` into a list of
+    {'module', 'self_ms', 'cumulative_ms', 'depth'} dicts, in import order
+    (a module comes after the modules it imported).
+    """
+    imports = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append({
+                'module': module,
+                'self_ms': int(self_us) / 1000,
+                'cumulative_ms': int(cumulative_us) / 1000,
+                # Modules imported directly by the script have depth 0
+                'depth': (len(indent) - 1) // 2,
+            })
+    return imports
+
+
+def measure_startup(settings_module=None, connect=False, import_times=False):
+    """
+    Start a fresh interpreter, set up Django, load the WSGI application
+    and warm it up, timing each phase.
+
+    Returns {'total': seconds from start to exit, 'phases': {...},
+    'imports': [...]}, with the imports only when `import_times` is set
+    (`-X importtime` slows the imports down somewhat).
+    """
+    env = dict(os.environ)
+    if settings_module:
+        env['DJANGO_SETTINGS_MODULE'] = settings_module
+    command = [sys.executable]
+    if import_times:
+        command += ['-X', 'importtime']
+    command += ['-c', STARTUP_SCRIPT]
+    if connect:
+        command.append('--connect')
+
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=settings.BASE_DIR, capture_output=True, text=True)
+    total = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'Startup failed:\n{result.stderr[-2000:]}')
+
+    return {
+        'total': total,
+        'phases': json.loads(result.stdout.strip().splitlines()[-1]),
+        'imports': parse_import_times(result.stderr) if import_times else [],
+    }